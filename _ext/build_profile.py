@@ -0,0 +1,374 @@
+"""Record and compare the time and memory used by each page and cell of a build.
+
+Both the chapter scripts run by ``doit execute_python_scripts`` and the pages
+executed by Jupyter Book are profiled. For every page, and every cell of it, the
+wall time, the peak resident memory, and the number of ``glue`` calls are
+appended to ``current.jsonl`` in the profile directory while the build runs. The
+sections of a script, marked by ``# [section-N]`` comments, are its cells. At the
+end of ``doit build_jb`` the records are collected into one entry in
+``history.jsonl`` and a report ranks the slowest cells and flags pages that got
+slower or used more memory than in the previous builds.
+
+Run a script with profiling with ``python build_profile.py run SCRIPT``.
+"""
+
+import argparse
+import json
+import os
+import re
+import resource
+import statistics
+import sys
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+HERE = Path(__file__).parent
+PROFILE = HERE.parent / ".build_profile"
+# Number of previous builds that each page is compared against
+N_PREVIOUS = 5
+# A page or cell is flagged when it is this much slower, or uses this much more
+# memory, than the median of the previous builds
+REGRESSION_FACTOR = 1.25
+# Differences in time and memory smaller than these are never flagged
+MIN_SECONDS = 0.5
+MIN_RSS = 32 * 1024**2
+# Split a script into sections at the markers used for literalinclude
+SECTION_REGEX = re.compile(r"^# \[(section-\d+)\]\s*$", re.MULTILINE)
+
+
+def reset_peak_rss(pid: int | None) -> bool:
+    """Reset the peak resident memory of process ``pid`` to its current value.
+
+    This writes to ``clear_refs`` in ``/proc``, so it is only available on Linux.
+    Returns whether the peak was reset.
+    """
+    if pid is None:
+        return False
+    try:
+        Path(f"/proc/{pid}/clear_refs").write_text("5")
+    except OSError:
+        return False
+    return True
+
+
+def kernel_peak_rss(pid: int | None) -> int | None:
+    """Return the peak resident memory of process ``pid`` in bytes.
+
+    This reads the high water mark from ``/proc``, so it is only available on
+    Linux and ``None`` is returned elsewhere. The mark is the peak since the
+    process started or since `reset_peak_rss` was last called.
+    """
+    if pid is None:
+        return None
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    match = re.search(r"^VmHWM:\s+(\d+) kB", status, re.MULTILINE)
+    return int(match.group(1)) * 1024 if match else None
+
+
+def own_peak_rss() -> int:
+    """Return the peak resident memory of this process in bytes.
+
+    On Linux this is the high water mark that `reset_peak_rss` resets, elsewhere
+    it is the peak since the process started.
+    """
+    peak = kernel_peak_rss(os.getpid())
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def rss_increase(before: int | None, after: int | None) -> int | None:
+    """Return how much a cell raised the peak resident memory, in bytes."""
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def count_glue(outputs: list[dict[str, Any]]) -> int:
+    """Count the outputs of a cell that were created by ``glue``."""
+    return sum("scrapbook" in output.get("metadata", {}) for output in outputs)
+
+
+def record(
+    kind: str,
+    name: str,
+    seconds: float,
+    cells: list[dict[str, Any]],
+    error: str | None = None,
+) -> None:
+    """Append the profile of one page or script to the records of this build.
+
+    Each record is written with a single append, so concurrent processes do not
+    interleave their records.
+    """
+    rss = [cell["peak_rss"] for cell in cells if cell["peak_rss"] is not None]
+    entry = {
+        "kind": kind,
+        "name": name,
+        "time": time.time(),
+        "seconds": seconds,
+        "peak_rss": max(rss, default=None),
+        "glue_calls": sum(cell["glue_calls"] for cell in cells),
+        "error": error,
+        "cells": cells,
+    }
+    PROFILE.mkdir(parents=True, exist_ok=True)
+    with PROFILE.joinpath("current.jsonl").open("a") as current:
+        current.write(json.dumps(entry) + "\n")
+
+
+def cell_label(source: str) -> str:
+    """Return the first line of code in ``source``, to identify a cell in reports."""
+    for line in source.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            return line if len(line) <= 60 else line[:57] + "..."
+    return ""
+
+
+class NotebookProfiler:
+    """Collect the profile of each cell while a notebook is executed.
+
+    Pass the hooks to ``nbclient.NotebookClient`` and set ``pid`` to the process
+    id of the kernel once it has started. The peak memory of the kernel is reset
+    before each cell where possible, so each cell records its own peak, and
+    ``rss_increase`` is how far the cell raised it above the memory the cell
+    started with.
+    """
+
+    def __init__(self) -> None:
+        self.pid: int | None = None
+        self.cells: list[dict[str, Any]] = []
+        self.start = time.perf_counter()
+        self.cell_start = self.start
+        self.cell_rss: int | None = None
+
+    def on_cell_start(self, cell: dict[str, Any], cell_index: int) -> None:
+        reset_peak_rss(self.pid)
+        self.cell_rss = kernel_peak_rss(self.pid)
+        self.cell_start = time.perf_counter()
+
+    def on_cell_executed(self, cell: dict[str, Any], cell_index: int, **_: Any) -> None:
+        peak_rss = kernel_peak_rss(self.pid)
+        self.cells.append(
+            {
+                "index": cell_index,
+                "label": cell_label(cell["source"]),
+                "seconds": time.perf_counter() - self.cell_start,
+                "peak_rss": peak_rss,
+                "rss_increase": rss_increase(self.cell_rss, peak_rss),
+                "glue_calls": count_glue(cell.get("outputs", [])),
+            }
+        )
+
+    def record(self, name: str, error: str | None = None) -> None:
+        record("page", name, time.perf_counter() - self.start, self.cells, error)
+
+
+def split_sections(source: str) -> list[tuple[str, int, str]]:
+    """Split a script into its sections.
+
+    Returns the name, first line number, and source of each section. Code before
+    the first marker is a section called ``start``.
+    """
+    sections = []
+    name, start = "start", 0
+    for match in SECTION_REGEX.finditer(source):
+        sections.append((name, start, source[start : match.start()]))
+        name, start = match.group(1), match.start()
+    sections.append((name, start, source[start:]))
+    return [
+        (name, source.count("\n", 0, start) + 1, code)
+        for name, start, code in sections
+        if code.strip()
+    ]
+
+
+def run_script(script: Path) -> int:
+    """Run ``script`` one section at a time and record the profile of each one.
+
+    The sections share a namespace, so the script behaves as if it was run with
+    ``python SCRIPT``. The peak memory is reset before each section where
+    possible, as for the cells of a notebook. Returns the exit status.
+    """
+    glue_calls = [0]
+    try:
+        from IPython import display as ipython_display
+    except ImportError:
+        ipython_display = None
+    if ipython_display is not None:
+        original_display = ipython_display.display
+
+        def counting_display(*objs: Any, **kwargs: Any) -> Any:
+            if "scrapbook" in (kwargs.get("metadata") or {}):
+                glue_calls[0] += 1
+            return original_display(*objs, **kwargs)
+
+        ipython_display.display = counting_display
+
+    source = script.read_text(encoding="utf-8")
+    namespace = {"__name__": "__main__", "__file__": str(script.resolve())}
+    sys.argv = [str(script)]
+    sys.path.insert(0, str(script.resolve().parent))
+    cells = []
+    error = None
+    start = time.perf_counter()
+    for index, (name, line, code) in enumerate(split_sections(source)):
+        glue_calls[0] = 0
+        reset_peak_rss(os.getpid())
+        cell_rss = own_peak_rss()
+        cell_start = time.perf_counter()
+        # Pad the code so that line numbers in tracebacks match the script
+        compiled = compile("\n" * (line - 1) + code, str(script), "exec")
+        try:
+            exec(compiled, namespace)
+        except BaseException as e:
+            if isinstance(e, SystemExit) and not e.code:
+                break
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        finally:
+            peak_rss = own_peak_rss()
+            cells.append(
+                {
+                    "index": index,
+                    "label": name,
+                    "seconds": time.perf_counter() - cell_start,
+                    "peak_rss": peak_rss,
+                    "rss_increase": rss_increase(cell_rss, peak_rss),
+                    "glue_calls": glue_calls[0],
+                }
+            )
+        if error is not None:
+            break
+    try:
+        script_name = str(script.resolve().relative_to(HERE.parent))
+    except ValueError:
+        script_name = str(script)
+    record("script", script_name, time.perf_counter() - start, cells, error)
+    return 1 if error is not None else 0
+
+
+def read_history() -> list[dict[str, Any]]:
+    history = PROFILE / "history.jsonl"
+    if not history.exists():
+        return []
+    return [json.loads(line) for line in history.read_text().splitlines()]
+
+
+def finish_build() -> None:
+    """Collect the records of this build into the history and print the report."""
+    current = PROFILE / "current.jsonl"
+    if not current.exists():
+        print("No pages or scripts were executed in this build")
+        return
+    entries = [json.loads(line) for line in current.read_text().splitlines()]
+    build = {"time": datetime.now().isoformat(timespec="seconds"), "pages": entries}
+    with PROFILE.joinpath("history.jsonl").open("a") as history:
+        history.write(json.dumps(build) + "\n")
+    current.unlink()
+    print_report()
+
+
+def format_size(n_bytes: int | None) -> str:
+    return "-" if n_bytes is None else f"{n_bytes / 1024**2:.0f} MB"
+
+
+def format_increase(n_bytes: int | None) -> str:
+    return "-" if n_bytes is None else "+" + format_size(n_bytes)
+
+
+def regressions(
+    history: list[dict[str, Any]], n_previous: int = N_PREVIOUS
+) -> list[str]:
+    """Compare each page of the last build with the same page in the previous
+    ``n_previous`` builds that executed it.
+    """
+    *previous, last = history
+    lines = []
+    for page in last["pages"]:
+        earlier = [
+            old
+            for build in previous
+            for old in build["pages"]
+            if old["name"] == page["name"] and old["error"] is None
+        ][-n_previous:]
+        if not earlier or page["error"] is not None:
+            continue
+        seconds = statistics.median(old["seconds"] for old in earlier)
+        if (
+            page["seconds"] > REGRESSION_FACTOR * seconds
+            and page["seconds"] - seconds > MIN_SECONDS
+        ):
+            lines.append(
+                f"{page['name']}: {page['seconds']:.2f} s, "
+                f"median of the previous {len(earlier)} was {seconds:.2f} s"
+            )
+        rss = [old["peak_rss"] for old in earlier if old["peak_rss"] is not None]
+        if rss and page["peak_rss"] is not None:
+            peak = statistics.median(rss)
+            if (
+                page["peak_rss"] > REGRESSION_FACTOR * peak
+                and page["peak_rss"] - peak > MIN_RSS
+            ):
+                lines.append(
+                    f"{page['name']}: {format_size(page['peak_rss'])} peak memory, "
+                    f"median of the previous {len(rss)} was {format_size(int(peak))}"
+                )
+    return lines
+
+
+def print_report(top: int = 10, n_previous: int = N_PREVIOUS) -> None:
+    """Print the slowest cells of the last build and any regressions."""
+    history = read_history()
+    if not history:
+        print("There are no profiled builds yet")
+        return
+    last = history[-1]
+    pages = last["pages"]
+    total = sum(page["seconds"] for page in pages)
+    print(f"Build of {last['time']}: {len(pages)} pages executed in {total:.2f} s")
+    cells = sorted(
+        ((cell, page) for page in pages for cell in page["cells"]),
+        key=lambda item: item[0]["seconds"],
+        reverse=True,
+    )
+    if cells:
+        print(f"Slowest {min(top, len(cells))} cells:")
+    for cell, page in cells[:top]:
+        print(
+            f"  {cell['seconds']:8.2f} s {format_size(cell['peak_rss']):>8} "
+            f"{format_increase(cell.get('rss_increase')):>9} "
+            f"{cell['glue_calls']:3d} glue  {page['name']} [{cell['index']}] "
+            f"{cell['label']}"
+        )
+    for page in pages:
+        if page["error"] is not None:
+            print(f"Failed: {page['name']}: {page['error']}")
+    found = regressions(history, n_previous)
+    if found:
+        print("Regressions:")
+        for line in found:
+            print("  " + line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run a script with profiling")
+    run_parser.add_argument("script", type=Path)
+    report_parser = subparsers.add_parser("report", help="Print the last report")
+    report_parser.add_argument("--top", type=int, default=10)
+    report_parser.add_argument("--previous", type=int, default=N_PREVIOUS)
+    args = parser.parse_args()
+    if args.command == "run":
+        sys.exit(run_script(args.script))
+    print_report(args.top, args.previous)
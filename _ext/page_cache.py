@@ -0,0 +1,472 @@
+"""Sphinx extension to reuse the outputs of pages whose code has not changed.
+
+MyST Markdown pages have no stored outputs, so in the ``auto`` execution mode they
+are executed on every build, even when only the prose changed. This extension
+wraps the direct execution client of MyST-NB so that the outputs of each page are
+stored in a cache keyed on the code cells of the page, the local modules they
+import, and the data files they name. When the key of a page is unchanged, the
+stored outputs, including the glue values, are reused instead of executing it.
+
+Before Sphinx reads the pages, the ones that need to be executed are executed in a
+pool of processes, starting with the pages that took longest in earlier builds, and
+their outputs are stored in the cache for the reader to use.
+"""
+
+import copy
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any
+
+import nbformat
+from build_profile import NotebookProfiler
+from myst_nb import sphinx_
+from myst_nb.core.execute import (
+    ExecutionError,
+    NotebookClientBase,
+    NotebookClientDirect,
+    create_client,
+)
+from myst_nb.core.read import create_nb_reader
+from nbclient import NotebookClient
+from nbclient.exceptions import CellExecutionError, CellTimeoutError
+from sphinx.application import Sphinx
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+HERE = Path(__file__).parent
+CACHE = HERE.parent / "_build" / ".page_cache"
+# Bump this when the way outputs are stored changes so that old entries are not used
+CACHE_VERSION = "page-cache-1"
+# Largest total size in bytes of the cache before the least recently used entries
+# are removed at the end of the build
+MAX_SIZE = 500 * 1024**2
+# Names of modules imported by a code cell
+IMPORT_REGEX = re.compile(r"^\s*(?:from|import)\s+([A-Za-z_]\w*)", re.MULTILINE)
+# Anything in a code cell that might be a path to a file relative to the page
+PATH_REGEX = re.compile(r"[\w./-]+\.\w+")
+# Number of processes used to execute pages, None to use one per CPU
+PROCESSES = None
+
+# The cache and the build environment in this process
+_STATE: dict[str, Any] = {}
+
+
+def dependencies(code: str, folder: Path) -> list[Path]:
+    """Return the local modules and data files used by ``code``.
+
+    Modules are looked up in ``folder``, where the page is executed, and data
+    files are any existing files named relative to ``folder``.
+    """
+    files = set()
+    for module in IMPORT_REGEX.findall(code):
+        for candidate in (folder / f"{module}.py", folder / module / "__init__.py"):
+            if candidate.is_file():
+                files.add(candidate)
+    for name in PATH_REGEX.findall(code):
+        candidate = folder / name
+        try:
+            if candidate.is_file():
+                files.add(candidate)
+        except OSError:
+            continue
+    return sorted(files)
+
+
+class PageCache:
+    """Cache of executed notebooks, stored as one ``.ipynb`` file per key.
+
+    Entries are sharded into subdirectories by the first two characters of the
+    key and written atomically, so several processes can share the cache. The
+    modification time of an entry is updated when it is read, which is used for
+    LRU eviction.
+    """
+
+    def __init__(self, directory: Path = CACHE) -> None:
+        self.directory = directory
+        self.stats = {"hits": 0, "misses": 0, "writes": 0}
+
+    @staticmethod
+    def key(notebook: nbformat.NotebookNode, path: Path) -> str:
+        code = [cell.source for cell in notebook.cells if cell.cell_type == "code"]
+        files = {
+            str(file.relative_to(path.parent)): hashlib.sha256(
+                file.read_bytes()
+            ).hexdigest()
+            for file in dependencies("\n".join(code), path.parent)
+        }
+        kernelspec = notebook.metadata.get("kernelspec", {})
+        payload = json.dumps(
+            {
+                "code": code,
+                "files": files,
+                "kernel": kernelspec.get("name"),
+                "python": sys.version,
+                "version": CACHE_VERSION,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.ipynb"
+
+    def get(self, key: str) -> nbformat.NotebookNode | None:
+        path = self.path(key)
+        try:
+            notebook = nbformat.read(path, as_version=nbformat.NO_CONVERT)
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return notebook
+
+    def set(
+        self, key: str, notebook: nbformat.NotebookNode, docname: str, runtime: float
+    ) -> None:
+        notebook = copy.deepcopy(notebook)
+        notebook.metadata["page_cache"] = {"page": docname, "runtime": runtime}
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            nbformat.write(notebook, tmp_file)
+        os.replace(tmp_name, path)
+        self.stats["writes"] += 1
+
+    def entries(self) -> list[Path]:
+        return list(self.directory.glob("??/*.ipynb"))
+
+    def read_timings(self) -> dict[str, float]:
+        """Return the time in seconds each page took to execute when it was last
+        executed by `execute_pages`.
+        """
+        try:
+            return json.loads(self.directory.joinpath("timings.json").read_text())
+        except FileNotFoundError:
+            return {}
+
+    def write_timings(self, timings: dict[str, float]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(timings, tmp_file, indent=2, sort_keys=True)
+        os.replace(tmp_name, self.directory / "timings.json")
+
+    def evict(self, max_size: int = MAX_SIZE) -> int:
+        """Remove the least recently used entries until the cache is smaller than
+        ``max_size`` bytes.
+
+        Returns the number of entries removed.
+        """
+        entries = []
+        for path in self.entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(reverse=True)
+        total = 0
+        n_removed = 0
+        for _, size, path in entries:
+            total += size
+            if total > max_size:
+                path.unlink(missing_ok=True)
+                n_removed += 1
+        return n_removed
+
+    def invalidate(self, pages: list[str] | None = None) -> int:
+        """Remove the entries of ``pages``, given as document names such as
+        ``the-n-body-problem/jacobi-constant``, or all the entries if ``pages``
+        is ``None``.
+
+        Returns the number of entries removed.
+        """
+        n_removed = 0
+        for path in self.entries():
+            if pages is not None:
+                notebook = nbformat.read(path, as_version=nbformat.NO_CONVERT)
+                if notebook.metadata.get("page_cache", {}).get("page") not in pages:
+                    continue
+            path.unlink(missing_ok=True)
+            n_removed += 1
+        return n_removed
+
+
+def invalidate_cache(pages: list[str] | None = None) -> None:
+    n_removed = PageCache().invalidate(pages or None)
+    print(f"Removed {n_removed} entries from the page execution cache")
+
+
+def execute_notebook(
+    notebook: nbformat.NotebookNode,
+    cwd: str,
+    allow_errors: bool,
+    timeout: int | None,
+    docname: str,
+) -> tuple[nbformat.NotebookNode, float, str | None, str | None]:
+    """Execute ``notebook`` in place and record its profile.
+
+    Like MyST-NB, the ``timeout`` and ``allow_errors`` options can be overridden
+    in the ``execution`` metadata of the notebook. Returns the executed notebook,
+    the time it took, and the error and traceback if it failed.
+    """
+    execution = notebook.metadata.get("execution", {})
+    profiler = NotebookProfiler()
+
+    def set_kernel_pid(**_: Any) -> None:
+        provisioner = client.km.provisioner if client.km is not None else None
+        profiler.pid = getattr(provisioner, "pid", None)
+
+    client = NotebookClient(
+        notebook,
+        timeout=execution.get("timeout", timeout),
+        allow_errors=execution.get("allow_errors", allow_errors),
+        record_timing=False,
+        resources={"metadata": {"path": cwd}},
+        on_notebook_start=set_kernel_pid,
+        on_cell_start=profiler.on_cell_start,
+        on_cell_executed=profiler.on_cell_executed,
+    )
+    start = time.perf_counter()
+    error = exc_string = None
+    try:
+        client.execute()
+    except (CellExecutionError, CellTimeoutError) as err:
+        error = type(err).__name__
+        exc_string = traceback.format_exc()
+    runtime = time.perf_counter() - start
+    profiler.record(docname, error)
+    return notebook, runtime, error, exc_string
+
+
+class NotebookClientPageCache(NotebookClientBase):
+    """A notebook client that reuses the outputs of a page from the page cache,
+    or executes the page directly and stores its outputs if it succeeds.
+    """
+
+    def start_client(self) -> None:
+        cache: PageCache = _STATE["cache"]
+        assert self.path is not None
+        key = cache.key(self.notebook, self.path)
+        cached = cache.get(key)
+        if cached is not None:
+            code_cells = [c for c in self.notebook.cells if c.cell_type == "code"]
+            cached_cells = [c for c in cached.cells if c.cell_type == "code"]
+            for cell, cached_cell in zip(code_cells, cached_cells):
+                cell.outputs = cached_cell.outputs
+                cell.execution_count = cached_cell.execution_count
+            runtime = cached.metadata.get("page_cache", {}).get("runtime")
+            self.logger.info(f"Using cached outputs: key={key[:12]}")
+            self.exec_metadata = {
+                "mtime": cache.path(key).stat().st_mtime,
+                "runtime": runtime,
+                "method": "page_cache",
+                "succeeded": True,
+                "error": None,
+                "traceback": None,
+            }
+            return
+
+        cwd_context = (
+            TemporaryDirectory()
+            if self.nb_config.execution_in_temp
+            else nullcontext(str(self.path.parent))
+        )
+        docname = self._kwargs["docname"]
+        with cwd_context as cwd:
+            self.logger.info("Executing notebook")
+            _, runtime, error, exc_string = execute_notebook(
+                self.notebook,
+                os.path.abspath(cwd),
+                self.nb_config.execution_allow_errors,
+                self.nb_config.execution_timeout,
+                docname,
+            )
+        if error is not None:
+            if self.nb_config.execution_raise_on_error:
+                raise ExecutionError(str(self.path))
+            msg = f"Executing notebook failed: {error}"
+            if self.nb_config.execution_show_tb:
+                msg += f"\n{exc_string}"
+            self.logger.warning(msg, subtype="exec")
+        else:
+            self.logger.info(f"Executed notebook in {runtime:.2f} seconds")
+            cache.set(key, self.notebook, docname, runtime)
+        self.exec_metadata = {
+            "mtime": datetime.now().timestamp(),
+            "runtime": runtime,
+            "method": "page_cache",
+            "succeeded": error is None,
+            "error": error,
+            "traceback": exc_string,
+        }
+
+
+def create_cached_client(
+    notebook: nbformat.NotebookNode,
+    source: str,
+    nb_config: Any,
+    logger: Any,
+    read_fmt: dict | None = None,
+) -> Any:
+    """Create the MyST-NB client for a page, using the page cache whenever the
+    page would otherwise be executed directly.
+    """
+    client = create_client(notebook, source, nb_config, logger, read_fmt)
+    if type(client) is not NotebookClientDirect or client.path is None:
+        return client
+    docname = _STATE["env"].path2doc(str(client.path)) or str(client.path)
+    return NotebookClientPageCache(
+        notebook, client.path, nb_config, logger, docname=docname
+    )
+
+
+def read_page(env: Any, docname: str) -> tuple[nbformat.NotebookNode, Any] | None:
+    """Read ``docname`` as a notebook like the MyST-NB parser does.
+
+    Returns the notebook and its configuration, or ``None`` if the page is not a
+    notebook.
+    """
+    path = env.doc2path(docname)
+    content = Path(path).read_text(encoding="utf-8")
+    nb_config = env.mystnb_config
+    nb_reader = create_nb_reader(path, env.myst_config, nb_config, content)
+    if nb_reader is None:
+        return None
+    notebook = nb_reader.read(content)
+    kernelspec = notebook.metadata.get("kernelspec", {})
+    for pattern, alias in nb_config.kernel_rgx_aliases.items():
+        if kernelspec.get("name") and re.fullmatch(pattern, kernelspec["name"]):
+            kernelspec["name"] = alias
+            break
+    if nb_config.metadata_key in notebook.metadata:
+        overrides = dict(notebook.metadata[nb_config.metadata_key])
+        overrides.pop("output_folder", None)
+        try:
+            nb_config = nb_config.copy(**overrides)
+        except Exception:
+            # The parser warns about this when it reads the page
+            pass
+    return notebook, nb_config
+
+
+def execute_pages(app: Sphinx, env: Any, docnames: list[str]) -> None:
+    """Execute the pages that are about to be read and are not in the cache in a
+    pool of processes, starting with the ones that took longest last time.
+
+    The outputs are stored in the cache, where the reader finds them. Pages that
+    fail are left for the reader, which executes them again and reports the error.
+    """
+    processes = app.config.page_cache_processes or os.cpu_count() or 1
+    if processes < 2:
+        return
+    cache: PageCache = _STATE["cache"]
+    pending = []
+    for docname in docnames:
+        page = read_page(env, docname)
+        if page is None:
+            continue
+        notebook, nb_config = page
+        client = create_client(notebook, env.doc2path(docname), nb_config, logger)
+        if (
+            type(client) is not NotebookClientDirect
+            or client.path is None
+            or nb_config.execution_in_temp
+        ):
+            continue
+        key = cache.key(notebook, client.path)
+        if not cache.path(key).exists():
+            pending.append((docname, key, notebook, client.path, nb_config))
+    if len(pending) < 2:
+        return
+
+    timings = cache.read_timings()
+    # Pages without a timing are new, so run them early in case they are slow
+    pending.sort(key=lambda page: timings.get(page[0], math.inf), reverse=True)
+    processes = min(processes, len(pending))
+    logger.info(
+        "Executing %d pages in %d processes", len(pending), processes, color="green"
+    )
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as executor:
+        futures = {
+            executor.submit(
+                execute_notebook,
+                notebook,
+                str(path.parent),
+                nb_config.execution_allow_errors,
+                nb_config.execution_timeout,
+                docname,
+            ): (docname, key)
+            for docname, key, notebook, path, nb_config in pending
+        }
+        for future in as_completed(futures):
+            docname, key = futures[future]
+            try:
+                notebook, runtime, error, _ = future.result()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            if error is not None:
+                logger.info("Executing %s failed: %s", docname, error)
+                continue
+            timings[docname] = runtime
+            cache.set(key, notebook, docname, runtime)
+            logger.info("Executed %s in %.2f s", docname, runtime)
+    cache.write_timings(timings)
+    logger.info(
+        "Executed %d pages in %.2f s", len(pending), time.perf_counter() - start
+    )
+
+
+def init_state(app: Sphinx) -> None:
+    _STATE["cache"] = PageCache(Path(app.config.page_cache_path))
+    _STATE["env"] = app.env
+
+
+def evict(app: Sphinx, exception: Exception | None) -> None:
+    cache: PageCache | None = _STATE.get("cache")
+    if cache is None:
+        return
+    start = time.perf_counter()
+    n_removed = cache.evict(app.config.page_cache_max_size)
+    stats = cache.stats
+    logger.info(
+        "Page cache: %d hits, %d misses, %d writes, evicted %d entries in %.2f s",
+        stats["hits"],
+        stats["misses"],
+        stats["writes"],
+        n_removed,
+        time.perf_counter() - start,
+    )
+
+
+def setup(app: Sphinx) -> dict:
+    app.setup_extension("myst_nb")
+    # MyST-NB has no hook for custom execution clients, so replace the function
+    # that its parser uses to create them
+    sphinx_.create_client = create_cached_client
+    app.add_config_value("page_cache_path", str(CACHE), "env")
+    app.add_config_value("page_cache_max_size", MAX_SIZE, "env")
+    app.add_config_value("page_cache_processes", PROCESSES, "env")
+    app.connect("builder-inited", init_state)
+    app.connect("env-before-read-docs", execute_pages)
+    app.connect("build-finished", evict)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
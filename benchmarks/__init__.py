@@ -0,0 +1,5 @@
+"""Propagators, integrators, and helpers that are not part of the book.
+
+The modules import each other relatively, so run the comparison or benchmark of
+each one from the root of the repository with ``python -m benchmarks.NAME``.
+"""
@@ -0,0 +1,362 @@
+"""Barnes-Hut tree gravity for simulations with many bodies.
+
+Direct summation in ``n_body.accelerations`` costs O(N²) per evaluation. Here the
+bodies are sorted into an octree, and the bodies in a cell that is far enough away
+are replaced by a single body at their center of mass. A cell of side ``s`` is used
+whole when ``s`` is less than the opening angle ``theta`` times its distance from
+the bodies, so ``theta = 0`` gives the same result as direct summation and larger
+values trade accuracy for speed.
+
+The tree is stored in flat arrays, with one entry per node for its range of bodies,
+mass, center of mass, size, and children, so that it can be built and walked with
+NumPy operations on whole levels of the tree and many bodies at once. The bodies
+are ordered along a Morton curve, so the bodies of every node are contiguous, and
+small groups of consecutive bodies share one walk of the tree. An ``Octree`` keeps
+the order between evaluations, so rebuilding the tree after a step starts from a
+nearly sorted order.
+
+``barnes_hut_rhs`` has the same interface as ``n_body.n_body_rhs``. Run this file
+to print tables of the accuracy and speed against direct summation.
+"""
+
+import time
+
+import numpy as np
+
+from .n_body import G, accelerations
+
+# Default opening angle
+THETA = 0.5
+# Largest number of bodies in a leaf of the tree
+LEAF_SIZE = 16
+# Number of levels of the tree, the bits per axis of the Morton codes
+MAX_DEPTH = 21
+# Number of consecutive bodies that share one walk of the tree
+GROUP_SIZE = 8
+# Number of groups whose interactions are found together while walking the tree
+BATCH_SIZE = 1024
+# Largest number of interactions evaluated together, to bound the memory used
+PAIR_CHUNK = 2**16
+
+
+def spread_bits(x: np.ndarray) -> np.ndarray:
+    """Insert two zero bits between each of the lowest 21 bits of ``x``."""
+    x = x.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in (
+        (32, 0x1F00000000FFFF),
+        (16, 0x1F0000FF0000FF),
+        (8, 0x100F00F00F00F00F),
+        (4, 0x10C30C30C30C30C3),
+        (2, 0x1249249249249249),
+    ):
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def morton_codes(R: np.ndarray, low: np.ndarray, size: float) -> np.ndarray:
+    """Return the Morton code of each position in the cube at ``low`` of side
+    ``size``.
+    """
+    cells = (R - low) / size * 2**MAX_DEPTH
+    cells = np.clip(cells, 0, 2**MAX_DEPTH - 1).astype(np.uint64)
+    return (
+        (spread_bits(cells[:, 0]) << np.uint64(2))
+        | (spread_bits(cells[:, 1]) << np.uint64(1))
+        | spread_bits(cells[:, 2])
+    )
+
+
+class Octree:
+    """Octree of bodies stored in flat arrays.
+
+    After ``build``, the bodies are in the order ``order``, and node ``k`` holds
+    the bodies ``start[k]`` to ``end[k]`` of that order, with total mass
+    ``mass[k]``, center of mass ``com[k]``, and side ``size[k]``. The children of
+    node ``k`` are nodes ``first_child[k]`` to ``first_child[k] + n_children[k]``,
+    and leaves have no children. The bodies are also split into groups of
+    ``GROUP_SIZE`` consecutive bodies, each with a center of mass and the radius of
+    a sphere around it that contains the bodies of the group.
+    """
+
+    def __init__(self, leaf_size: int = LEAF_SIZE) -> None:
+        self.leaf_size = leaf_size
+        self.order: np.ndarray | None = None
+        self.stats = {"builds": 0, "build_seconds": 0.0, "walk_seconds": 0.0}
+
+    def sort(self, codes: np.ndarray) -> None:
+        """Sort the bodies by their Morton codes, starting from the order of the
+        previous build.
+
+        The bodies move little between evaluations, so the previous order is
+        nearly sorted.
+        """
+        if self.order is None or self.order.size != codes.size:
+            self.order = np.arange(codes.size)
+        self.order = self.order[np.argsort(codes[self.order], kind="stable")]
+
+    def build(self, R: np.ndarray, masses: np.ndarray) -> None:
+        start_time = time.perf_counter()
+        R = np.asarray(R, dtype=float)
+        masses = np.asarray(masses, dtype=float)
+        low = R.min(axis=0)
+        size = float(np.max(R.max(axis=0) - low)) * (1 + 1e-12) or 1.0
+        codes = morton_codes(R, low, size)
+        self.sort(codes)
+        codes = codes[self.order]
+        self.positions = R[self.order]
+        self.masses = masses[self.order]
+        n_bodies = len(R)
+
+        # Pad with zeros so that reduceat can sum up to the last body
+        weighted = np.zeros((n_bodies + 1, 4))
+        weighted[:-1, 0] = self.masses
+        weighted[:-1, 1:] = self.masses[:, None] * self.positions
+
+        starts = [np.array([0])]
+        ends = [np.array([n_bodies])]
+        parents = [np.array([-1])]
+        # The node of each body at the previous level, or -1 if it is in a leaf
+        body_node = np.zeros(n_bodies, dtype=int)
+        n_nodes = 1
+        for level in range(1, MAX_DEPTH + 1):
+            # Split the nodes of the previous level with too many bodies, the
+            # last element is False for the bodies that are already in leaves
+            internal = np.zeros(n_nodes + 1, dtype=bool)
+            internal[n_nodes - starts[-1].size : n_nodes] = (
+                ends[-1] - starts[-1] > self.leaf_size
+            )
+            index = np.flatnonzero(internal[body_node])
+            if index.size == 0:
+                break
+            # The bodies of each child have the same code down to this level and
+            # are contiguous in the sorted order
+            keys = codes[index] >> np.uint64(3 * (MAX_DEPTH - level))
+            new = np.ones(index.size, dtype=bool)
+            new[1:] = (keys[1:] != keys[:-1]) | (index[1:] != index[:-1] + 1)
+            first = np.flatnonzero(new)
+            run_starts = index[first]
+            run_ends = index[np.append(first[1:], index.size) - 1] + 1
+            starts.append(run_starts)
+            ends.append(run_ends)
+            parents.append(body_node[run_starts])
+            body_node = np.full(n_bodies, -1)
+            body_node[index] = np.repeat(
+                np.arange(n_nodes, n_nodes + run_starts.size), run_ends - run_starts
+            )
+            n_nodes += run_starts.size
+
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        parent = np.concatenate(parents)
+        self.level = np.repeat(np.arange(len(starts)), [s.size for s in starts])
+        self.size = size / 2.0**self.level
+        sums = np.add.reduceat(
+            weighted, np.column_stack((self.start, self.end)).ravel()
+        )[::2]
+        self.mass = sums[:, 0]
+        self.com = sums[:, 1:] / np.where(self.mass > 0, self.mass, 1.0)[:, None]
+        n_children = np.bincount(parent[1:], minlength=self.start.size)
+        self.n_children = n_children
+        # Children are created in the order of their parents
+        self.first_child = np.cumsum(n_children) - n_children + 1
+        # The bodies are divided into groups of GROUP_SIZE consecutive bodies,
+        # which are close together because of the Morton order. The last group is
+        # padded with massless copies of its first body.
+        index = np.arange(-(-n_bodies // GROUP_SIZE) * GROUP_SIZE)
+        self.valid = (index < n_bodies).reshape(-1, GROUP_SIZE)
+        index = np.where(index < n_bodies, index, index[-GROUP_SIZE])
+        self.group_index = index.reshape(-1, GROUP_SIZE)
+        self.group_positions = self.positions[self.group_index]
+        self.group_coordinates = [
+            np.ascontiguousarray(self.group_positions[..., k].T) for k in range(3)
+        ]
+        group_masses = np.where(self.valid, self.masses[self.group_index], 0.0)
+        self.group_start = self.group_index[:, 0]
+        self.group_end = self.group_start + self.valid.sum(axis=1)
+        self.group_com = np.einsum(
+            "gs,gsi->gi", group_masses, self.group_positions
+        ) / group_masses.sum(axis=1, keepdims=True)
+        self.group_radius = np.max(
+            np.linalg.norm(self.group_positions - self.group_com[:, None], axis=2),
+            axis=1,
+        )
+        self.stats["builds"] += 1
+        self.stats["build_seconds"] += time.perf_counter() - start_time
+
+    def accelerations(
+        self, theta: float = THETA, G: float = G, softening: float = 0.0
+    ) -> np.ndarray:
+        """Return the acceleration of each body, in the order they were given to
+        ``build``.
+
+        The tree is walked once for each group of bodies rather than for each
+        body, so the bodies of a group share one list of the nodes they interact
+        with. A node is used whole when its side is less than ``theta`` times its
+        distance to the nearest point of a sphere around the group, otherwise it is
+        opened, and the bodies of the leaves that are too close are summed
+        directly.
+        """
+        start_time = time.perf_counter()
+        a = np.zeros_like(self.group_positions)
+        eps_sq = softening**2
+        n_groups = len(self.group_start)
+        for batch in range(0, n_groups, BATCH_SIZE):
+            # Pairs of a group and a node, starting at the root
+            group = np.arange(batch, min(batch + BATCH_SIZE, n_groups))
+            node = np.zeros(group.size, dtype=int)
+            groups, positions, masses = [], [], []
+            while group.size:
+                d = self.com[node] - self.group_com[group]
+                distance = np.sqrt(np.einsum("ij,ij->i", d, d))
+                overlap = (self.start[node] < self.group_end[group]) & (
+                    self.group_start[group] < self.end[node]
+                )
+                far = ~overlap & (
+                    self.size[node] < theta * (distance - self.group_radius[group])
+                )
+                near = ~far & (self.n_children[node] == 0)
+                groups.append(group[far])
+                positions.append(self.com[node[far]])
+                masses.append(self.mass[node[far]])
+                owner, offset = expand(self.end[node[near]] - self.start[node[near]])
+                body = self.start[node[near]][owner] + offset
+                groups.append(group[near][owner])
+                positions.append(self.positions[body])
+                masses.append(self.masses[body])
+                opened = ~far & ~near
+                owner, offset = expand(self.n_children[node[opened]])
+                group = group[opened][owner]
+                node = self.first_child[node[opened]][owner] + offset
+            self.add(
+                a,
+                np.concatenate(groups),
+                np.concatenate(positions),
+                np.concatenate(masses),
+                eps_sq,
+            )
+        result = np.empty((len(self.positions), 3))
+        result[self.order[self.group_index[self.valid]]] = G * a[self.valid]
+        self.stats["walk_seconds"] += time.perf_counter() - start_time
+        return result
+
+    def add(
+        self,
+        a: np.ndarray,
+        group: np.ndarray,
+        positions: np.ndarray,
+        masses: np.ndarray,
+        eps_sq: float,
+    ) -> None:
+        """Add the accelerations of point masses to the bodies of each group.
+
+        The masses are either the nodes used whole or the bodies of the leaves
+        that are too close. A body does not interact with itself.
+        """
+        order = np.argsort(group, kind="stable")
+        n_pairs = max(1, PAIR_CHUNK // GROUP_SIZE)
+        for i in range(0, order.size, n_pairs):
+            part = order[i : i + n_pairs]
+            targets = group[part]
+            # Each component is a contiguous array of shape (GROUP_SIZE, pairs), so
+            # that the sums over the pairs of each group are over contiguous rows
+            d = [
+                positions[part, k] - self.group_coordinates[k][:, targets]
+                for k in range(3)
+            ]
+            r_sq = d[0] * d[0]
+            r_sq += d[1] * d[1]
+            r_sq += d[2] * d[2]
+            r_sq[r_sq == 0] = np.inf
+            r_sq += eps_sq
+            weights = np.sqrt(r_sq)
+            weights *= r_sq
+            np.divide(masses[part], weights, out=weights)
+            first = np.flatnonzero(np.diff(targets, prepend=-1))
+            for k in range(3):
+                d[k] *= weights
+                a[targets[first], :, k] += np.add.reduceat(d[k], first, axis=1).T
+
+
+def expand(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the owner of each of ``sum(counts)`` items, where owner ``i`` has
+    ``counts[i]`` items, and the offset of each item among those of its owner.
+    """
+    owner = np.repeat(np.arange(counts.size), counts)
+    offset = np.arange(owner.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, offset
+
+
+def barnes_hut_rhs(
+    t: float,
+    y: np.ndarray,
+    masses: np.ndarray,
+    G: float = G,
+    softening: float = 0.0,
+    theta: float = THETA,
+    tree: Octree | None = None,
+) -> np.ndarray:
+    """Calculate the motion of N bodies in an inertial reference frame with the
+    accelerations from a Barnes-Hut tree.
+
+    The state vector is in the same order as for ``n_body.n_body_rhs``. Pass the
+    same ``tree`` to every call so that the order of the bodies is reused when the
+    tree is rebuilt.
+    """
+    if tree is None:
+        tree = Octree()
+    n_bodies = len(masses)
+    ydot = np.empty_like(y, dtype=float)
+    ydot[: 3 * n_bodies] = y[3 * n_bodies :]
+    tree.build(y[: 3 * n_bodies].reshape(n_bodies, 3), masses)
+    ydot[3 * n_bodies :] = tree.accelerations(theta, G, softening).ravel()
+    return ydot
+
+
+if __name__ == "__main__":
+    # Bodies in a Plummer sphere, in units with G = 1 and a total mass of 1
+    rng = np.random.default_rng(0)
+
+    def plummer(n_bodies: int) -> np.ndarray:
+        radius = 1 / np.sqrt(rng.uniform(0.01, 0.99, n_bodies) ** (-2 / 3) - 1)
+        direction = rng.normal(size=(n_bodies, 3))
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+        return radius[:, None] * direction
+
+    softening = 1e-3
+    print("Accuracy and speed against direct summation, relative error of |a|")
+    print("     N  theta  direct (s)    tree (s)  speedup    median       99%")
+    for n_bodies in (1000, 5000, 20_000):
+        R = plummer(n_bodies)
+        masses = np.full(n_bodies, 1 / n_bodies)
+        start = time.perf_counter()
+        exact = accelerations(R, masses, 1.0, softening)
+        direct = time.perf_counter() - start
+        for theta in (0.0, 0.3, 0.5, 0.7, 1.0):
+            if theta == 0 and n_bodies > 5000:
+                continue
+            tree = Octree()
+            start = time.perf_counter()
+            tree.build(R, masses)
+            a = tree.accelerations(theta, 1.0, softening)
+            seconds = time.perf_counter() - start
+            error = np.linalg.norm(a - exact, axis=1) / np.linalg.norm(exact, axis=1)
+            print(
+                f"{n_bodies:6d}  {theta:5.1f}  {direct:10.3f}  {seconds:10.3f}  "
+                f"{direct / seconds:7.1f}  {np.median(error):8.1e}  "
+                f"{np.quantile(error, 0.99):8.1e}"
+            )
+
+    # Rebuilding the tree after a small step reuses the previous order
+    n_bodies = 20_000
+    R = plummer(n_bodies)
+    masses = np.full(n_bodies, 1 / n_bodies)
+    tree = Octree()
+    tree.build(R, masses)
+    fresh = tree.stats["build_seconds"]
+    R += rng.normal(0, 1e-3, R.shape)
+    tree.build(R, masses)
+    rebuild = tree.stats["build_seconds"] - fresh
+    print(
+        f"Building the tree of {n_bodies} bodies: {fresh:.3f} s, "
+        f"rebuilding it after a step: {rebuild:.3f} s"
+    )
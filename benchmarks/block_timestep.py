@@ -0,0 +1,234 @@
+"""Integrate N bodies with individual block time steps.
+
+With one adaptive step for the whole system, as in ``solve_ivp``, a single close
+encounter forces tiny steps on every body. Here each body has its own step, a power
+of two fraction of ``dt_max``, and only the bodies whose steps end at the next
+block time are advanced, with the fourth order Hermite predictor-corrector scheme
+of Makino and Aarseth (1992). At each block time, the positions and velocities
+of all bodies are predicted from their last accelerations and jerks, and the
+forces on the active bodies are computed from the predicted positions, so the cost
+of a block step grows with the number of active bodies rather than with N.
+
+The step of each body is chosen with the Aarseth criterion from its acceleration
+and derivatives. A step may be halved as often as needed, but only doubled when the
+doubled step stays aligned with the block times.
+
+With ``block=False`` all bodies share the smallest step, which is the global-step
+baseline. Run this file to compare the two on a cluster with a tight binary.
+"""
+
+import time
+from typing import Any
+
+import numpy as np
+
+from .n_body import BLOCK_PAIRS, G
+
+# Accuracy parameter of the Aarseth time step criterion
+ETA = 0.02
+# Accuracy parameter of the first step, from the acceleration and jerk only
+ETA_START = 0.01
+# Smallest step allowed, as a power of two fraction of dt_max
+MAX_LEVEL = 40
+
+
+def acceleration_jerk(
+    R: np.ndarray,
+    V: np.ndarray,
+    masses: np.ndarray,
+    targets: np.ndarray,
+    G: float = G,
+    softening: float = 0.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the acceleration and its time derivative, the jerk, of the bodies
+    ``targets`` from all the bodies with positions ``R`` and velocities ``V``.
+    """
+    coordinates = np.ascontiguousarray(R.T)
+    velocities = np.ascontiguousarray(V.T)
+    n_bodies = len(R)
+    a = np.empty((3, targets.size))
+    jerk = np.empty((3, targets.size))
+    size = max(1, BLOCK_PAIRS // n_bodies)
+    for start in range(0, targets.size, size):
+        rows = targets[start : start + size]
+        block = slice(start, start + rows.size)
+        dR = coordinates[:, None, :] - coordinates[:, rows, None]
+        dV = velocities[:, None, :] - velocities[:, rows, None]
+        r_sq = dR[0] * dR[0] + dR[1] * dR[1] + dR[2] * dR[2] + softening**2
+        r_sq[np.arange(rows.size), rows] = np.inf
+        rv = dR[0] * dV[0] + dR[1] * dV[1] + dR[2] * dV[2]
+        rv *= 3 / r_sq
+        weights = masses / (r_sq * np.sqrt(r_sq))
+        rv *= weights
+        for k in range(3):
+            a[k, block] = np.einsum("tn,tn->t", weights, dR[k])
+            jerk[k, block] = np.einsum("tn,tn->t", weights, dV[k]) - np.einsum(
+                "tn,tn->t", rv, dR[k]
+            )
+    return G * a.T, G * jerk.T
+
+
+def norm(x: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.einsum("ij,ij->i", x, x))
+
+
+def aarseth_step(
+    a: np.ndarray, jerk: np.ndarray, snap: np.ndarray, crackle: np.ndarray
+) -> np.ndarray:
+    """Return the step of each body from its acceleration and derivatives."""
+    a_n, j_n, s_n, c_n = norm(a), norm(jerk), norm(snap), norm(crackle)
+    return np.sqrt(ETA * (a_n * s_n + j_n**2) / (j_n * c_n + s_n**2))
+
+
+def quantize(
+    dt_new: np.ndarray, dt: np.ndarray, t: np.ndarray, dt_max: float
+) -> np.ndarray:
+    """Return the block step closest to ``dt_new`` that is allowed for bodies with
+    current step ``dt`` at time ``t``.
+
+    The step is halved until it is no longer than ``dt_new``, or doubled once if
+    ``dt_new`` allows it and ``t`` is a multiple of the doubled step.
+    """
+    with np.errstate(divide="ignore"):
+        halvings = np.ceil(np.log2(dt / dt_new)).clip(min=0)
+    quantized = dt / 2.0**halvings
+    double = (dt_new >= 2 * dt) & (np.fmod(t, 2 * dt) == 0) & (2 * dt <= dt_max)
+    quantized[double] = 2 * dt[double]
+    if np.any(quantized < dt_max / 2.0**MAX_LEVEL):
+        raise RuntimeError("The step of a body became too small")
+    return quantized
+
+
+def hermite(
+    y_0: np.ndarray,
+    masses: np.ndarray,
+    t_end: float,
+    dt_max: float | None = None,
+    G: float = G,
+    softening: float = 0.0,
+    block: bool = True,
+) -> tuple[np.ndarray, dict[str, Any]]:
+    """Integrate the state ``y_0`` from 0 to ``t_end`` and return the final state.
+
+    The state vector is in the same order as for ``n_body.n_body_rhs``. The
+    largest step is ``dt_max``, rounded down so that ``t_end`` is a power of two
+    multiple of it, and defaults to ``t_end / 8``. With ``block=False`` every body
+    takes the smallest of the steps. Also returns the number of block steps, the
+    number of steps of single bodies, and the wall time.
+    """
+    start_time = time.perf_counter()
+    masses = np.asarray(masses, dtype=float)
+    n_bodies = len(masses)
+    R = np.array(y_0[: 3 * n_bodies], dtype=float).reshape(n_bodies, 3)
+    V = np.array(y_0[3 * n_bodies :], dtype=float).reshape(n_bodies, 3)
+    if dt_max is None:
+        dt_max = t_end / 8
+    dt_max = t_end / 2.0 ** np.ceil(np.log2(t_end / dt_max))
+
+    everyone = np.arange(n_bodies)
+    a, jerk = acceleration_jerk(R, V, masses, everyone, G, softening)
+    t = np.zeros(n_bodies)
+    dt = quantize(
+        ETA_START * norm(a) / norm(jerk), np.full(n_bodies, dt_max), t, dt_max
+    )
+    if not block:
+        dt[:] = dt.min()
+    stats = {"block_steps": 0, "body_steps": 0}
+    while True:
+        t_next = np.min(t + dt)
+        if t_next > t_end:
+            break
+        active = everyone if not block else np.flatnonzero(t + dt == t_next)
+
+        # Predict every body to the block time from its last derivatives
+        h = (t_next - t)[:, None]
+        R_p = R + h * (V + h * (a / 2 + h * jerk / 6))
+        V_p = V + h * (a + h * jerk / 2)
+        a_1, jerk_1 = acceleration_jerk(R_p, V_p, masses, active, G, softening)
+
+        # Correct the active bodies
+        h = dt[active][:, None]
+        a_0, jerk_0 = a[active], jerk[active]
+        V_1 = V[active] + h / 2 * (a_0 + a_1) + h**2 / 12 * (jerk_0 - jerk_1)
+        R_1 = R[active] + h / 2 * (V[active] + V_1) + h**2 / 12 * (a_0 - a_1)
+        snap = (-6 * (a_0 - a_1) - h * (4 * jerk_0 + 2 * jerk_1)) / h**2
+        crackle = (12 * (a_0 - a_1) + 6 * h * (jerk_0 + jerk_1)) / h**3
+        snap += h * crackle
+        R[active], V[active] = R_1, V_1
+        a[active], jerk[active] = a_1, jerk_1
+        t[active] = t_next
+
+        dt_new = aarseth_step(a_1, jerk_1, snap, crackle)
+        if block:
+            dt[active] = quantize(dt_new, dt[active], t[active], dt_max)
+        else:
+            dt[:] = quantize(np.array([dt_new.min()]), dt[:1], t[:1], dt_max)[0]
+        stats["block_steps"] += 1
+        stats["body_steps"] += active.size
+    stats["seconds"] = time.perf_counter() - start_time
+    return np.hstack((R.ravel(), V.ravel())), stats
+
+
+if __name__ == "__main__":
+    from scipy.integrate import solve_ivp
+
+    from .n_body import n_body_rhs, total_energy
+
+    # A cluster of bodies spread through a sphere with a tight binary at its
+    # center, in units with G = 1
+    rng = np.random.default_rng(0)
+    n_cluster = 254
+    direction = rng.normal(size=(n_cluster, 3))
+    direction /= norm(direction)[:, None]
+    R = direction * rng.uniform(0.1, 1, (n_cluster, 1)) ** (1 / 3)
+    V = rng.normal(0, 0.2, (n_cluster, 3))
+    masses = np.full(n_cluster + 2, 1 / (n_cluster + 2))
+    separation = 1e-3
+    speed = np.sqrt(2 * masses[0] / separation) / 2
+    R = np.vstack((R, (separation / 2, 0, 0), (-separation / 2, 0, 0)))
+    V = np.vstack((V, (0, speed, 0), (0, -speed, 0)))
+    y_0 = np.hstack((R.ravel(), V.ravel()))
+    t_end = 1 / 32
+    E_0 = total_energy(y_0, masses, 1.0)
+
+    print(
+        f"{n_cluster} bodies and a binary with a period of about "
+        f"{2 * np.pi * np.sqrt(separation**3 / (2 * masses[0])):.1e}, to t = {t_end}"
+    )
+    print(
+        "                block steps  body steps  force pairs  wall (s)  energy error"
+    )
+    results = {}
+    for name, block in (("global step", False), ("block steps", True)):
+        y, stats = hermite(y_0, masses, t_end, G=1.0, block=block)
+        results[name] = y
+        error = abs(total_energy(y, masses, 1.0) / E_0 - 1)
+        print(
+            f"{name:14s} {stats['block_steps']:12d} {stats['body_steps']:11d} "
+            f"{stats['body_steps'] * len(masses):12.2e} {stats['seconds']:9.2f} "
+            f"{error:13.1e}"
+        )
+
+    start = time.perf_counter()
+    sol = solve_ivp(
+        n_body_rhs,
+        (0, t_end),
+        y_0,
+        method="DOP853",
+        rtol=1e-10,
+        atol=1e-12,
+        args=(masses, 1.0),
+    )
+    seconds = time.perf_counter() - start
+    error = abs(total_energy(sol.y[:, -1], masses, 1.0) / E_0 - 1)
+    print(
+        f"{'solve_ivp':14s} {sol.t.size - 1:12d} {(sol.t.size - 1) * len(masses):11d} "
+        f"{sol.nfev * len(masses) ** 2:12.2e} {seconds:9.2f} {error:13.1e}"
+    )
+    difference = np.max(
+        np.abs(results["block steps"] - sol.y[:, -1])[: 3 * len(masses)]
+    )
+    print(
+        f"Largest difference in position between block steps and solve_ivp: "
+        f"{difference:.1e}"
+    )
@@ -0,0 +1,296 @@
+"""Perturbed two-body propagation with Encke's method.
+
+When a small perturbing acceleration is added to ``relative_motion`` and the sum
+is integrated, which is Cowell's method, the solver still has to resolve the
+Keplerian motion, and its steps are set by the orbit rather than by the
+perturbation. Encke's method integrates only the deviation ``delta`` of the true
+position ``r`` from an osculating reference orbit ``rho``, which is propagated
+analytically with the universal Kepler equation. The deviation changes slowly
+when the perturbation is small, so the solver can take long steps. Its
+acceleration is computed with the function ``f(q)`` of Battin (1999), which avoids
+the cancellation in the difference of the two gravitational accelerations,
+
+    delta'' = -mu / rho**3 * (delta + f(q) * r) + P,
+
+where ``q = delta . (delta - 2 r) / r**2`` and ``f(q) = (1 + q)**1.5 - 1``.
+
+When the deviation grows larger than a fraction ``rectify`` of the distance, the
+reference orbit is rectified: it is replaced by the osculating orbit of the true
+state, and the deviation starts again from zero.
+
+``solve_encke`` is used like ``solve_ivp`` with the Cartesian state, and
+``perturbation(t, y, *args)`` returns the perturbing acceleration for the
+Cartesian state ``y``, as for ``kustaanheimo_stiefel.solve_ks``.
+
+Run this file to compare the number of evaluations with Cowell's method at the
+same tolerances and at the same error, for perturbations the size of J2 and of
+atmospheric drag.
+"""
+
+from collections.abc import Callable, Sequence
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+
+from .jit import njit, solve_universal_kepler, stumpff_2, stumpff_3
+
+# Default largest deviation from the reference orbit, relative to the distance,
+# before the reference orbit is rectified
+RECTIFY = 1e-2
+
+
+@njit(cache=True)
+def kepler(r_0, v_0, delta_t, mu):
+    """Return the position and velocity ``delta_t`` after ``r_0`` and ``v_0`` on a
+    two-body orbit, from the universal Lagrange coefficients.
+    """
+    r_0_mag = np.sqrt(r_0[0] ** 2 + r_0[1] ** 2 + r_0[2] ** 2)
+    v_r0 = (r_0[0] * v_0[0] + r_0[1] * v_0[1] + r_0[2] * v_0[2]) / r_0_mag
+    alpha = 2 / r_0_mag - (v_0[0] ** 2 + v_0[1] ** 2 + v_0[2] ** 2) / mu
+    chi = solve_universal_kepler(r_0_mag, v_r0, alpha, delta_t, mu)
+    z = alpha * chi**2
+    C, S = stumpff_2(z), stumpff_3(z)
+    f = 1 - chi**2 / r_0_mag * C
+    g = delta_t - chi**3 * S / np.sqrt(mu)
+    r = f * r_0 + g * v_0
+    r_mag = np.sqrt(r[0] ** 2 + r[1] ** 2 + r[2] ** 2)
+    fdot = np.sqrt(mu) / (r_mag * r_0_mag) * (alpha * chi**3 * S - chi)
+    gdot = 1 - chi**2 / r_mag * C
+    return r, fdot * r_0 + gdot * v_0
+
+
+@njit(cache=True)
+def battin_f(q):
+    """Return ``(1 + q)**1.5 - 1`` without cancellation for small ``q``."""
+    return q * (3 + 3 * q + q * q) / (1 + (1 + q) ** 1.5)
+
+
+@njit(cache=True)
+def deviation(t, delta, epoch, reference, mu):
+    """Return the true state and the derivative of the deviation ``delta`` without
+    the perturbation, from the two-body orbit that passes through the state
+    ``reference`` at ``epoch``.
+    """
+    rho, rho_dot = kepler(reference[:3], reference[3:], t - epoch, mu)
+    y = np.empty(6)
+    y[:3] = rho + delta[:3]
+    y[3:] = rho_dot + delta[3:]
+    r_sq = y[0] ** 2 + y[1] ** 2 + y[2] ** 2
+    q = 0.0
+    for i in range(3):
+        q += delta[i] * (delta[i] - 2 * y[i])
+    q /= r_sq
+    rho_mag = np.sqrt(rho[0] ** 2 + rho[1] ** 2 + rho[2] ** 2)
+    k = -mu / rho_mag**3
+    f_q = battin_f(q)
+    delta_dot = np.empty(6)
+    for i in range(3):
+        delta_dot[i] = delta[i + 3]
+        delta_dot[i + 3] = k * (delta[i] + f_q * y[i])
+    return y, delta_dot
+
+
+def encke_rhs(
+    t: float,
+    delta: np.ndarray,
+    epoch: float,
+    reference: np.ndarray,
+    mu: float,
+    perturbation: Callable[..., np.ndarray],
+    args: tuple,
+) -> np.ndarray:
+    """Return the derivative of the deviation ``delta`` from the two-body orbit
+    that passes through the state ``reference`` at ``epoch``.
+    """
+    y, delta_dot = deviation(t, delta, epoch, reference, mu)
+    delta_dot[3:] += perturbation(t, y, *args)
+    return delta_dot
+
+
+def solve_encke(
+    mu: float,
+    t_span: Sequence[float],
+    y0: np.ndarray,
+    perturbation: Callable[..., np.ndarray],
+    t_eval: np.ndarray | None = None,
+    args: tuple = (),
+    rectify: float = RECTIFY,
+    method: str = "DOP853",
+    rtol: float = 1e-3,
+    atol: float | np.ndarray = 1e-6,
+    **options,
+) -> OptimizeResult:
+    """Solve the perturbed two-body problem for the Cartesian state ``y0`` with
+    Encke's method.
+
+    ``rtol`` and ``atol`` have the defaults of ``solve_ivp`` and apply to the
+    deviation. The deviation is much smaller than the state, so the relative
+    tolerance adds little, and the error is mostly set by ``atol``, which is the
+    absolute error allowed per step in the position and velocity, as in Cowell's
+    method with the same ``atol``. Other options are passed to ``solve_ivp``. The
+    result has the physical times ``t`` and Cartesian states ``y`` at ``t_eval``,
+    or at the steps of the solver if ``t_eval`` is None, together with ``nfev``,
+    the number of steps ``n_steps``, and the number of times the reference orbit
+    was rectified, ``rectifications``.
+    """
+    t_0, t_end = map(float, t_span)
+    if t_end <= t_0:
+        raise ValueError("t_span must be increasing")
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype=float)
+    epoch = t_0
+    reference = np.array(y0, dtype=float)
+
+    def too_far(t, delta, epoch, reference, mu, perturbation, args):
+        rho, _ = kepler(reference[:3], reference[3:], t - epoch, mu)
+        return np.sqrt(delta[:3] @ delta[:3]) - rectify * np.sqrt(rho @ rho)
+
+    too_far.terminal = True
+
+    times, states = [], []
+    stats = {"nfev": 0, "n_steps": 0, "rectifications": 0}
+    while True:
+        sol = solve_ivp(
+            encke_rhs,
+            (epoch, t_end),
+            np.zeros(6),
+            method=method,
+            dense_output=True,
+            events=too_far,
+            args=(epoch, reference, mu, perturbation, args),
+            rtol=rtol,
+            atol=atol,
+            **options,
+        )
+        if not sol.success:
+            raise RuntimeError(sol.message)
+        stats["nfev"] += sol.nfev
+        stats["n_steps"] += sol.t.size - 1
+        if t_eval is None:
+            # The first step is the last step of the previous segment
+            segment_t = sol.t if not times else sol.t[1:]
+        else:
+            segment_t = t_eval[(t_eval >= epoch) & (t_eval < sol.t[-1])]
+            if sol.status == 0:
+                segment_t = t_eval[t_eval >= epoch]
+        deltas = sol.sol(segment_t) if segment_t.size else np.empty((6, 0))
+        for t, delta in zip(segment_t, deltas.T, strict=True):
+            rho, rho_dot = kepler(reference[:3], reference[3:], t - epoch, mu)
+            times.append(t)
+            states.append(np.concatenate((rho, rho_dot)) + delta)
+        if sol.status == 0:
+            break
+        # Rectify, with the osculating orbit of the true state as the new reference
+        t_r, delta = sol.t_events[0][0], sol.y_events[0][0]
+        rho, rho_dot = kepler(reference[:3], reference[3:], t_r - epoch, mu)
+        reference = np.concatenate((rho, rho_dot)) + delta
+        epoch = t_r
+        stats["rectifications"] += 1
+    return OptimizeResult(
+        t=np.array(times),
+        y=np.array(states).T,
+        status=0,
+        message="The solver successfully reached the end of the integration interval.",
+        success=True,
+        **stats,
+    )
+
+
+if __name__ == "__main__":
+    import time
+
+    from .jit import relative_motion
+
+    mu = 3.986e5  # km**3/s**2
+    R_E = 6378.0  # km
+    J_2 = 1.08263e-3
+    omega_E = 7.2921159e-5  # rad/s
+    # An exponential atmosphere fit near 400 km, and a ballistic coefficient of
+    # C_D * A / m = 0.02 m**2/kg in km**2/kg
+    rho_0, h_0, H = 3.7e-3, 400.0, 59.0  # kg/km**3, km, km
+    ballistic = 2e-8
+
+    def j2(t, y):
+        x, y_, z = y[:3]
+        r_sq = x * x + y_ * y_ + z * z
+        factor = 1.5 * J_2 * mu * R_E**2 / r_sq**2.5
+        k = 5 * z * z / r_sq
+        return factor * np.array((x * (k - 1), y_ * (k - 1), z * (k - 3)))
+
+    def drag(t, y):
+        r = np.sqrt(y[:3] @ y[:3])
+        v_rel = y[3:] - np.cross((0, 0, omega_E), y[:3])
+        density = rho_0 * np.exp(-(r - R_E - h_0) / H)
+        return -0.5 * density * ballistic * np.sqrt(v_rel @ v_rel) * v_rel
+
+    def cowell(t, y, perturbation):
+        return relative_motion(t, y, mu) + np.concatenate(
+            (np.zeros(3), perturbation(t, y))
+        )
+
+    # A 400 km orbit inclined by 51.6 degrees, for one day
+    r_0 = R_E + 400.0
+    v_0 = np.sqrt(mu / r_0)
+    inclination = np.radians(51.6)
+    y_0 = np.array((r_0, 0, 0, 0, v_0 * np.cos(inclination), v_0 * np.sin(inclination)))
+    t_end = 86_400.0
+    t_eval = np.linspace(0, t_end, 25)
+    # Compile the functions before anything is timed
+    solve_encke(mu, (0, 60.0), y_0, j2)
+    print("400 km orbit for one day, with rtol = atol = tol")
+    print(
+        "                     steps    nfev  rectified  wall (s)  error (km)  "
+        "Cowell nfev at the same error"
+    )
+    for name, perturbation in (("J2", j2), ("drag", drag)):
+        reference = solve_ivp(
+            cowell,
+            (0, t_end),
+            y_0,
+            method="DOP853",
+            t_eval=t_eval,
+            rtol=1e-13,
+            atol=1e-11,
+            args=(perturbation,),
+        )
+        size = np.linalg.norm(perturbation(0, y_0)) / (mu / r_0**2)
+        print(f"{name}, {size:.0e} of the central gravity")
+        cowell_nfev, cowell_error = [], []
+        for tol in (1e-6, 1e-7, 1e-8, 1e-9, 1e-10, 1e-11, 1e-12):
+            start = time.perf_counter()
+            sol = solve_ivp(
+                cowell,
+                (0, t_end),
+                y_0,
+                method="DOP853",
+                rtol=tol,
+                atol=tol,
+                args=(perturbation,),
+                dense_output=True,
+            )
+            seconds = time.perf_counter() - start
+            error = np.max(np.abs(sol.sol(t_eval)[:3] - reference.y[:3]))
+            cowell_nfev.append(sol.nfev)
+            cowell_error.append(error)
+            print(
+                f"  Cowell, tol {tol:.0e} {sol.t.size - 1:6d} {sol.nfev:7d} "
+                f"{'':10s} {seconds:9.2f} {error:11.1e}"
+            )
+        for tol in (1e-8, 1e-10, 1e-12):
+            start = time.perf_counter()
+            sol = solve_encke(
+                mu, (0, t_end), y_0, perturbation, t_eval, rtol=tol, atol=tol
+            )
+            seconds = time.perf_counter() - start
+            error = np.max(np.abs(sol.y[:3] - reference.y[:3]))
+            # The number of evaluations Cowell's method needs for the same error,
+            # interpolated between the tolerances above
+            matched = np.exp(
+                np.interp(-np.log(error), -np.log(cowell_error), np.log(cowell_nfev))
+            )
+            print(
+                f"  Encke, tol {tol:.0e}  {sol.n_steps:6d} {sol.nfev:7d} "
+                f"{sol.rectifications:10d} {seconds:9.2f} {error:11.1e} "
+                f"{matched:12.0f}"
+            )
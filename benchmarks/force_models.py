@@ -0,0 +1,364 @@
+"""Composable force models for Cowell propagation.
+
+``relative_motion`` has only the gravity of a point mass, and
+``nonimpulsive_maneuver`` adds a thrust along the velocity. ``ForceModels``
+collects any number of accelerations instead, each registered under a name with
+its parameters, and sums them with the point mass gravity of the central body::
+
+    forces = ForceModels(MU_EARTH)
+    forces.add("zonal", zonal, MU_EARTH, R_EARTH, J_2, J_3)
+    forces.add("drag", exponential_drag, R_EARTH, 3.7e-3, 400.0, 59.0, 2e-8)
+    sol = solve_ivp(forces.rhs, [t_0, t_f], Y_0, vectorized=True)
+
+Every model is called once per evaluation for all of the states, with the
+positions and velocities as ``(3, M)`` arrays, the layout of ``vectorized=True``
+in ``solve_ivp``, and returns the ``(3, M)`` accelerations. Models have the
+signature ``model(t, R, V, m, *params)``, where ``m`` is the mass of each
+state, or None without a mass state. A model registered with a ``mass_rate``,
+such as a thrust law, adds the mass as the seventh state, as in
+``nonimpulsive_maneuver``. The number of calls, the number of states, and the
+time spent in each model are counted in ``stats``, so the expensive terms are
+visible.
+
+``ForceModels.perturbation`` returns the sum of the registered models without the
+central gravity, for ``encke.solve_encke`` and ``kustaanheimo_stiefel.solve_ks``.
+
+Run this file to time each model and to compare the regression of the nodes with
+the J2 theory of the notes.
+"""
+
+import time
+from collections.abc import Callable
+from typing import Any
+
+import numpy as np
+
+MU_EARTH = 3.986004418e5  # km**3/s**2
+R_EARTH = 6378.137  # km
+J_2 = 1.08263e-3
+J_3 = -2.5327e-6
+OMEGA_EARTH = 7.292115e-5  # rad/s
+MU_SUN = 1.32712440018e11  # km**3/s**2
+MU_MOON = 4.9028e3  # km**3/s**2
+AU = 1.495978707e8  # km
+# Mean distance and sidereal period of the Moon, and the inclination of its orbit
+# and of the ecliptic to the equator
+MOON_DISTANCE = 384_400.0  # km
+MOON_PERIOD = 27.321661 * 86_400  # s
+MOON_INCLINATION = np.radians(28.58)
+YEAR = 365.256363 * 86_400  # s
+OBLIQUITY = np.radians(23.439)
+
+
+def squared_norm(X: np.ndarray) -> np.ndarray:
+    """Return the squared length of the vectors ``X``, of shape ``(3, ...)``."""
+    return X[0] * X[0] + X[1] * X[1] + X[2] * X[2]
+
+
+def point_mass(
+    t: float, R: np.ndarray, V: np.ndarray, m: np.ndarray | None, mu: float
+) -> np.ndarray:
+    """Return the gravity of a point mass at the origin."""
+    r_sq = squared_norm(R)
+    return -mu * R / (r_sq * np.sqrt(r_sq))
+
+
+def zonal(
+    t: float,
+    R: np.ndarray,
+    V: np.ndarray,
+    m: np.ndarray | None,
+    mu: float,
+    R_E: float,
+    J_2: float,
+    J_3: float = 0.0,
+) -> np.ndarray:
+    """Return the acceleration from the J2 and J3 zonal harmonics of the central
+    body, whose equatorial radius is ``R_E``.
+    """
+    x, y, z = R
+    r_sq = x * x + y * y + z * z
+    z_sq = z * z / r_sq
+    k_2 = 1.5 * J_2 * mu * R_E**2 / (r_sq * r_sq * np.sqrt(r_sq))
+    a = np.empty_like(R, dtype=float)
+    a[0] = k_2 * x * (5 * z_sq - 1)
+    a[1] = k_2 * y * (5 * z_sq - 1)
+    a[2] = k_2 * z * (5 * z_sq - 3)
+    if J_3:
+        k_3 = 2.5 * J_3 * mu * R_E**3 / (r_sq**3 * np.sqrt(r_sq))
+        common = k_3 * (7 * z * z_sq - 3 * z)
+        a[0] += common * x
+        a[1] += common * y
+        a[2] += k_3 * (7 * z * z * z_sq - 6 * z * z + 0.6 * r_sq)
+    return a
+
+
+def exponential_drag(
+    t: float,
+    R: np.ndarray,
+    V: np.ndarray,
+    m: np.ndarray | None,
+    R_E: float,
+    rho_0: float,
+    h_0: float,
+    H: float,
+    ballistic: float,
+    omega: float = OMEGA_EARTH,
+) -> np.ndarray:
+    """Return the drag in an exponential atmosphere that rotates with the central
+    body.
+
+    The density is ``rho_0`` in kg/km**3 at the altitude ``h_0`` and falls with the
+    scale height ``H``. ``ballistic`` is ``C_D * A / m`` in km**2/kg.
+    """
+    r = np.sqrt(squared_norm(R))
+    V_rel = V.astype(float)
+    V_rel[0] += omega * R[1]
+    V_rel[1] -= omega * R[0]
+    speed = np.sqrt(squared_norm(V_rel))
+    density = rho_0 * np.exp(-(r - R_E - h_0) / H)
+    return -0.5 * ballistic * density * speed * V_rel
+
+
+def circular_ephemeris(
+    radius: float, period: float, inclination: float, phase: float = 0.0
+) -> Callable[[float], np.ndarray]:
+    """Return a function of time that gives the position of a body on a circular
+    orbit, with its ascending node on the x axis.
+    """
+
+    def position(t: float | np.ndarray) -> np.ndarray:
+        angle = 2 * np.pi * np.asarray(t) / period + phase
+        return radius * np.array(
+            (
+                np.cos(angle),
+                np.sin(angle) * np.cos(inclination),
+                np.sin(angle) * np.sin(inclination),
+            )
+        )
+
+    return position
+
+
+SUN = circular_ephemeris(AU, YEAR, OBLIQUITY)
+MOON = circular_ephemeris(MOON_DISTANCE, MOON_PERIOD, MOON_INCLINATION)
+
+
+def third_body(
+    t: float,
+    R: np.ndarray,
+    V: np.ndarray,
+    m: np.ndarray | None,
+    mu_3: float,
+    ephemeris: Callable[[float], np.ndarray],
+) -> np.ndarray:
+    """Return the perturbation from a third body, whose position relative to the
+    central body is ``ephemeris(t)``.
+
+    The acceleration of the central body towards the third body is subtracted,
+    since the states are relative to the central body.
+    """
+    S = ephemeris(t).reshape(3, *(1,) * (R.ndim - 1))
+    D = S - R
+    d_sq = squared_norm(D)
+    s_sq = squared_norm(S)
+    return mu_3 * (D / (d_sq * np.sqrt(d_sq)) - S / (s_sq * np.sqrt(s_sq)))
+
+
+def tangential_thrust(
+    t: float, R: np.ndarray, V: np.ndarray, m: np.ndarray | None, T: float
+) -> np.ndarray:
+    """Return the acceleration of a thrust ``T`` along the velocity, as in
+    ``nonimpulsive_maneuver``. A negative thrust is opposite the velocity.
+    """
+    speed = np.sqrt(squared_norm(V))
+    return T * V / (m * speed)
+
+
+def fixed_thrust(
+    t: float,
+    R: np.ndarray,
+    V: np.ndarray,
+    m: np.ndarray | None,
+    T: float,
+    direction: np.ndarray,
+) -> np.ndarray:
+    """Return the acceleration of a thrust ``T`` in a fixed inertial
+    ``direction``.
+    """
+    direction = np.asarray(direction, dtype=float)
+    direction = direction / np.linalg.norm(direction)
+    return T * direction.reshape(3, *(1,) * (R.ndim - 1)) / m
+
+
+def rocket_mass_rate(T: float, I_sp: float, g_0: float = 9.807e-3) -> float:
+    """Return the rate of change of the mass of a rocket with thrust ``T`` in kN
+    and specific impulse ``I_sp`` in s, with ``g_0`` in km/s**2.
+    """
+    return -abs(T) / (I_sp * g_0)
+
+
+class ForceModels:
+    """The sum of the gravity of a central body with parameter ``mu`` and any
+    number of registered force models.
+    """
+
+    def __init__(self, mu: float) -> None:
+        self.mu = mu
+        self.models: dict[str, tuple[Callable[..., np.ndarray], tuple, float]] = {}
+        self.stats: dict[str, dict[str, Any]] = {}
+        self.reset_stats()
+
+    def add(
+        self,
+        name: str,
+        model: Callable[..., np.ndarray],
+        *params: Any,
+        mass_rate: float = 0.0,
+    ) -> None:
+        """Register ``model`` with its ``params`` under ``name``.
+
+        ``mass_rate`` is the rate of change of the mass caused by the model, in
+        kg/s. If any model changes the mass, the state has the mass after the
+        velocity.
+        """
+        if name == "central" or name in self.models:
+            raise ValueError(f"A model named {name!r} is already registered")
+        self.models[name] = (model, params, mass_rate)
+        self.stats[name] = {"calls": 0, "states": 0, "seconds": 0.0}
+
+    def remove(self, name: str) -> None:
+        del self.models[name]
+        del self.stats[name]
+
+    def reset_stats(self) -> None:
+        for name in ("central", *self.models):
+            self.stats[name] = {"calls": 0, "states": 0, "seconds": 0.0}
+
+    @property
+    def has_mass(self) -> bool:
+        return any(mass_rate for _, _, mass_rate in self.models.values())
+
+    def evaluate(
+        self, name: str, model: Callable, t: float, Y: np.ndarray, params: tuple
+    ) -> np.ndarray:
+        """Call one model and count its time."""
+        m = Y[6] if Y.shape[0] > 6 else None
+        start = time.perf_counter()
+        a = model(t, Y[:3], Y[3:6], m, *params)
+        stats = self.stats[name]
+        stats["seconds"] += time.perf_counter() - start
+        stats["calls"] += 1
+        stats["states"] += 1 if Y.ndim == 1 else Y.shape[1]
+        return a
+
+    def perturbation(self, t: float, Y: np.ndarray) -> np.ndarray:
+        """Return the sum of the registered models, without the central gravity,
+        for the states ``Y`` of shape ``(6, ...)`` or ``(7, ...)``.
+        """
+        a = np.zeros(Y[:3].shape)
+        for name, (model, params, _) in self.models.items():
+            a += self.evaluate(name, model, t, Y, params)
+        return a
+
+    def accelerations(self, t: float, Y: np.ndarray) -> np.ndarray:
+        """Return the total acceleration of the states ``Y``."""
+        a = self.evaluate("central", point_mass, t, Y, (self.mu,))
+        return a + self.perturbation(t, Y)
+
+    def rhs(self, t: float, Y: np.ndarray) -> np.ndarray:
+        """Return the derivative of the states ``Y``, with shape ``(n,)`` or
+        ``(n, k)``, for ``solve_ivp`` with or without ``vectorized=True``.
+        """
+        Y = np.asarray(Y, dtype=float)
+        Ydot = np.empty_like(Y)
+        Ydot[:3] = Y[3:6]
+        Ydot[3:6] = self.accelerations(t, Y)
+        if Y.shape[0] > 6:
+            Ydot[6] = sum(mass_rate for _, _, mass_rate in self.models.values())
+        return Ydot
+
+    def report(self) -> str:
+        """Return a table of the time spent in each model."""
+        total = sum(stats["seconds"] for stats in self.stats.values()) or 1.0
+        lines = ["model           calls      states  seconds  ns/state  share"]
+        for name, stats in sorted(
+            self.stats.items(), key=lambda item: -item[1]["seconds"]
+        ):
+            per_state = stats["seconds"] / max(stats["states"], 1) * 1e9
+            lines.append(
+                f"{name:12s} {stats['calls']:8d} {stats['states']:11d} "
+                f"{stats['seconds']:8.3f} {per_state:9.1f} "
+                f"{stats['seconds'] / total:6.1%}"
+            )
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from scipy.integrate import solve_ivp
+
+    from .jit import nonimpulsive_maneuver
+
+    # A 400 km orbit inclined by 51.6 degrees with every model
+    r_0 = R_EARTH + 400.0
+    v_0 = np.sqrt(MU_EARTH / r_0)
+    inclination = np.radians(51.6)
+    Y_0 = np.array((r_0, 0, 0, 0, v_0 * np.cos(inclination), v_0 * np.sin(inclination)))
+    forces = ForceModels(MU_EARTH)
+    forces.add("zonal", zonal, MU_EARTH, R_EARTH, J_2, J_3)
+    forces.add("drag", exponential_drag, R_EARTH, 3.7e-3, 400.0, 59.0, 2e-8)
+    forces.add("sun", third_body, MU_SUN, SUN)
+    forces.add("moon", third_body, MU_MOON, MOON)
+
+    print("Size of each acceleration at the start, relative to the central gravity")
+    g = np.linalg.norm(point_mass(0, Y_0[:3], Y_0[3:], None, MU_EARTH))
+    for name, (model, params, _) in forces.models.items():
+        a = model(0.0, Y_0[:3], Y_0[3:], None, *params)
+        print(f"  {name:6s} {np.linalg.norm(a) / g:.1e}")
+
+    # The regression of the nodes over three days, against the secular rate of
+    # the notes
+    t_end = 3 * 86_400
+    sol = solve_ivp(
+        forces.rhs,
+        (0, t_end),
+        Y_0,
+        method="DOP853",
+        rtol=1e-10,
+        atol=1e-10,
+        t_eval=np.linspace(0, t_end, 2001),
+    )
+    h = np.cross(sol.y[:3].T, sol.y[3:].T)
+    node = np.unwrap(np.arctan2(h[:, 0], -h[:, 1]))
+    rate = np.polyfit(sol.t, node, 1)[0]
+    a = r_0
+    theory = -1.5 * np.sqrt(MU_EARTH) * J_2 * R_EARTH**2 / a**3.5 * np.cos(inclination)
+    print(
+        f"Regression of the nodes: {np.degrees(rate) * 86_400:.3f} deg/day "
+        f"integrated, {np.degrees(theory) * 86_400:.3f} deg/day from J2 theory"
+    )
+    print(f"Time in each model for {sol.nfev} evaluations of one state")
+    print(forces.report())
+
+    # One call for a batch of states
+    forces.reset_stats()
+    rng = np.random.default_rng(0)
+    n_states = 100_000
+    Y = Y_0[:, None] * rng.uniform(0.95, 1.05, (6, n_states))
+    for _ in range(10):
+        forces.rhs(0.0, Y)
+    print(f"Time in each model for 10 evaluations of {n_states} states")
+    print(forces.report())
+
+    # The thrust law and mass of nonimpulsive_maneuver
+    T, I_sp = 2.5e-3, 10_000
+    thrust = ForceModels(3.986e5)
+    thrust.add("thrust", tangential_thrust, T, mass_rate=rocket_mass_rate(T, I_sp))
+    Y = np.array((6678.0, 0, 0, 0, 7.726, 0, 1000))
+    difference = np.max(
+        np.abs(
+            thrust.rhs(0.0, Y)
+            - nonimpulsive_maneuver(0.0, Y, 3.986e5, T, I_sp, 9.807e-3, 42_164)
+        )
+    )
+    print(f"Largest difference from nonimpulsive_maneuver: {difference:.1e}")
@@ -0,0 +1,198 @@
+"""Analytic Jacobians of the equations of motion for implicit solvers.
+
+The implicit methods of ``solve_ivp``, ``Radau``, ``BDF``, and ``LSODA``, need the
+Jacobian of the right-hand side with respect to the state. When ``jac`` is not
+given, it is estimated by finite differences, which costs an extra evaluation of
+the right-hand side for every state variable, or one vectorized evaluation of all
+of them, every time the Jacobian is updated. The functions here return the exact
+Jacobians of ``relative_motion``, ``nondim_cr3bp``, and ``nonimpulsive_maneuver``
+from ``jit.py``. They take the same arguments as the right-hand side, so they can
+be passed as ``jac`` to any call that uses ``args``::
+
+    from benchmarks.jacobians import relative_motion_jac
+    from benchmarks.jit import relative_motion
+
+    sol = solve_ivp(
+        relative_motion, [t_0, t_f], Y_0, method="Radau", jac=relative_motion_jac,
+        args=(mu,),
+    )
+
+The Jacobians are vectorized: for a state of shape ``(n,)`` they return an
+``(n, n)`` array, and for ``k`` states in the columns of an ``(n, k)`` array, as
+with ``vectorized=True``, they return an ``(n, n, k)`` array.
+
+The solvers update the Jacobian rarely, so the analytic Jacobians do not reduce
+the number of evaluations of the right-hand side; with ``Radau`` on the thrust
+problem they even take a few percent more steps. What they save is the time of
+the finite differences: ``Radau`` runs in about half the time, and ``BDF`` and
+``LSODA`` about 15% to 50% faster.
+
+Run this file to compare the evaluations and the wall time with and without the
+analytic Jacobians.
+"""
+
+import numpy as np
+
+
+def gravity_gradient(r_vec: np.ndarray, mu: float) -> np.ndarray:
+    """Return the derivative of ``-mu * r_vec / r**3`` with respect to ``r_vec``.
+
+    ``r_vec`` has shape ``(3, ...)`` and the result has shape ``(3, 3, ...)``.
+    """
+    r_sq = np.einsum("i...,i...->...", r_vec, r_vec)
+    gradient = 3 * np.einsum("i...,j...->ij...", r_vec, r_vec) / r_sq
+    gradient -= np.eye(3).reshape(3, 3, *(1,) * (r_vec.ndim - 1))
+    gradient *= mu / (r_sq * np.sqrt(r_sq))
+    return gradient
+
+
+def relative_motion_jac(t: float, Y: np.ndarray, mu: float) -> np.ndarray:
+    """Return the Jacobian of ``relative_motion`` at the states ``Y``."""
+    Y = np.asarray(Y, dtype=float)
+    jac = np.zeros((6, 6, *Y.shape[1:]))
+    jac[:3, 3:] = np.eye(3).reshape(3, 3, *(1,) * (Y.ndim - 1))
+    jac[3:, :3] = gravity_gradient(Y[:3], mu)
+    return jac
+
+
+def nondim_cr3bp_jac(t: float, Y: np.ndarray, pi_2: float) -> np.ndarray:
+    """Return the Jacobian of ``nondim_cr3bp`` at the states ``Y``.
+
+    The position block is the gravity gradient of the two primaries, plus the
+    centrifugal term in the plane of their motion, and the velocity block holds the
+    Coriolis terms.
+    """
+    Y = np.asarray(Y, dtype=float)
+    jac = np.zeros((6, 6, *Y.shape[1:]))
+    jac[:3, 3:] = np.eye(3).reshape(3, 3, *(1,) * (Y.ndim - 1))
+    offset = np.zeros(Y[:3].shape)
+    offset[0] = pi_2
+    jac[3:, :3] = gravity_gradient(Y[:3] + offset, 1 - pi_2)
+    offset[0] = pi_2 - 1
+    jac[3:, :3] += gravity_gradient(Y[:3] + offset, pi_2)
+    jac[3, 0] += 1
+    jac[4, 1] += 1
+    jac[3, 4] = 2
+    jac[4, 3] = -2
+    return jac
+
+
+def nonimpulsive_maneuver_jac(
+    t: float,
+    Y: np.ndarray,
+    mu: float,
+    T: float,
+    I_sp: float,
+    g_0: float,
+    r_2: float,
+) -> np.ndarray:
+    """Return the Jacobian of ``nonimpulsive_maneuver`` at the states ``Y``.
+
+    The thrust ``T * v_vec / (m * v)`` adds a velocity block, the projection
+    perpendicular to the velocity scaled by ``T / (m * v)``, and a mass column. The
+    mass flow rate is constant, so the last row is zero.
+    """
+    Y = np.asarray(Y, dtype=float)
+    jac = np.zeros((7, 7, *Y.shape[1:]))
+    jac[:3, 3:6] = np.eye(3).reshape(3, 3, *(1,) * (Y.ndim - 1))
+    jac[3:6, :3] = gravity_gradient(Y[:3], mu)
+    v_vec = Y[3:6]
+    m = Y[6]
+    v_sq = np.einsum("i...,i...->...", v_vec, v_vec)
+    v = np.sqrt(v_sq)
+    jac[3:6, 3:6] = np.eye(3).reshape(3, 3, *(1,) * (Y.ndim - 1))
+    jac[3:6, 3:6] -= np.einsum("i...,j...->ij...", v_vec, v_vec) / v_sq
+    jac[3:6, 3:6] *= T / (m * v)
+    jac[3:6, 6] = -T * v_vec / (m * m * v)
+    return jac
+
+
+if __name__ == "__main__":
+    import time
+
+    from scipy.integrate import solve_ivp
+
+    from .jit import nondim_cr3bp, nonimpulsive_maneuver, relative_motion
+
+    def finite_difference(fun, t, Y, args, h=1e-6):
+        """Return the Jacobian of ``fun`` from central differences."""
+        columns = []
+        for i in range(Y.size):
+            step = np.zeros_like(Y)
+            step[i] = h * max(1.0, abs(Y[i]))
+            columns.append((fun(t, Y + step, *args) - fun(t, Y - step, *args)) / 2)
+            columns[-1] /= step[i]
+        return np.stack(columns, axis=1)
+
+    mu = 3.986e5  # km**3/s**2
+    pi_2 = 7.348e22 / (5.974e24 + 7.348e22)
+    thrust_args = (mu, 2.5e-3, 10_000, 9.807e-3, 42_164)
+    cases = {
+        "two-body": (
+            relative_motion,
+            relative_motion_jac,
+            np.array((8000.0, 0, 6000, 0, 7, 0)),
+            (mu,),
+            5 * 14_709,
+        ),
+        "CR3BP": (
+            nondim_cr3bp,
+            nondim_cr3bp_jac,
+            np.array((1 - pi_2, 0.0455, 0, -0.5, 0.5, 0)),
+            (pi_2,),
+            20,
+        ),
+        "thrust": (
+            nonimpulsive_maneuver,
+            nonimpulsive_maneuver_jac,
+            np.array((6678.0, 0, 0, 0, 7.726, 0, 1000)),
+            thrust_args,
+            100_000,
+        ),
+    }
+
+    print("Largest relative difference from a finite difference Jacobian")
+    for name, (fun, jac, Y_0, args, _) in cases.items():
+        analytic = jac(0.0, Y_0, *args)
+        numerical = finite_difference(fun, 0.0, Y_0, args)
+        error = np.max(np.abs(analytic - numerical)) / np.max(np.abs(analytic))
+        # The vectorized form agrees with the Jacobian of each column
+        columns = np.stack((Y_0, 1.01 * Y_0), axis=1)
+        batch = jac(0.0, columns, *args)
+        if not np.allclose(batch[..., 1], jac(0.0, columns[:, 1], *args)):
+            raise RuntimeError(f"The vectorized Jacobian of {name} is wrong")
+        print(f"  {name:8s}: {error:.1e}")
+
+    # solve_ivp does not include the evaluations of the finite differences in nfev,
+    # so every call of the right-hand side is counted. The finite differences are
+    # given a vectorized right-hand side, which evaluates all the perturbed states
+    # in one call, as is fair for SciPy.
+    print("            method  jac        calls  nfev  njev  nlu  wall (s)")
+    for name, (fun, jac, Y_0, args, t_f) in cases.items():
+        for method in ("Radau", "BDF", "LSODA"):
+            for label, jacobian in (("numerical", None), ("analytic", jac)):
+                calls = [0]
+
+                def counted(t, Y, *args, fun=fun, calls=calls):
+                    calls[0] += 1
+                    if Y.ndim == 1:
+                        return fun(t, Y, *args)
+                    return np.stack([fun(t, column, *args) for column in Y.T], axis=1)
+
+                start = time.perf_counter()
+                sol = solve_ivp(
+                    counted,
+                    (0, t_f),
+                    Y_0,
+                    method=method,
+                    jac=jacobian,
+                    vectorized=jacobian is None,
+                    rtol=1e-8,
+                    atol=1e-8,
+                    args=args,
+                )
+                seconds = time.perf_counter() - start
+                print(
+                    f"{name:8s} {method:>9s}  {label:9s} {calls[0]:6d} {sol.nfev:5d} "
+                    f"{sol.njev:5d} {sol.nlu:4d} {seconds:9.3f}"
+                )
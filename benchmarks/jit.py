@@ -0,0 +1,365 @@
+"""Compiled versions of the equations of motion and the Kepler equation solvers.
+
+The right-hand side functions in the notes are called thousands of times by
+``solve_ivp``, and most of the time of each call is spent creating small NumPy
+arrays. The functions here compute the same derivatives with scalar arithmetic
+and are compiled with Numba when it is installed, as it is by the ``benchmarks``
+dependency group, ``uv sync --group benchmarks``. The compiled machine code is
+cached in ``_build/.numba_cache``, so it is only compiled again when this file
+changes. Without Numba, ``numba_shim`` provides a pass-through ``njit`` and the
+same functions run as plain Python.
+
+The constants that are module globals in the notes are passed as arguments, so
+the functions are used with the ``args`` of ``solve_ivp``::
+
+    from benchmarks.jit import relative_motion
+
+    sol = solve_ivp(relative_motion, [t_0, t_f], Y_0, args=(mu,))
+
+Run this file to compare the cost of one call of each function with and without
+compilation.
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+HERE = Path(__file__).parent
+CACHE = HERE.parent / "_build" / ".numba_cache"
+# Numba reads the cache directory when it is first imported
+os.environ.setdefault("NUMBA_CACHE_DIR", str(CACHE))
+
+try:
+    from numba import njit
+
+    HAVE_NUMBA = True
+except ImportError:
+    from .numba_shim import njit
+
+    HAVE_NUMBA = False
+
+G = 6.67430e-20  # km**3/(kg * s**2)
+# Convergence tolerance and largest number of iterations of the Newton solvers,
+# the same as scipy.optimize.newton
+TOLERANCE = 1.48e-8
+MAX_ITERATIONS = 50
+# Below this magnitude of z, the Stumpff functions are computed from their series,
+# since the closed forms lose precision to cancellation
+SERIES_LIMIT = 1e-4
+
+
+@njit(cache=True)
+def relative_motion(t, Y, mu):
+    """Calculate the motion of a body relative to the central body.
+
+    The state vector ``Y`` is the position followed by the velocity.
+    """
+    r = np.sqrt(Y[0] * Y[0] + Y[1] * Y[1] + Y[2] * Y[2])
+    k = -mu / (r * r * r)
+    Ydot = np.empty(6)
+    for i in range(3):
+        Ydot[i] = Y[i + 3]
+        Ydot[i + 3] = k * Y[i]
+    return Ydot
+
+
+@njit(cache=True)
+def absolute_motion(t, y, m_1, m_2, G=G):
+    """Calculate the motion of a two-body system in an inertial reference frame.
+
+    The state vector ``y`` should be in the order:
+
+    1. Coordinates of $m_1$
+    2. Coordinates of $m_2$
+    3. Velocity components of $m_1$
+    4. Velocity components of $m_2$
+    """
+    d_x = y[3] - y[0]
+    d_y = y[4] - y[1]
+    d_z = y[5] - y[2]
+    r = np.sqrt(d_x * d_x + d_y * d_y + d_z * d_z)
+    k = G / (r * r * r)
+    ydot = np.empty(12)
+    for i in range(6):
+        ydot[i] = y[i + 6]
+    for i, d in enumerate((d_x, d_y, d_z)):
+        ydot[i + 6] = m_2 * k * d
+        ydot[i + 9] = -m_1 * k * d
+    return ydot
+
+
+@njit(cache=True)
+def nondim_cr3bp(t, Y, pi_2):
+    """Solve the CR3BP in nondimensional coordinates.
+
+    The state vector is Y, with the first three components as the
+    position of $m$, and the second three components its velocity.
+
+    The solution is parameterized on $\\pi_2$, the mass ratio.
+    """
+    x, y, z = Y[0], Y[1], Y[2]
+    sigma_sq = (x + pi_2) ** 2 + y * y + z * z
+    psi_sq = (x - 1 + pi_2) ** 2 + y * y + z * z
+    k_1 = (1 - pi_2) / (sigma_sq * np.sqrt(sigma_sq))
+    k_2 = pi_2 / (psi_sq * np.sqrt(psi_sq))
+    Ydot = np.empty(6)
+    Ydot[0] = Y[3]
+    Ydot[1] = Y[4]
+    Ydot[2] = Y[5]
+    Ydot[3] = 2 * Y[4] + x - k_1 * (x + pi_2) - k_2 * (x - 1 + pi_2)
+    Ydot[4] = -2 * Y[3] + y - k_1 * y - k_2 * y
+    Ydot[5] = -k_1 * z - k_2 * z
+    return Ydot
+
+
+@njit(cache=True)
+def nonimpulsive_maneuver(t, Y, mu, T, I_sp, g_0, r_2):
+    """Residual function for non-impulsive maneuvers.
+
+    t: Current simulation time
+    Y: State vector [x y z xdot ydot zdot m], km, km/s, kg
+    mu: Gravitational parameter, km**3/s**2
+    T: Thrust, kN
+    I_sp: Specific impulse, s
+    g_0: Standard sea-level gravity, km/s**2
+    """
+    r = np.sqrt(Y[0] * Y[0] + Y[1] * Y[1] + Y[2] * Y[2])
+    v = np.sqrt(Y[3] * Y[3] + Y[4] * Y[4] + Y[5] * Y[5])
+    k_r = -mu / (r * r * r)
+    k_v = T / (Y[6] * v)
+    dY_dt = np.empty(7)
+    for i in range(3):
+        dY_dt[i] = Y[i + 3]
+        dY_dt[i + 3] = k_r * Y[i] + k_v * Y[i + 3]
+    dY_dt[6] = -T / (I_sp * g_0)
+    return dY_dt
+
+
+@njit(cache=True)
+def stumpff_2(z):
+    """Solve the Stumpff function C(z) = c2(z). The input z should be
+    a scalar value.
+    """
+    if abs(z) < SERIES_LIMIT:
+        return 1 / 2 - z / 24 + z * z / 720
+    elif z > 0:
+        return (1 - np.cos(np.sqrt(z))) / z
+    else:
+        return (np.cosh(np.sqrt(-z)) - 1) / (-z)
+
+
+@njit(cache=True)
+def stumpff_3(z):
+    """Solve the Stumpff function S(z) = c3(z). The input z should be
+    a scalar value.
+    """
+    if abs(z) < SERIES_LIMIT:
+        return 1 / 6 - z / 120 + z * z / 5040
+    elif z > 0:
+        return (np.sqrt(z) - np.sin(np.sqrt(z))) / np.sqrt(z) ** 3
+    else:
+        return (np.sinh(np.sqrt(-z)) - np.sqrt(-z)) / np.sqrt(-z) ** 3
+
+
+@njit(cache=True)
+def universal_kepler(chi, r_0, v_r0, alpha, delta_t, mu):
+    """Solve the universal Kepler equation in terms of the universal anomaly chi.
+
+    This function is intended to be used with an iterative solution algorithm,
+    such as Newton's algorithm.
+    """
+    z = alpha * chi**2
+    first_term = r_0 * v_r0 / np.sqrt(mu) * chi**2 * stumpff_2(z)
+    second_term = (1 - alpha * r_0) * chi**3 * stumpff_3(z)
+    third_term = r_0 * chi
+    fourth_term = np.sqrt(mu) * delta_t
+    return first_term + second_term + third_term - fourth_term
+
+
+@njit(cache=True)
+def d_universal_d_chi(chi, r_0, v_r0, alpha, delta_t, mu):
+    """The derivative of the universal Kepler equation with respect to chi."""
+    z = alpha * chi**2
+    first_term = r_0 * v_r0 / np.sqrt(mu) * chi * (1 - z * stumpff_3(z))
+    second_term = (1 - alpha * r_0) * chi**2 * stumpff_2(z)
+    third_term = r_0
+    return first_term + second_term + third_term
+
+
+@njit(cache=True)
+def solve_universal_kepler(r_0, v_r0, alpha, delta_t, mu):
+    """Return the universal anomaly after ``delta_t`` with Newton's method.
+
+    The initial guess is the same as in the notes, ``sqrt(mu) * |alpha| * delta_t``.
+    """
+    chi = np.sqrt(mu) * abs(alpha) * delta_t
+    for _ in range(MAX_ITERATIONS):
+        step = universal_kepler(chi, r_0, v_r0, alpha, delta_t, mu) / d_universal_d_chi(
+            chi, r_0, v_r0, alpha, delta_t, mu
+        )
+        chi -= step
+        if abs(step) < TOLERANCE:
+            return chi
+    raise RuntimeError("The universal Kepler equation did not converge")
+
+
+@njit(cache=True)
+def solve_kepler_elliptic(M_e, e):
+    """Return the eccentric anomaly for the mean anomaly ``M_e`` of an ellipse."""
+    E = np.pi
+    for _ in range(MAX_ITERATIONS):
+        step = (E - e * np.sin(E) - M_e) / (1 - e * np.cos(E))
+        E -= step
+        if abs(step) < TOLERANCE:
+            return E
+    raise RuntimeError("Kepler's equation did not converge")
+
+
+@njit(cache=True)
+def solve_kepler_hyperbolic(M_h, e):
+    """Return the hyperbolic eccentric anomaly for the mean anomaly ``M_h``."""
+    F = np.pi
+    for _ in range(MAX_ITERATIONS):
+        step = (e * np.sinh(F) - F - M_h) / (e * np.cosh(F) - 1)
+        F -= step
+        if abs(step) < TOLERANCE:
+            return F
+    raise RuntimeError("Kepler's equation did not converge")
+
+
+if __name__ == "__main__":
+    import timeit
+
+    from scipy.integrate import solve_ivp
+    from scipy.optimize import newton
+
+    # The NumPy versions of the functions, as they are written in the notes
+    def relative_motion_numpy(t, Y, mu):
+        r = np.sqrt(np.sum(np.square(Y[:3])))
+        return np.hstack((Y[3:], -mu * Y[:3] / r**3))
+
+    def absolute_motion_numpy(t, y, m_1, m_2):
+        R_1 = y[:3]
+        R_2 = y[3:6]
+        ydot = np.zeros_like(y)
+        ydot[:6] = y[6:]
+        r = np.sqrt(np.sum(np.square(R_2 - R_1)))
+        ddot = G * (R_2 - R_1) / r**3
+        ydot[6:9] = m_2 * ddot
+        ydot[9:] = -m_1 * ddot
+        return ydot
+
+    def nondim_cr3bp_numpy(t, Y, pi_2):
+        x, y, z = Y[:3]
+        xdot, ydot = Y[3:5]
+        Ydot = np.zeros_like(Y)
+        Ydot[:3] = Y[3:]
+        sigma = np.sqrt(np.sum(np.square([x + pi_2, y, z])))
+        psi = np.sqrt(np.sum(np.square([x - 1 + pi_2, y, z])))
+        Ydot[3] = (
+            2 * ydot
+            + x
+            - (1 - pi_2) * (x + pi_2) / sigma**3
+            - pi_2 * (x - 1 + pi_2) / psi**3
+        )
+        Ydot[4] = -2 * xdot + y - (1 - pi_2) * y / sigma**3 - pi_2 * y / psi**3
+        Ydot[5] = -(1 - pi_2) / sigma**3 * z - pi_2 / psi**3 * z
+        return Ydot
+
+    def nonimpulsive_maneuver_numpy(t, Y, mu, T, I_sp, g_0, r_2):
+        r = np.sqrt(np.dot(Y[0:3], Y[0:3]))
+        v = np.sqrt(np.dot(Y[3:6], Y[3:6]))
+        m = Y[-1]
+        dY_dt = np.zeros(len(Y))
+        dY_dt[0:3] = Y[3:6]
+        dY_dt[3:6] = -mu * Y[0:3] / r**3 + T * Y[3:6] / (m * v)
+        dY_dt[-1] = -T / (I_sp * g_0)
+        return dY_dt
+
+    def universal_numpy(r_0, v_r0, alpha, delta_t, mu):
+        chi_0 = np.sqrt(mu) * np.abs(alpha) * delta_t
+        return newton(
+            universal_kepler.py_func if HAVE_NUMBA else universal_kepler,
+            x0=chi_0,
+            fprime=(d_universal_d_chi.py_func if HAVE_NUMBA else d_universal_d_chi),
+            args=(r_0, v_r0, alpha, delta_t, mu),
+        )
+
+    mu = 3.986e5  # km**3/s**2
+    pi_2 = 7.348e22 / (5.974e24 + 7.348e22)
+    r_0, v_r0, alpha = 10_000, 3.0752, -5.0878e-5
+    cases = {
+        "relative_motion": (
+            relative_motion_numpy,
+            relative_motion,
+            (0.0, np.array((8000.0, 0, 6000, 0, 7, 0)), mu),
+        ),
+        "absolute_motion": (
+            absolute_motion_numpy,
+            absolute_motion,
+            (0.0, np.array((0.0, 0, 0, 3000, 0, 0, 10, 20, 30, 0, 40, 0)), 1e26, 1e26),
+        ),
+        "nondim_cr3bp": (
+            nondim_cr3bp_numpy,
+            nondim_cr3bp,
+            (0.0, np.array((1 - pi_2, 0.0455, 0, -0.5, 0.5, 0)), pi_2),
+        ),
+        "nonimpulsive_maneuver": (
+            nonimpulsive_maneuver_numpy,
+            nonimpulsive_maneuver,
+            (
+                0.0,
+                np.array((6678.0, 0, 0, 0, 7.726, 0, 1000)),
+                mu,
+                2.5e-3,
+                10_000,
+                9.807e-3,
+                42_164,
+            ),
+        ),
+        "universal Kepler": (
+            universal_numpy,
+            solve_universal_kepler,
+            (r_0, v_r0, alpha, 3600.0, mu),
+        ),
+        "elliptic Kepler": (
+            lambda M_e, e: newton(
+                lambda E: E - e * np.sin(E) - M_e,
+                x0=np.pi,
+                fprime=lambda E: 1 - e * np.cos(E),
+            ),
+            solve_kepler_elliptic,
+            (3.6029, 0.37255),
+        ),
+    }
+
+    backend = "Numba" if HAVE_NUMBA else "numba_shim, Numba is not installed"
+    print(f"Time of one call in microseconds ({backend})")
+    print("                        notes   compiled  speedup  first call (ms)")
+    for name, (notes, compiled, args) in cases.items():
+        start = timeit.default_timer()
+        result = compiled(*args)
+        first = timeit.default_timer() - start
+        if not np.allclose(result, notes(*args), rtol=1e-12, atol=1e-12):
+            raise RuntimeError(f"The two versions of {name} do not agree")
+        timer_notes = timeit.Timer(lambda notes=notes, args=args: notes(*args))
+        timer_compiled = timeit.Timer(
+            lambda compiled=compiled, args=args: compiled(*args)
+        )
+        number = max(10, int(0.05 / timer_notes.timeit(10) * 10))
+        time_notes = min(timer_notes.repeat(3, number)) / number * 1e6
+        time_compiled = min(timer_compiled.repeat(3, number)) / number * 1e6
+        print(
+            f"{name:22s} {time_notes:7.2f} {time_compiled:10.2f} "
+            f"{time_notes / time_compiled:8.1f} {first * 1000:16.1f}"
+        )
+
+    # An integration of the CR3BP, as in the notes
+    Y_0 = np.array((1 - pi_2, 0.0455, 0, -0.5, 0.5, 0))
+    print("solve_ivp of the CR3BP to t = 20 with RK45")
+    for name, func in (("notes", nondim_cr3bp_numpy), ("compiled", nondim_cr3bp)):
+        start = timeit.default_timer()
+        sol = solve_ivp(func, (0, 20), Y_0, rtol=1e-12, atol=1e-12, args=(pi_2,))
+        seconds = timeit.default_timer() - start
+        print(f"  {name:8s}: {sol.nfev:6d} evaluations in {seconds:6.3f} s")
@@ -0,0 +1,482 @@
+"""Orbit-averaged propagation of low-thrust spirals.
+
+``nonimpulsive-maneuver-example.ipynb`` integrates the spiral of an ion engine from
+LEO to GEO by integrating ``nonimpulsive_maneuver`` in Cartesian coordinates
+with tolerances of 1e-12, through more than a hundred revolutions, and the solver
+spends almost all of its steps following the motion around each orbit. The thrust
+changes the orbit only slightly during one revolution, so the orbital elements
+vary slowly, and their rates from the Gauss variational equations can be
+averaged over a revolution to remove the motion around the orbit. The averaged
+equations take steps of many revolutions.
+
+The elements are the modified equinoctial elements ``p``, ``f``, ``g``, ``h``,
+``k``, and the true longitude ``L`` of Walker et al. (1985),
+
+    p = a (1 - e**2)
+    f = e cos(omega + Omega),  g = e sin(omega + Omega)
+    h = tan(i / 2) cos(Omega),  k = tan(i / 2) sin(Omega)
+    L = Omega + omega + theta,
+
+which have no singularities for circular or equatorial orbits such as the spiral.
+The averaged state holds the first five elements, the mean longitude ``lambda``,
+and the mass. The rates of the elements are averaged over a revolution in time,
+by the trapezoidal rule at ``NODES`` true longitudes, which converges
+exponentially for these periodic functions. ``lambda`` advances at the mean
+motion, so ``(lambda - lambda_0) / (2 pi)`` counts the revolutions.
+
+A thrust law ``law(t, elements, L, mu)`` returns the unit direction of the thrust
+in the radial, transverse, and normal directions, with shape ``(3, ...)``.
+``tangential`` thrusts along the velocity, as in ``nonimpulsive_maneuver``.
+
+``solve_averaged`` integrates the averaged equations until the apoapsis reaches
+a target radius. With ``full_revolutions``, the last revolutions are integrated
+again with the full equations of motion, from the averaged state, with the
+events of the notebook.
+
+For the spiral of the notebook, the averaged equations reproduce the time of
+flight and the propellant within 3e-4 and the number of revolutions exactly, with
+about 300 evaluations of the right-hand side instead of about 80,000. The error
+comes from the first-order averaging, whose small parameter, the ratio of the
+thrust to the gravity, grows to 1e-2 at GEO. Integrating the last five
+revolutions with the full equations reduces the error to 4e-5.
+
+Run this file to compare the time of flight, the propellant, and the number of
+revolutions with the full integration of the notebook.
+"""
+
+from collections.abc import Callable, Sequence
+from typing import Any
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult, brentq
+
+from .jit import nonimpulsive_maneuver, solve_kepler_elliptic
+
+# Layout of the averaged state: the elements p, f, g, h, k, the mean longitude,
+# and the mass
+ELEMENTS = slice(0, 5)
+LONGITUDE = 5
+MASS = 6
+# Number of true longitudes in the average over a revolution
+NODES = 64
+# Options of the full integration, the tolerances of the notebook
+FULL_OPTIONS = {"method": "DOP853", "rtol": 1e-12, "atol": 1e-15}
+
+
+def to_equinoctial(
+    r_vec: np.ndarray, v_vec: np.ndarray, mu: float
+) -> tuple[np.ndarray, float]:
+    """Return the elements ``(p, f, g, h, k)`` and the true longitude ``L`` of the
+    position ``r_vec`` and velocity ``v_vec``.
+    """
+    h_vec = np.cross(r_vec, v_vec)
+    h_mag = np.linalg.norm(h_vec)
+    p = h_mag**2 / mu
+    w_x, w_y, w_z = h_vec / h_mag
+    h = -w_y / (1 + w_z)
+    k = w_x / (1 + w_z)
+    f_hat, g_hat = equinoctial_frame(h, k)
+    r = np.linalg.norm(r_vec)
+    e_vec = np.cross(v_vec, h_vec) / mu - r_vec / r
+    L = np.arctan2(r_vec @ g_hat, r_vec @ f_hat) % (2 * np.pi)
+    return np.array((p, e_vec @ f_hat, e_vec @ g_hat, h, k)), L
+
+
+def equinoctial_frame(h: float, k: float) -> tuple[np.ndarray, np.ndarray]:
+    """Return the unit vectors of the equinoctial frame in the orbital plane."""
+    s_sq = 1 + h * h + k * k
+    f_hat = np.array((1 - k * k + h * h, 2 * h * k, -2 * k)) / s_sq
+    g_hat = np.array((2 * h * k, 1 + k * k - h * h, 2 * h)) / s_sq
+    return f_hat, g_hat
+
+
+def from_equinoctial(
+    elements: np.ndarray, L: float, mu: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the position and velocity of the elements ``(p, f, g, h, k)`` at the
+    true longitude ``L``.
+    """
+    p, f, g, h, k = elements
+    f_hat, g_hat = equinoctial_frame(h, k)
+    cos_L, sin_L = np.cos(L), np.sin(L)
+    r = p / (1 + f * cos_L + g * sin_L)
+    speed = np.sqrt(mu / p)
+    r_vec = r * (cos_L * f_hat + sin_L * g_hat)
+    v_vec = speed * (-(g + sin_L) * f_hat + (f + cos_L) * g_hat)
+    return r_vec, v_vec
+
+
+def mean_longitude(elements: np.ndarray, L: float) -> float:
+    """Return the mean longitude at the true longitude ``L``."""
+    _, f, g, _, _ = elements
+    e = np.hypot(f, g)
+    varpi = np.arctan2(g, f)
+    theta = L - varpi
+    E = 2 * np.arctan(np.sqrt((1 - e) / (1 + e)) * np.tan(theta / 2))
+    # The half angle formula returns E in (-pi, pi), so add the whole revolutions
+    E += 2 * np.pi * np.round((theta - E) / (2 * np.pi))
+    return varpi + E - e * np.sin(E)
+
+
+def true_longitude(elements: np.ndarray, mean: float) -> float:
+    """Return the true longitude at the mean longitude ``mean``."""
+    _, f, g, _, _ = elements
+    e = np.hypot(f, g)
+    varpi = np.arctan2(g, f)
+    M = mean - varpi
+    revolutions = np.floor(M / (2 * np.pi))
+    E = solve_kepler_elliptic(M - 2 * np.pi * revolutions, e)
+    theta = 2 * np.arctan(np.sqrt((1 + e) / (1 - e)) * np.tan(E / 2))
+    theta += 2 * np.pi * np.round((E - theta) / (2 * np.pi))
+    return varpi + theta + 2 * np.pi * revolutions
+
+
+def tangential(t: float, elements: np.ndarray, L: np.ndarray, mu: float) -> np.ndarray:
+    """Return the direction of the velocity in the radial, transverse, and normal
+    directions.
+    """
+    _, f, g, _, _ = elements
+    v_r = f * np.sin(L) - g * np.cos(L)
+    v_t = 1 + f * np.cos(L) + g * np.sin(L)
+    v = np.sqrt(v_r * v_r + v_t * v_t)
+    return np.array((v_r / v, v_t / v, np.zeros_like(v)))
+
+
+def gauss_rates(
+    elements: np.ndarray, L: np.ndarray, mu: float, accel: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the rates of the elements ``(p, f, g, h, k)`` and of the true
+    longitude ``L`` for the acceleration ``accel`` in the radial, transverse, and
+    normal directions, from the Gauss variational equations.
+    """
+    p, f, g, h, k = elements
+    a_r, a_t, a_n = accel
+    cos_L, sin_L = np.cos(L), np.sin(L)
+    w = 1 + f * cos_L + g * sin_L
+    s_sq = 1 + h * h + k * k
+    root = np.sqrt(p / mu)
+    out_of_plane = (h * sin_L - k * cos_L) * a_n / w
+    rates = np.array(
+        (
+            2 * p / w * root * a_t,
+            root * (a_r * sin_L + ((w + 1) * cos_L + f) * a_t / w - g * out_of_plane),
+            root * (-a_r * cos_L + ((w + 1) * sin_L + g) * a_t / w + f * out_of_plane),
+            root * s_sq * a_n * cos_L / (2 * w),
+            root * s_sq * a_n * sin_L / (2 * w),
+        )
+    )
+    L_dot = np.sqrt(mu * p) * (w / p) ** 2 + root * out_of_plane
+    return rates, L_dot
+
+
+def node_rates(
+    t: float,
+    X: np.ndarray,
+    mu: float,
+    T: float,
+    law: Callable[..., np.ndarray],
+    nodes: int,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the true longitudes of the nodes of the average, the rates of the
+    elements at the nodes, and the time spent near each node, ``1 / L_dot``.
+    """
+    elements = X[ELEMENTS, None]
+    L = np.linspace(0, 2 * np.pi, nodes, endpoint=False)
+    accel = T / X[MASS] * law(t, elements, L, mu)
+    rates, L_dot = gauss_rates(elements, L, mu, accel)
+    return L, rates, 1 / L_dot
+
+
+def averaged_rhs(
+    t: float,
+    X: np.ndarray,
+    mu: float,
+    T: float,
+    mass_rate: float,
+    law: Callable[..., np.ndarray],
+    nodes: int,
+) -> np.ndarray:
+    """Return the derivative of the averaged state ``X`` for the thrust ``T``."""
+    _, rates, weights = node_rates(t, X, mu, T, law, nodes)
+    period = 2 * np.pi * weights.mean()
+    Xdot = np.empty_like(X)
+    Xdot[ELEMENTS] = rates @ weights / weights.sum()
+    Xdot[LONGITUDE] = 2 * np.pi / period
+    Xdot[MASS] = mass_rate
+    return Xdot
+
+
+def short_period(
+    t: float,
+    X: np.ndarray,
+    L: float,
+    mu: float,
+    T: float,
+    law: Callable[..., np.ndarray],
+    nodes: int,
+) -> np.ndarray:
+    """Return the difference between the osculating and the averaged elements
+    ``(p, f, g, h, k)`` at the true longitude ``L``, to first order in the thrust.
+
+    The difference changes with ``L`` at the rate ``(x_dot - <x_dot>) / L_dot``,
+    which is integrated term by term from its Fourier series at the nodes, and
+    its average over a revolution in time is zero.
+    """
+    L_nodes, rates, weights = node_rates(t, X, mu, T, law, nodes)
+    mean_rates = rates @ weights / weights.sum()
+    coefficients = np.fft.rfft((rates - mean_rates[:, None]) * weights, axis=1)
+    # The constant term is zero, and the term at the Nyquist frequency is dropped
+    m = np.arange(1, coefficients.shape[1] - 1)
+    integrated = 2 * coefficients[:, 1:-1] / (1j * m * nodes)
+    at_nodes = np.real(integrated @ np.exp(1j * np.outer(m, L_nodes)))
+    at_L = np.real(integrated @ np.exp(1j * m * L))
+    return at_L - at_nodes @ weights / weights.sum()
+
+
+def full_rhs(
+    t: float,
+    Y: np.ndarray,
+    mu: float,
+    T: float,
+    mass_rate: float,
+    law: Callable[..., np.ndarray],
+) -> np.ndarray:
+    """Return the derivative of the Cartesian state and mass ``Y`` for the thrust
+    ``T`` in the direction of ``law``.
+    """
+    r_vec, v_vec, m = Y[:3], Y[3:6], Y[6]
+    elements, L = to_equinoctial(r_vec, v_vec, mu)
+    r = np.linalg.norm(r_vec)
+    radial = r_vec / r
+    normal = np.cross(r_vec, v_vec)
+    normal /= np.linalg.norm(normal)
+    transverse = np.cross(normal, radial)
+    a_r, a_t, a_n = law(t, elements, L, mu)
+    Ydot = np.empty_like(Y)
+    Ydot[:3] = v_vec
+    Ydot[3:6] = -mu * r_vec / r**3 + T / m * (a_r * radial + a_t * transverse)
+    Ydot[3:6] += T / m * a_n * normal
+    Ydot[6] = mass_rate
+    return Ydot
+
+
+def solve_averaged(
+    mu: float,
+    t_span: Sequence[float],
+    Y_0: np.ndarray,
+    T: float,
+    I_sp: float,
+    g_0: float,
+    r_target: float,
+    law: Callable[..., np.ndarray] = tangential,
+    full_revolutions: float = 0.0,
+    nodes: int = NODES,
+    full_options: dict[str, Any] | None = None,
+    **options,
+) -> OptimizeResult:
+    """Integrate the averaged equations from the Cartesian state and mass ``Y_0``
+    until the apoapsis reaches ``r_target`` or the mass is used up.
+
+    ``T``, ``I_sp``, and ``g_0`` are the same as for ``nonimpulsive_maneuver``,
+    and ``options`` are passed to ``solve_ivp``, which uses ``DOP853`` with
+    tolerances of 1e-10 unless they are given. With ``full_revolutions``, the
+    last revolutions of the averaged solution are replaced by an integration of
+    the full equations with ``full_options``, which stops when the radius
+    reaches ``r_target``, as in the notebook.
+
+    The averaged elements differ from the osculating elements by short-period
+    terms, which are removed from the initial state and added back at the switch
+    to the full equations.
+
+    The result has the time of flight ``t_f``, the final mass ``m_f`` and the
+    propellant used, the number of revolutions of the true longitude, the number
+    of multiples of 2 pi that it passed including the start, ``crossings``, which
+    for an equatorial orbit is the count of the ``orbit`` event of the notebook,
+    the number of evaluations of each phase, and the solutions of the two phases,
+    ``averaged`` and ``full``.
+    """
+    t_0, t_end = map(float, t_span)
+    if t_end <= t_0:
+        raise ValueError("t_span must be increasing")
+    if full_revolutions < 0:
+        raise ValueError("full_revolutions must not be negative")
+    Y_0 = np.asarray(Y_0, dtype=float)
+    mass_rate = -T / (I_sp * g_0)
+    elements, L_0 = to_equinoctial(Y_0[:3], Y_0[3:6], mu)
+    X_0 = np.concatenate((elements, (0.0, Y_0[6])))
+    X_0[ELEMENTS] -= short_period(t_0, X_0, L_0, mu, T, law, nodes)
+    lambda_0 = X_0[LONGITUDE] = mean_longitude(X_0[ELEMENTS], L_0)
+    args = (mu, T, mass_rate, law, nodes)
+
+    def apoapsis(t, X, *args):
+        p, f, g = X[:3]
+        return p / (1 - np.hypot(f, g)) - r_target
+
+    def mass(t, X, *args):
+        return X[MASS]
+
+    apoapsis.terminal = mass.terminal = True
+    options = {"method": "DOP853", "rtol": 1e-10, "atol": 1e-10, **options}
+    averaged = solve_ivp(
+        averaged_rhs,
+        (t_0, t_end),
+        X_0,
+        dense_output=True,
+        events=(apoapsis, mass),
+        args=args,
+        **options,
+    )
+    if not averaged.success:
+        raise RuntimeError(averaged.message)
+
+    t_f = averaged.t[-1]
+    X_f = averaged.y[:, -1]
+    L_f = true_longitude(X_f[ELEMENTS], X_f[LONGITUDE])
+    m_f = X_f[MASS]
+    full = None
+    if full_revolutions > 0:
+        # Go back the given number of revolutions, or to the start
+        target = X_f[LONGITUDE] - 2 * np.pi * full_revolutions
+        if target <= lambda_0:
+            t_switch = t_0
+        else:
+            t_switch = brentq(
+                lambda t: averaged.sol(t)[LONGITUDE] - target, t_0, t_f, xtol=1e-6
+            )
+        X_s = averaged.sol(t_switch)
+        L_s = true_longitude(X_s[ELEMENTS], X_s[LONGITUDE])
+        osculating = X_s[ELEMENTS] + short_period(t_switch, X_s, L_s, mu, T, law, nodes)
+        r_vec, v_vec = from_equinoctial(osculating, L_s, mu)
+        Y_s = np.concatenate((r_vec, v_vec, (X_s[MASS],)))
+        _, g_hat = equinoctial_frame(*osculating[3:])
+
+        def reached_destination(t, Y, *args):
+            return np.linalg.norm(Y[:3]) - r_target
+
+        def full_mass(t, Y, *args):
+            return Y[6]
+
+        def orbit(t, Y, *args):
+            return Y[:3] @ g_hat
+
+        reached_destination.terminal = full_mass.terminal = True
+        orbit.direction = 1
+        # Thrust along the velocity is the compiled right-hand side of the notebook
+        if law is tangential:
+            rhs, full_args = nonimpulsive_maneuver, (mu, T, I_sp, g_0, r_target)
+        else:
+            rhs, full_args = full_rhs, (mu, T, mass_rate, law)
+        full = solve_ivp(
+            rhs,
+            (t_switch, t_end),
+            Y_s,
+            events=(reached_destination, full_mass, orbit),
+            args=full_args,
+            **(FULL_OPTIONS if full_options is None else full_options),
+        )
+        if not full.success:
+            raise RuntimeError(full.message)
+        t_f = full.t[-1]
+        m_f = full.y[6, -1]
+        # Whole revolutions from the crossings, and the rest from the longitudes
+        _, L_end = to_equinoctial(full.y[:3, -1], full.y[3:6, -1], mu)
+        upward = full.t_events[2]
+        n_full = upward[upward > t_switch].size
+        L_f = L_s + 2 * np.pi * n_full + L_end - L_s % (2 * np.pi)
+    revolutions = (L_f - L_0) / (2 * np.pi)
+    # The true longitude passes a multiple of 2 pi at every upward crossing of the
+    # x axis of an equatorial orbit, which the notebook counts including the start
+    crossings = int(np.floor(L_f / (2 * np.pi)) - np.ceil(L_0 / (2 * np.pi))) + 1
+    status = (full if full is not None else averaged).status
+    return OptimizeResult(
+        t_f=t_f,
+        m_f=m_f,
+        propellant=Y_0[6] - m_f,
+        revolutions=revolutions,
+        crossings=crossings,
+        nfev_averaged=averaged.nfev,
+        nfev_full=0 if full is None else full.nfev,
+        averaged=averaged,
+        full=full,
+        status=status,
+        message=(full if full is not None else averaged).message,
+        success=True,
+    )
+
+
+if __name__ == "__main__":
+    import time
+
+    # The spacecraft of the notebook
+    R_E = 6378  # km
+    mu = 3.986e5  # km**3/s**2
+    r_LEO = R_E + 300  # km
+    r_2 = 42_164  # km, GEO
+    m_0 = 1000  # kg
+    T = 2.5e-3  # kN
+    I_sp = 10_000  # s
+    g_0 = 9.807e-3  # km/s**2
+    Y_0 = np.array((r_LEO, 0, 0, 0, np.sqrt(mu / r_LEO), 0, m_0))
+    t_end = 2_000_000  # s
+
+    def reached_destination(t, Y, *args):
+        return np.linalg.norm(Y[:3]) - r_2
+
+    def mass(t, Y, *args):
+        return Y[-1]
+
+    def orbit(t, Y, *args):
+        return Y[1]
+
+    reached_destination.terminal = mass.terminal = True
+    orbit.direction = 1
+    start = time.perf_counter()
+    sol = solve_ivp(
+        nonimpulsive_maneuver,
+        (0, t_end),
+        Y_0,
+        events=(reached_destination, mass, orbit),
+        args=(mu, T, I_sp, g_0, r_2),
+        **FULL_OPTIONS,
+    )
+    seconds = time.perf_counter() - start
+    rows = [
+        (
+            "full, notebook",
+            sol.t[-1],
+            m_0 - sol.y[6, -1],
+            sol.t_events[2].size,
+            sol.nfev,
+            seconds,
+        )
+    ]
+    for full_revolutions in (0, 5):
+        start = time.perf_counter()
+        result = solve_averaged(
+            mu, (0, t_end), Y_0, T, I_sp, g_0, r_2, full_revolutions=full_revolutions
+        )
+        seconds = time.perf_counter() - start
+        name = f"averaged, {full_revolutions} full revs"
+        nfev = result.nfev_averaged + result.nfev_full
+        row = (name, result.t_f, result.propellant, result.crossings, nfev, seconds)
+        rows.append(row)
+        print(
+            f"{name}: {result.revolutions:.2f} revolutions, "
+            f"{result.nfev_averaged} averaged and {result.nfev_full} full evaluations"
+        )
+    print(
+        "                      TOF (days)  propellant (kg)  crossings    nfev  wall (s)"
+    )
+    for name, t_f, propellant, crossings, nfev, seconds in rows:
+        print(
+            f"{name:21s} {t_f / 86_400:10.4f} {propellant:16.4f} {crossings:10d} "
+            f"{nfev:7d} {seconds:9.2f}"
+        )
+    reference = rows[0]
+    for name, t_f, propellant, crossings, _, _ in rows[1:]:
+        print(
+            f"{name}: TOF error {abs(t_f / reference[1] - 1):.1e}, "
+            f"propellant error {abs(propellant / reference[2] - 1):.1e}, "
+            f"crossings {crossings - reference[3]:+d}"
+        )
@@ -0,0 +1,346 @@
+"""Propagate the mean elements of large catalogs with the secular effects of J2.
+
+The oblateness of the Earth makes the node line regress and the perigee rotate at
+the rates of the notes,
+
+    Omega_dot = -[3/2 sqrt(mu) J_2 R**2 / ((1 - e**2)**2 a**(7/2))] cos i
+    omega_dot = -[3/2 sqrt(mu) J_2 R**2 / ((1 - e**2)**2 a**(7/2))] (5/2 sin**2 i - 2)
+
+and changes the mean motion, to first order in J_2, to
+
+    M_dot = n [1 + 3/4 J_2 (R / p)**2 sqrt(1 - e**2) (3 cos**2 i - 1)].
+
+The semimajor axis, eccentricity, and inclination have no secular change, so the
+mean elements at any time are a linear function of time, and a catalog can be
+propagated without integrating anything. The short-period oscillations of the
+osculating elements, of order ``J_2 R`` in position, are not modeled.
+
+The elements of ``N`` objects are an ``(N, 6)`` array with the columns ``a``,
+``e``, ``i``, ``Omega``, ``omega``, and ``M``, with the angles in radians.
+``propagate_chunks`` yields the elements at the times ``t`` as ``(N_c, T, 6)``
+arrays for consecutive chunks of ``N_c`` objects, so the memory stays bounded for
+any size of catalog, and converts them to positions and velocities with
+``cartesian=True``. ``to_cartesian`` converts any array of elements, and
+``propagate`` collects the chunks into one ``(N, T, 6)`` array, the layout of
+``batch_two_body.propagate``.
+
+The mean elements of 100,000 objects every minute for one day take a few seconds.
+The conversion to Cartesian coordinates solves Kepler's equation for each of the
+144 million states, and takes about 40 s, or about 13 s in ``float32``, on one
+core. So Cartesian output misses the target of a few seconds, and is meant for the
+objects and times that are needed.
+
+Run this file to compare the regression of the nodes with a Cowell integration
+and to time a catalog of 100,000 objects for one day at one minute resolution.
+"""
+
+from collections.abc import Iterator
+
+import numpy as np
+
+MU_EARTH = 3.986e5  # km**3/s**2
+R_EARTH = 6378.0  # km
+J_2 = 1.08263e-3
+# Default number of states in each chunk of propagate_chunks, small enough for
+# the temporary arrays of the conversion to Cartesian coordinates to stay in cache
+CHUNK_STATES = 2**16
+# Convergence tolerance and largest number of iterations of Kepler's equation
+TOLERANCE = 1e-12
+MAX_ITERATIONS = 50
+# Largest angle for which rotate uses Taylor series, which are then accurate to
+# the precision of float64
+ROTATE = 0.1
+
+
+def secular_rates(
+    a: np.ndarray,
+    e: np.ndarray,
+    i: np.ndarray,
+    mu: float = MU_EARTH,
+    R: float = R_EARTH,
+    J_2: float = J_2,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the rates of change of ``Omega``, ``omega``, and ``M`` in rad/s."""
+    factor = 1.5 * np.sqrt(mu) * J_2 * R**2 / ((1 - e**2) ** 2 * a**3.5)
+    cos_i = np.cos(i)
+    raan_dot = -factor * cos_i
+    argp_dot = -factor * (2.5 * (1 - cos_i**2) - 2)
+    mean_motion = np.sqrt(mu / a**3)
+    M_dot = mean_motion + 0.5 * factor * np.sqrt(1 - e**2) * (3 * cos_i**2 - 1)
+    return raan_dot, argp_dot, M_dot
+
+
+def check_elements(elements: np.ndarray) -> np.ndarray:
+    """Return ``elements`` as an ``(N, 6)`` array of elliptical orbits."""
+    elements = np.asarray(elements, dtype=float)
+    if elements.ndim != 2 or elements.shape[1] != 6:
+        raise ValueError(f"elements must have shape (N, 6), not {elements.shape}")
+    a, e = elements[:, 0], elements[:, 1]
+    if np.any(a <= 0) or np.any((e < 0) | (e >= 1)):
+        raise ValueError("The orbits must be ellipses with a > 0 and 0 <= e < 1")
+    return elements
+
+
+def propagate_chunks(
+    elements: np.ndarray,
+    t: np.ndarray,
+    chunk_size: int | None = None,
+    cartesian: bool = False,
+    mu: float = MU_EARTH,
+    R: float = R_EARTH,
+    J_2: float = J_2,
+    dtype: type = np.float64,
+) -> Iterator[tuple[slice, np.ndarray]]:
+    """Yield the mean elements of consecutive chunks of ``chunk_size`` objects at
+    the times ``t``, together with the slice of ``elements`` they belong to.
+
+    ``elements`` has shape ``(N, 6)`` and holds the mean elements at ``t = 0``.
+    ``chunk_size`` defaults to the number of objects that keeps each chunk under
+    ``CHUNK_STATES`` states. Each chunk has shape ``(chunk_size, T, 6)`` and is
+    stored as ``dtype``. The angles grow continuously from their initial values,
+    except with a lower precision ``dtype``, when they are reduced to
+    ``[0, 2 pi)`` first. With ``cartesian=True``, the chunks hold the positions
+    and velocities instead of the elements, computed in ``dtype``, so
+    ``np.float32`` trades about 10 m of precision in low orbits for three times
+    the speed.
+    """
+    elements = check_elements(elements)
+    t = np.atleast_1d(np.asarray(t, dtype=float))
+    n_objects = elements.shape[0]
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_STATES // t.size)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    rates = np.stack(secular_rates(*elements[:, :3].T, mu, R, J_2), axis=1)
+    for start in range(0, n_objects, chunk_size):
+        part = slice(start, min(start + chunk_size, n_objects))
+        initial = elements[part]
+        chunk = np.empty((initial.shape[0], t.size, 6), dtype=dtype)
+        angles = []
+        for k in range(3):
+            angle = np.multiply.outer(rates[part, k], t)
+            angle += initial[:, 3 + k, None]
+            if dtype != np.float64:
+                # Reduce the angles before they lose precision
+                angle -= 2 * np.pi * np.floor(angle / (2 * np.pi))
+            angles.append(angle.astype(dtype, copy=False))
+        if cartesian:
+            a, e, i = initial[:, :3].astype(dtype).T[:, :, None]
+            states = cartesian_states(a, e, np.cos(i), np.sin(i), *angles, mu)
+            for k in range(6):
+                chunk[:, :, k] = states[k]
+        else:
+            for k in range(3):
+                chunk[:, :, k] = initial[:, k, None]
+                chunk[:, :, 3 + k] = angles[k]
+        yield part, chunk
+
+
+def propagate(
+    elements: np.ndarray,
+    t: np.ndarray,
+    cartesian: bool = False,
+    mu: float = MU_EARTH,
+    R: float = R_EARTH,
+    J_2: float = J_2,
+    dtype: type = np.float64,
+) -> np.ndarray:
+    """Return the mean elements, or the positions and velocities with
+    ``cartesian=True``, of every object at the times ``t``, with shape
+    ``(N, T, 6)``.
+    """
+    elements = check_elements(elements)
+    t = np.atleast_1d(np.asarray(t, dtype=float))
+    result = np.empty((elements.shape[0], t.size, 6), dtype=dtype)
+    for part, chunk in propagate_chunks(
+        elements, t, cartesian=cartesian, mu=mu, R=R, J_2=J_2, dtype=dtype
+    ):
+        result[part] = chunk
+    return result
+
+
+def rotate(
+    cos_x: np.ndarray, sin_x: np.ndarray, delta: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the cosine and sine of ``x + delta`` from those of ``x``, for
+    ``|delta| <= ROTATE``, from the Taylor series of the cosine and sine of
+    ``delta``, with fewer terms when ``delta`` is small.
+    """
+    delta_sq = delta * delta
+    if np.max(delta_sq, initial=0.0) <= 1e-8:
+        cos_delta = 1 - delta_sq / 2
+        sin_delta = delta * (1 - delta_sq / 6)
+    else:
+        cos_delta = 1 - delta_sq / 2 * (
+            1 - delta_sq / 12 * (1 - delta_sq / 30 * (1 - delta_sq / 56))
+        )
+        sin_delta = delta * (
+            1 - delta_sq / 6 * (1 - delta_sq / 20 * (1 - delta_sq / 42))
+        )
+    return (
+        cos_x * cos_delta - sin_x * sin_delta,
+        sin_x * cos_delta + cos_x * sin_delta,
+    )
+
+
+def solve_kepler(
+    M: np.ndarray, e: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the eccentric anomalies for the mean anomalies ``M`` of ellipses
+    with eccentricities ``e``, and their cosines and sines.
+
+    Newton's method is applied to all of the anomalies at once. Whenever the
+    change of the anomalies is small enough, their cosines and sines are rotated
+    instead of recomputed, so the solution for orbits of small eccentricity costs
+    only the cosine and sine of ``M``. Newton's method converges quadratically,
+    with an error after a step below ``e / (2 (1 - e))`` times the square of the
+    step, so the iterations stop as soon as that bound is below the tolerance.
+    """
+    tolerance = max(TOLERANCE, 16 * np.finfo(M.dtype).eps)
+    e_max = np.max(e, initial=0.0)
+    cos_E, sin_E = np.cos(M), np.sin(M)
+    E = M
+    step = np.where(e < 0.8, e * sin_E, 0.85 * e * np.sign(sin_E))
+    converged = False
+    for _ in range(MAX_ITERATIONS):
+        E = E + step
+        if np.max(np.abs(step), initial=0.0) <= ROTATE:
+            cos_E, sin_E = rotate(cos_E, sin_E, step)
+        else:
+            cos_E, sin_E = np.cos(E), np.sin(E)
+        if converged:
+            return E, cos_E, sin_E
+        step = (M - E + e * sin_E) / (1 - e * cos_E)
+        largest = np.max(np.abs(step), initial=0.0)
+        converged = e_max * largest**2 < tolerance * (1 - e_max)
+    raise RuntimeError("Kepler's equation did not converge")
+
+
+def cartesian_states(
+    a: np.ndarray,
+    e: np.ndarray,
+    cos_i: np.ndarray,
+    sin_i: np.ndarray,
+    raan: np.ndarray,
+    argp: np.ndarray,
+    M: np.ndarray,
+    mu: float = MU_EARTH,
+) -> tuple[np.ndarray, ...]:
+    """Return the three components of the position and of the velocity for the
+    elements, which are broadcast together.
+    """
+    _, cos_E, sin_E = solve_kepler(M, e)
+    root = np.sqrt(1 - e * e)
+    # Coordinates in the perifocal frame
+    x = a * (cos_E - e)
+    y = a * root * sin_E
+    speed = np.sqrt(mu / a) / (1 - e * cos_E)
+    v_x = -speed * sin_E
+    v_y = speed * root * cos_E
+    # Unit vectors of the perifocal frame towards perigee and 90 degrees ahead
+    cos_O, sin_O = np.cos(raan), np.sin(raan)
+    cos_w, sin_w = np.cos(argp), np.sin(argp)
+    cos_w_cos_i = cos_w * cos_i
+    sin_w_cos_i = sin_w * cos_i
+    P = (
+        cos_O * cos_w - sin_O * sin_w_cos_i,
+        sin_O * cos_w + cos_O * sin_w_cos_i,
+        sin_w * sin_i,
+    )
+    Q = (
+        -cos_O * sin_w - sin_O * cos_w_cos_i,
+        -sin_O * sin_w + cos_O * cos_w_cos_i,
+        cos_w * sin_i,
+    )
+    positions = tuple(x * P[k] + y * Q[k] for k in range(3))
+    velocities = tuple(v_x * P[k] + v_y * Q[k] for k in range(3))
+    return positions + velocities
+
+
+def to_cartesian(elements: np.ndarray, mu: float = MU_EARTH) -> np.ndarray:
+    """Return the positions and velocities of the ``elements``, an array of shape
+    ``(..., 6)``, as an array of the same shape.
+    """
+    elements = np.asarray(elements, dtype=float)
+    a, e, i, raan, argp, M = np.moveaxis(elements, -1, 0)
+    states = cartesian_states(a, e, np.cos(i), np.sin(i), raan, argp, M, mu)
+    return np.stack(states, axis=-1)
+
+
+if __name__ == "__main__":
+    import time
+
+    from scipy.integrate import solve_ivp
+
+    from .force_models import ForceModels, zonal
+
+    # A sun-synchronous orbit at 700 km, whose node must advance 0.9856 deg/day,
+    # and a Molniya orbit at the critical inclination, whose perigee is fixed
+    examples = np.array(
+        (
+            (R_EARTH + 700, 0.001, np.radians(98.19), 0, np.pi / 2, 0),
+            (26_600, 0.74, np.radians(63.435), 0, np.radians(270), 0),
+        )
+    )
+    raan_dot, argp_dot, _ = secular_rates(*examples[:, :3].T)
+    for name, node, perigee in zip(
+        ("Sun-synchronous", "Molniya"), raan_dot, argp_dot, strict=True
+    ):
+        print(
+            f"{name:16s} node {np.degrees(node) * 86_400:8.4f} deg/day, "
+            f"perigee {np.degrees(perigee) * 86_400:8.4f} deg/day"
+        )
+
+    # The node of the sun-synchronous orbit, integrated with the J2 acceleration
+    t_end = 3 * 86_400
+    t = np.linspace(0, t_end, 1001)
+    forces = ForceModels(MU_EARTH)
+    forces.add("zonal", zonal, MU_EARTH, R_EARTH, J_2)
+    Y_0 = to_cartesian(examples[0])
+    sol = solve_ivp(
+        forces.rhs, (0, t_end), Y_0, method="DOP853", t_eval=t, rtol=1e-10, atol=1e-10
+    )
+    h = np.cross(sol.y[:3].T, sol.y[3:].T)
+    osculating = np.unwrap(np.arctan2(h[:, 0], -h[:, 1]))
+    mean = propagate(examples[:1], t)[0, :, 3]
+    difference = np.angle(np.exp(1j * (osculating - mean)))
+    print(
+        "Largest difference of the node from a Cowell integration over 3 days: "
+        f"{np.degrees(np.abs(difference).max()):.4f} deg"
+    )
+
+    # A catalog of 100,000 low orbits for one day every minute
+    rng = np.random.default_rng(0)
+    n_objects = 100_000
+    catalog = np.column_stack(
+        (
+            R_EARTH + rng.uniform(400, 2000, n_objects),
+            rng.uniform(0, 0.05, n_objects),
+            rng.uniform(0, np.pi, n_objects),
+            rng.uniform(0, 2 * np.pi, (3, n_objects)).T,
+        )
+    )
+    t = np.arange(0, 86_401, 60.0)
+    print(f"{n_objects} objects at {t.size} times, in chunks of {CHUNK_STATES} states")
+    for name, cartesian, dtype in (
+        ("mean elements", False, np.float64),
+        ("mean elements, float32", False, np.float32),
+        ("Cartesian", True, np.float64),
+        ("Cartesian, float32", True, np.float32),
+    ):
+        start = time.perf_counter()
+        for _ in propagate_chunks(catalog, t, cartesian=cartesian, dtype=dtype):
+            pass
+        seconds = time.perf_counter() - start
+        print(f"  {name:24s} {seconds:6.1f} s, {seconds / t.size * 1e3:5.1f} ms/epoch")
+
+    # The positions in float32 against float64, and the energy of every orbit
+    states = propagate(catalog[:1000], t, cartesian=True)
+    single = propagate(catalog[:1000], t, cartesian=True, dtype=np.float32)
+    difference = np.max(np.linalg.norm(states[..., :3] - single[..., :3], axis=-1))
+    print(f"Largest difference of the float32 positions: {difference * 1e3:.1f} m")
+    r = np.linalg.norm(states[..., :3], axis=-1)
+    energy = 0.5 * np.sum(states[..., 3:] ** 2, axis=-1) - MU_EARTH / r
+    expected = -MU_EARTH / (2 * catalog[:1000, :1])
+    error = np.abs(energy / expected - 1).max()
+    print(f"Largest relative error of the energy: {error:.1e}")
@@ -0,0 +1,259 @@
+"""Equations of motion of N bodies with arbitrary masses.
+
+``absolute_motion`` in ``two-body-inertial-numerical-solution.py`` is written for
+two bodies. ``n_body_rhs`` computes the same derivative for any number of bodies,
+with the state vector in the same order: the coordinates of every body, followed
+by the velocity components of every body. It can be passed to ``solve_ivp`` with
+``args=(masses,)``.
+
+The accelerations are computed from the separations of all pairs of bodies at
+once with NumPy. To bound the memory used for thousands of bodies, the bodies are
+split into blocks of rows that are computed separately, and the blocks can be
+computed by several threads, since NumPy releases the GIL in its kernels.
+
+The barycenter and the quantities that are conserved by the exact solution, the
+energy and the linear and angular momentum, can be computed from a solution to
+check the accuracy of an integration.
+
+Run this file to integrate a three-body choreography and to measure the number of
+steps per second for increasing numbers of bodies.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+
+G = 6.67430e-20  # km**3/(kg * s**2)
+# Largest number of pairs of bodies in one block of the acceleration kernel, to
+# bound the size of the temporary arrays
+BLOCK_PAIRS = 2**18
+
+# Thread pools used by the kernels, by number of threads
+_STATE: dict[str, Any] = {"executors": {}}
+
+
+def split_state(y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the positions and velocities in the state ``y``.
+
+    ``y`` has shape ``(..., 6 * N)`` and the results have shape ``(..., N, 3)``.
+    """
+    y = np.asarray(y)
+    n_bodies = y.shape[-1] // 6
+    positions = y[..., : 3 * n_bodies].reshape(*y.shape[:-1], n_bodies, 3)
+    velocities = y[..., 3 * n_bodies :].reshape(*y.shape[:-1], n_bodies, 3)
+    return positions, velocities
+
+
+def blocks(n_bodies: int) -> list[tuple[int, int]]:
+    size = max(1, BLOCK_PAIRS // n_bodies)
+    return [(i, min(i + size, n_bodies)) for i in range(0, n_bodies, size)]
+
+
+def map_blocks(func: Any, n_bodies: int, threads: int) -> None:
+    """Call ``func(start, stop)`` for every block of bodies, with ``threads``
+    threads.
+    """
+    if threads <= 1:
+        for start, stop in blocks(n_bodies):
+            func(start, stop)
+        return
+    executors = _STATE["executors"]
+    if threads not in executors:
+        executors[threads] = ThreadPoolExecutor(max_workers=threads)
+    # Consume the results so that exceptions in the threads are raised
+    list(executors[threads].map(lambda block: func(*block), blocks(n_bodies)))
+
+
+def separations(
+    coordinates: np.ndarray, start: int, stop: int, softening: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the components of the vectors from bodies ``start`` to ``stop`` to
+    every body, and the squared distances, with the distance of each body to
+    itself set to infinity.
+
+    ``coordinates`` has shape ``(3, N)``, so that each component of the
+    separations is computed from a contiguous array.
+    """
+    d = coordinates[:, None, :] - coordinates[:, start:stop, None]
+    r_sq = d[0] * d[0]
+    r_sq += d[1] * d[1]
+    r_sq += d[2] * d[2]
+    r_sq += softening**2
+    rows = np.arange(stop - start)
+    r_sq[rows, rows + start] = np.inf
+    return d, r_sq
+
+
+def accelerations(
+    R: np.ndarray,
+    masses: np.ndarray,
+    G: float = G,
+    softening: float = 0.0,
+    threads: int = 1,
+) -> np.ndarray:
+    """Return the gravitational acceleration of each body.
+
+    ``R`` has shape ``(N, 3)``. ``softening`` is a length added in quadrature to
+    every separation, which limits the acceleration during close encounters.
+    """
+    coordinates = np.ascontiguousarray(np.transpose(R), dtype=float)
+    masses = np.asarray(masses, dtype=float)
+    a = np.empty_like(coordinates)
+
+    def block(start: int, stop: int) -> None:
+        d, r_sq = separations(coordinates, start, stop, softening)
+        # Reuse the memory of r_sq for the weight of each pair
+        weights = np.sqrt(r_sq)
+        weights *= r_sq
+        np.divide(masses, weights, out=weights)
+        for k in range(3):
+            a[k, start:stop] = np.einsum("bn,bn->b", weights, d[k])
+
+    map_blocks(block, coordinates.shape[1], threads)
+    return G * a.T
+
+
+def n_body_rhs(
+    t: float,
+    y: np.ndarray,
+    masses: np.ndarray,
+    G: float = G,
+    softening: float = 0.0,
+    threads: int = 1,
+) -> np.ndarray:
+    """Calculate the motion of N bodies in an inertial reference frame.
+
+    The state vector ``y`` should be in the order:
+
+    1. Coordinates of each body
+    2. Velocity components of each body
+    """
+    n_bodies = len(masses)
+    ydot = np.empty_like(y, dtype=float)
+    ydot[: 3 * n_bodies] = y[3 * n_bodies :]
+    R = y[: 3 * n_bodies].reshape(n_bodies, 3)
+    ydot[3 * n_bodies :] = accelerations(R, masses, G, softening, threads).ravel()
+    return ydot
+
+
+def barycenter(y: np.ndarray, masses: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the position and velocity of the barycenter of the states ``y``."""
+    positions, velocities = split_state(y)
+    masses = np.asarray(masses, dtype=float)
+    total = masses.sum()
+    return (
+        np.einsum("n,...nk->...k", masses, positions) / total,
+        np.einsum("n,...nk->...k", masses, velocities) / total,
+    )
+
+
+def linear_momentum(y: np.ndarray, masses: np.ndarray) -> np.ndarray:
+    _, velocities = split_state(y)
+    return np.einsum("n,...nk->...k", masses, velocities)
+
+
+def angular_momentum(y: np.ndarray, masses: np.ndarray) -> np.ndarray:
+    """Return the angular momentum of the states ``y`` about the origin."""
+    positions, velocities = split_state(y)
+    return np.einsum("n,...nk->...k", masses, np.cross(positions, velocities))
+
+
+def potential_energy(
+    R: np.ndarray,
+    masses: np.ndarray,
+    G: float = G,
+    softening: float = 0.0,
+    threads: int = 1,
+) -> float:
+    """Return the gravitational potential energy of the bodies at ``R``."""
+    coordinates = np.ascontiguousarray(np.transpose(R), dtype=float)
+    masses = np.asarray(masses, dtype=float)
+    n_bodies = coordinates.shape[1]
+    energies = np.zeros(n_bodies)
+
+    def block(start: int, stop: int) -> None:
+        _, r_sq = separations(coordinates, start, stop, softening)
+        energies[start:stop] = masses[start:stop] * ((1 / np.sqrt(r_sq)) @ masses)
+
+    map_blocks(block, n_bodies, threads)
+    # Every pair was counted twice
+    return -0.5 * G * energies.sum()
+
+
+def total_energy(
+    y: np.ndarray,
+    masses: np.ndarray,
+    G: float = G,
+    softening: float = 0.0,
+    threads: int = 1,
+) -> np.ndarray:
+    """Return the kinetic plus potential energy of the states ``y``, which has
+    shape ``(6 * N,)`` or ``(T, 6 * N)``.
+    """
+    positions, velocities = split_state(y)
+    masses = np.asarray(masses, dtype=float)
+    kinetic = 0.5 * np.einsum("n,...nk,...nk->...", masses, velocities, velocities)
+    potential = np.array(
+        [
+            potential_energy(R, masses, G, softening, threads)
+            for R in positions.reshape(-1, len(masses), 3)
+        ]
+    ).reshape(kinetic.shape)
+    return kinetic + potential
+
+
+if __name__ == "__main__":
+    from scipy.integrate import solve_ivp
+
+    # The figure-eight choreography of three equal masses, in units with G = 1
+    masses = np.ones(3)
+    R_0 = np.array(
+        ((-0.97000436, 0.24308753, 0), (0, 0, 0), (0.97000436, -0.24308753, 0))
+    )
+    V_3 = np.array((-0.93240737, -0.86473146, 0))
+    V_0 = np.array((-V_3 / 2, V_3, -V_3 / 2))
+    y_0 = np.hstack((R_0.ravel(), V_0.ravel()))
+    period = 6.32591398
+
+    sol = solve_ivp(
+        n_body_rhs,
+        (0, period),
+        y_0,
+        method="DOP853",
+        rtol=1e-12,
+        atol=1e-12,
+        args=(masses, 1.0),
+    )
+    y = sol.y.T
+    energy = total_energy(y, masses, 1.0)
+    L = angular_momentum(y, masses)
+    center, _ = barycenter(y, masses)
+    print(f"Figure-eight orbit, {sol.t.size - 1} steps over one period")
+    print(f"  Relative change in energy: {abs(energy[-1] / energy[0] - 1):.2e}")
+    print(f"  Change in angular momentum: {np.max(np.abs(L[-1] - L[0])):.2e}")
+    print(f"  Largest distance of the barycenter: {np.max(np.abs(center)):.2e}")
+    print(f"  Distance from the start: {np.max(np.abs(y[-1] - y_0)):.2e}")
+
+    # Bodies spread uniformly through a sphere, in units with G = 1
+    rng = np.random.default_rng(0)
+    threads = os.cpu_count() or 1
+    print(f"Steps per second of RK45, 6 evaluations per step ({threads} threads)")
+    for n_bodies in (10, 100, 300, 1000, 3000):
+        direction = rng.normal(size=(n_bodies, 3))
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+        R = direction * rng.uniform(0, 1, (n_bodies, 1)) ** (1 / 3)
+        y = np.hstack((R.ravel(), rng.normal(0, 0.1, 3 * n_bodies)))
+        masses = np.full(n_bodies, 1 / n_bodies)
+        rates = []
+        for n_threads in (1, threads):
+            repeats = max(2, 200_000 // n_bodies**2)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                n_body_rhs(0, y, masses, 1.0, 1e-3, n_threads)
+            rates.append(repeats / (time.perf_counter() - start) / 6)
+        print(
+            f"  N = {n_bodies:5d}: {rates[0]:10.1f} steps/s, {rates[1]:10.1f} threaded"
+        )
@@ -0,0 +1,421 @@
+"""Memoize the results of ``scipy.integrate.solve_ivp`` on disk between builds.
+
+``solve_ivp`` in this module is a drop-in replacement for the one in SciPy. The
+key of an integration is a hash of the source of the right-hand side function and
+of the constants it uses, whether they come from a closure, default arguments, or
+module globals, together with ``y0``, ``t_span``, ``t_eval``, the method, the
+tolerances, the events, ``args``, and any other solver options. When the key is
+found in the cache the stored solution, including ``t_events`` and ``y_events``,
+is loaded instead of integrating the equations again::
+
+    from benchmarks.solve_ivp_cache import solve_ivp
+
+    sol = solve_ivp(relative_motion, [t_0, t_f], Y_0, t_eval=t_points)
+
+The cache is opt-in: the pages of the book import ``solve_ivp`` from SciPy, since
+their code is shown to readers, and whole pages are reused by the page cache.
+
+Solutions with ``dense_output=True`` are not cached, since the interpolant cannot
+be stored without pickling it. Neither are integrations that depend on objects
+without a stable representation, such as instances of arbitrary classes.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import time
+import types
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import scipy
+from scipy import integrate
+from scipy.optimize import OptimizeResult
+
+HERE = Path(__file__).parent
+CACHE = HERE.parent / "_build" / ".solve_ivp_cache"
+# Bump this when the way solutions are stored changes so that old entries are not used
+CACHE_VERSION = "solve-ivp-cache-1"
+# Largest total size in bytes of the cache before the least recently used entries
+# are removed
+MAX_SIZE = 1024**3
+# Types of module globals and closure variables whose value is part of the key
+VALUE_TYPES = (type(None), bool, int, float, complex, str, bytes, np.generic)
+
+
+def value_token(value: Any, seen: set[int]) -> Any:
+    """Convert ``value`` into something that can be hashed as JSON.
+
+    Arrays are represented by their dtype, shape, and a hash of their data, and
+    functions by the token of their code and the constants they use. Raises
+    ``TypeError`` for other objects, whose ``repr`` usually contains their
+    address in memory and so would never match between builds.
+    """
+    if isinstance(value, VALUE_TYPES):
+        return repr(value)
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value)
+        return {
+            "dtype": data.dtype.str,
+            "shape": data.shape,
+            "sha256": hashlib.sha256(data.tobytes()).hexdigest(),
+        }
+    if isinstance(value, list | tuple):
+        return [type(value).__name__, [value_token(item, seen) for item in value]]
+    if isinstance(value, dict):
+        return {str(key): value_token(item, seen) for key, item in value.items()}
+    if isinstance(value, types.ModuleType):
+        return ["module", value.__name__]
+    if isinstance(value, type):
+        return ["type", value.__module__, value.__qualname__]
+    if isinstance(
+        value,
+        types.FunctionType | types.MethodType | types.BuiltinFunctionType | np.ufunc,
+    ) or (callable(value) and unwrap(value) is not value):
+        return function_token(value, seen)
+    raise TypeError(f"Cannot make a cache key from a {type(value).__qualname__}")
+
+
+def unwrap(func: Callable) -> Callable:
+    """Return the Python function compiled by a Numba dispatcher or wrapped by a
+    decorator, or ``func`` itself if it is neither.
+    """
+    while True:
+        inner = getattr(func, "py_func", None) or getattr(func, "__wrapped__", None)
+        if inner is None or inner is func:
+            return func
+        func = inner
+
+
+def code_names(code: types.CodeType) -> set[str]:
+    """Return the global names used by ``code`` and the functions defined in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+    return names
+
+
+def code_token(code: types.CodeType) -> Any:
+    """Return a token of the bytecode of ``code``, its constants, including
+    nested code objects, and the names it uses.
+    """
+    return {
+        "bytecode": code.co_code.hex(),
+        "consts": [const_token(const) for const in code.co_consts],
+        "names": code.co_names,
+        "varnames": code.co_varnames,
+        "freevars": code.co_freevars,
+    }
+
+
+def const_token(const: Any) -> Any:
+    """Return a token of a constant of a code object."""
+    if isinstance(const, types.CodeType):
+        return code_token(const)
+    if isinstance(const, tuple):
+        return [const_token(item) for item in const]
+    if isinstance(const, frozenset):
+        # The iteration order of a set of strings changes between processes
+        return ["frozenset", sorted(repr(item) for item in const)]
+    return repr(const)
+
+
+def function_token(func: Callable, seen: set[int] | None = None) -> Any:
+    """Return a token of the source of ``func`` and the values it depends on.
+
+    The values are the closure variables, the default arguments, and the module
+    globals named in the code of the function. Functions it calls are included
+    recursively, so changing a helper or a constant invalidates the cache. Numba
+    dispatchers and decorated functions are represented by the function they
+    wrap.
+    """
+    if seen is None:
+        seen = set()
+    func = unwrap(func)
+    if id(func) in seen:
+        return ["recursive", getattr(func, "__qualname__", repr(func))]
+    seen.add(id(func))
+    if isinstance(func, types.MethodType):
+        return [
+            "method",
+            function_token(func.__func__, seen),
+            value_token(func.__self__, seen),
+        ]
+    code = getattr(func, "__code__", None)
+    if code is None:
+        # Builtins and ufuncs are identified by their name
+        module = getattr(func, "__module__", None) or type(func).__module__
+        return ["builtin", module, getattr(func, "__qualname__", repr(func))]
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        # Functions created with exec have no source, so key on their code object
+        source = code_token(code)
+    cells = getattr(func, "__closure__", None) or ()
+    closure = {
+        name: value_token(cell.cell_contents, seen)
+        for name, cell in zip(code.co_freevars, cells, strict=True)
+    }
+    func_globals = getattr(func, "__globals__", {})
+    used_globals = {
+        name: value_token(func_globals[name], seen)
+        for name in sorted(code_names(code))
+        if name in func_globals
+    }
+    return {
+        "source": source,
+        "closure": closure,
+        "defaults": value_token(getattr(func, "__defaults__", None), seen),
+        "kwdefaults": value_token(getattr(func, "__kwdefaults__", None), seen),
+        "globals": used_globals,
+    }
+
+
+def event_token(event: Callable) -> Any:
+    return {
+        "function": function_token(event),
+        "terminal": value_token(getattr(event, "terminal", False), set()),
+        "direction": value_token(getattr(event, "direction", 0), set()),
+    }
+
+
+class SolutionCache:
+    """Cache of ``solve_ivp`` solutions, stored as one ``.npz`` file per key.
+
+    Entries are sharded into subdirectories by the first two characters of the
+    key and written atomically, so several processes can share the cache. The
+    modification time of an entry is updated when it is read, which is used for
+    LRU eviction when the total size of the cache exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, directory: Path = CACHE, max_size: int = MAX_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0}
+
+    @staticmethod
+    def key(
+        fun: Callable,
+        t_span: Sequence[float],
+        y0: np.ndarray,
+        method: str | type,
+        t_eval: np.ndarray | None,
+        events: Callable | Sequence[Callable] | None,
+        args: tuple | None,
+        options: dict[str, Any],
+    ) -> str:
+        if callable(events):
+            events = [events]
+        payload = json.dumps(
+            {
+                "fun": function_token(fun),
+                "t_span": value_token(np.asarray(t_span, dtype=float), set()),
+                "y0": value_token(np.asarray(y0), set()),
+                "method": value_token(method, set()),
+                "t_eval": value_token(
+                    None if t_eval is None else np.asarray(t_eval), set()
+                ),
+                "events": [event_token(event) for event in events or ()],
+                "args": value_token(args, set()),
+                "options": value_token(options, set()),
+                "numpy": np.__version__,
+                "scipy": scipy.__version__,
+                "version": CACHE_VERSION,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.npz"
+
+    def get(self, key: str) -> OptimizeResult | None:
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        info = json.loads(str(arrays.pop("info")))
+        n_events = info.pop("n_events")
+        if n_events is None:
+            t_events = y_events = None
+        else:
+            t_events = [arrays[f"t_events_{i}"] for i in range(n_events)]
+            y_events = [arrays[f"y_events_{i}"] for i in range(n_events)]
+        return OptimizeResult(
+            t=arrays["t"],
+            y=arrays["y"],
+            sol=None,
+            t_events=t_events,
+            y_events=y_events,
+            **info,
+        )
+
+    def set(self, key: str, sol: OptimizeResult) -> None:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        info = {
+            "n_events": None if sol.t_events is None else len(sol.t_events),
+            "nfev": int(sol.nfev),
+            "njev": int(sol.njev),
+            "nlu": int(sol.nlu),
+            "status": int(sol.status),
+            "message": str(sol.message),
+            "success": bool(sol.success),
+        }
+        arrays = {"t": sol.t, "y": sol.y, "info": np.array(json.dumps(info))}
+        for i, (t, y) in enumerate(
+            zip(sol.t_events or (), sol.y_events or (), strict=True)
+        ):
+            arrays[f"t_events_{i}"] = t
+            arrays[f"y_events_{i}"] = y
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_name, path)
+        self.stats["writes"] += 1
+        self.evict()
+
+    def entries(self) -> list[Path]:
+        return list(self.directory.glob("??/*.npz"))
+
+    def evict(self, max_size: int | None = None) -> int:
+        """Remove the least recently used entries until the cache is smaller than
+        ``max_size`` bytes.
+
+        Returns the number of entries removed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = []
+        for path in self.entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self.stats["evicted"] += removed
+        return removed
+
+
+_CACHE = SolutionCache()
+
+
+def solve_ivp(
+    fun: Callable,
+    t_span: Sequence[float],
+    y0: np.ndarray,
+    method: str | type = "RK45",
+    t_eval: np.ndarray | None = None,
+    dense_output: bool = False,
+    events: Callable | Sequence[Callable] | None = None,
+    vectorized: bool = False,
+    args: tuple | None = None,
+    cache: SolutionCache | None = None,
+    **options: Any,
+) -> OptimizeResult:
+    """Solve an initial value problem with ``scipy.integrate.solve_ivp``, reusing
+    the stored solution if the same problem was solved before.
+
+    The arguments are the same as for SciPy, plus ``cache`` to use a cache other
+    than the default one in ``_build/.solve_ivp_cache``. Problems that cannot be
+    keyed are always integrated.
+    """
+    if cache is None:
+        cache = _CACHE
+    kwargs = dict(
+        method=method,
+        t_eval=t_eval,
+        dense_output=dense_output,
+        events=events,
+        vectorized=vectorized,
+        args=args,
+        **options,
+    )
+    if dense_output:
+        return integrate.solve_ivp(fun, t_span, y0, **kwargs)
+    try:
+        key = cache.key(
+            fun,
+            t_span,
+            y0,
+            method,
+            t_eval,
+            events,
+            args,
+            {"vectorized": vectorized, **options},
+        )
+    except TypeError:
+        # The problem depends on an object that cannot be part of a key
+        return integrate.solve_ivp(fun, t_span, y0, **kwargs)
+    sol = cache.get(key)
+    if sol is None:
+        sol = integrate.solve_ivp(fun, t_span, y0, **kwargs)
+        cache.set(key, sol)
+    return sol
+
+
+if __name__ == "__main__":
+    from tempfile import TemporaryDirectory
+
+    mu = 3.986e5  # km**3/s**2
+    r_E = 6378  # km
+
+    def relative_motion(t, Y):
+        r = np.sqrt(np.sum(np.square(Y[:3])))
+        return np.hstack((Y[3:], -mu * Y[:3] / r**3))
+
+    def periapsis(t, Y):
+        return np.dot(Y[:3], Y[3:])
+
+    periapsis.direction = 1
+
+    Y_0 = np.array((8000, 0, 6000, 0, 7, 0))
+    t_eval = np.linspace(0, 5 * 14_709, 100_000)
+    with TemporaryDirectory() as directory:
+        cache = SolutionCache(Path(directory))
+        for attempt in ("first", "second"):
+            start = time.perf_counter()
+            sol = solve_ivp(
+                relative_motion,
+                (0, t_eval[-1]),
+                Y_0,
+                method="DOP853",
+                t_eval=t_eval,
+                events=periapsis,
+                rtol=1e-12,
+                atol=1e-12,
+                cache=cache,
+            )
+            seconds = time.perf_counter() - start
+            print(
+                f"{attempt} call: {seconds * 1000:8.1f} ms, "
+                f"{sol.t_events[0].size} periapsis passages, {cache.stats}"
+            )
+        mu = 3.9861e5  # km**3/s**2, changing a constant changes the key
+        solve_ivp(relative_motion, (0, 100), Y_0, cache=cache)
+        solve_ivp(relative_motion, (0, 100), Y_0, cache=cache)
+        print(f"after changing mu: {cache.stats}")
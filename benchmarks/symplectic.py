@@ -0,0 +1,310 @@
+"""Fixed-step symplectic integrators for long propagations of conservative systems.
+
+The Runge-Kutta methods of ``solve_ivp`` do not conserve energy, so the energy of
+an orbit, or the Jacobi constant in the CR3BP, drifts steadily away from its
+initial value, and the only remedy is to tighten the tolerances. Symplectic
+methods preserve the geometry of Hamiltonian flow instead, so that the error of
+the energy stays bounded, oscillating around its initial value, for any number of
+steps.
+
+``leapfrog`` integrates systems whose acceleration depends only on the position,
+such as ``relative_motion`` and ``n_body.n_body_rhs``, with the kick-drift-kick
+leapfrog method. ``implicit_midpoint`` integrates any system given its right-hand
+side and Jacobian, such as ``nondim_cr3bp``, whose Coriolis terms depend on the
+velocity. The implicit midpoint rule is symplectic in canonical coordinates, and
+since it commutes with linear changes of variables, it is also symplectic for the
+rotating frame velocities, which differ from the canonical momenta by a linear
+function of the position.
+
+Both methods are second order and symmetric, and ``order=4`` or ``order=6``
+composes them into the fourth and sixth order methods of Yoshida (1990). The
+state vector is in the same order as for ``solve_ivp``: the positions followed by
+the velocities.
+
+The bounded error only pays off over long spans. Over the 300 periods of the
+two-body comparison, and to ``t = 100`` in the CR3BP, ``solve_ivp`` with tight
+tolerances reaches a smaller error for about the same number of evaluations, and
+the implicit midpoint rule is also slower per evaluation. The drift of
+``solve_ivp`` grows linearly, so at equal cost the symplectic methods only win
+after about 1800 periods of the two-body orbit, which a run of 3000 periods
+confirms, or after ``t = 1500`` in the CR3BP.
+
+Run this file to compare the work and precision of these methods with
+``solve_ivp``, and to estimate when the bounded error wins.
+"""
+
+from collections.abc import Callable
+from typing import Any
+
+import numpy as np
+
+# Substep weights of the compositions of Yoshida (1990), the fourth order triple
+# jump and the sixth order solution A
+_CUBE_ROOT = 2 ** (1 / 3)
+_W_6 = (-1.17767998417887, 0.235573213359357, 0.784513610477560)
+COMPOSITIONS = {
+    2: (1.0,),
+    4: (1 / (2 - _CUBE_ROOT), -_CUBE_ROOT / (2 - _CUBE_ROOT), 1 / (2 - _CUBE_ROOT)),
+    6: (*_W_6[::-1], 1 - 2 * sum(_W_6), *_W_6),
+}
+# Convergence tolerance, relative to the size of the state, and largest number of
+# iterations of the implicit midpoint equations
+TOLERANCE = 1e-14
+MAX_ITERATIONS = 20
+
+
+def two_body_acceleration(r: np.ndarray, mu: float) -> np.ndarray:
+    """Return the acceleration of a body at ``r`` relative to the central body."""
+    r_sq = r @ r
+    return -mu * r / (r_sq * np.sqrt(r_sq))
+
+
+def two_body_energy(y: np.ndarray, mu: float) -> np.ndarray:
+    """Return the specific energy of the two-body states ``y``, of shape
+    ``(6, ...)``.
+    """
+    r = np.sqrt(np.einsum("i...,i...->...", y[:3], y[:3]))
+    return 0.5 * np.einsum("i...,i...->...", y[3:], y[3:]) - mu / r
+
+
+def jacobi_constant(y: np.ndarray, pi_2: float) -> np.ndarray:
+    """Return the Jacobi constant of the nondimensional CR3BP states ``y``, of shape
+    ``(6, ...)``, as it is defined in the notes.
+
+    The notes define it for planar orbits. The centrifugal term only depends on
+    the distances from the primaries in the plane of their motion, so ``z`` is
+    left out of it, and the constant is conserved for spatial orbits as well.
+    """
+    x, y_, z = y[:3]
+    sigma_sq = (x + pi_2) ** 2 + y_**2
+    psi_sq = (x - 1 + pi_2) ** 2 + y_**2
+    z_sq = z**2
+    return (
+        0.5 * np.einsum("i...,i...->...", y[3:], y[3:])
+        - (1 - pi_2) / np.sqrt(sigma_sq + z_sq)
+        - pi_2 / np.sqrt(psi_sq + z_sq)
+        - 0.5 * ((1 - pi_2) * sigma_sq + pi_2 * psi_sq)
+    )
+
+
+def steps(t_end: float, h: float, order: int) -> tuple[int, float, tuple]:
+    """Return the number of steps, the step adjusted to end at ``t_end``, and the
+    substep weights of the composition of ``order``.
+    """
+    if order not in COMPOSITIONS:
+        raise ValueError(f"order must be one of {list(COMPOSITIONS)}, not {order}")
+    if h <= 0 or t_end <= 0:
+        raise ValueError("t_end and h must be positive")
+    n_steps = int(np.ceil(t_end / h))
+    return n_steps, t_end / n_steps, COMPOSITIONS[order]
+
+
+def leapfrog(
+    acceleration: Callable[..., np.ndarray],
+    y_0: np.ndarray,
+    t_end: float,
+    h: float,
+    order: int = 2,
+    args: tuple = (),
+    save_every: int = 1,
+) -> tuple[np.ndarray, np.ndarray, dict[str, Any]]:
+    """Integrate ``y_0`` from 0 to ``t_end`` with steps close to ``h``.
+
+    ``acceleration(R, *args)`` returns the acceleration at the positions ``R``,
+    the first half of the state. The state is saved every ``save_every`` steps.
+    Returns the times, the states with shape ``(n, T)`` as in ``solve_ivp``, and
+    the number of steps and evaluations of the acceleration.
+    """
+    n_steps, h, weights = steps(t_end, h, order)
+    y = np.array(y_0, dtype=float)
+    n = y.size // 2
+    R, V = y[:n], y[n:]
+    a = acceleration(R, *args)
+    saved = [y.copy()]
+    for step in range(1, n_steps + 1):
+        for w in weights:
+            # The last kick of a substep and the first of the next are merged, so
+            # each substep costs one evaluation
+            V += 0.5 * w * h * a
+            R += w * h * V
+            a = acceleration(R, *args)
+            V += 0.5 * w * h * a
+        if step % save_every == 0:
+            saved.append(y.copy())
+    t = np.arange(len(saved)) * save_every * h
+    stats = {"steps": n_steps, "nfev": 1 + n_steps * len(weights)}
+    return t, np.array(saved).T, stats
+
+
+def implicit_midpoint(
+    fun: Callable[..., np.ndarray],
+    jac: Callable[..., np.ndarray] | None,
+    y_0: np.ndarray,
+    t_end: float,
+    h: float,
+    order: int = 2,
+    args: tuple = (),
+    save_every: int = 1,
+) -> tuple[np.ndarray, np.ndarray, dict[str, Any]]:
+    """Integrate ``y_0`` from 0 to ``t_end`` with steps close to ``h``.
+
+    ``fun(t, y, *args)`` is the right-hand side, as for ``solve_ivp``. Each
+    substep solves for the midpoint state with simplified Newton iterations,
+    which update the Jacobian ``jac(t, y, *args)`` only when they converge
+    slowly, or with fixed point iterations if ``jac`` is None. Returns the same
+    values as ``leapfrog``, plus the number of Jacobian evaluations.
+    """
+    n_steps, h, weights = steps(t_end, h, order)
+    y = np.array(y_0, dtype=float)
+    identity = np.eye(y.size)
+    saved = [y.copy()]
+    stats = {"steps": n_steps, "nfev": 1, "njev": 0}
+    t = 0.0
+    # The derivative at the last midpoint, to predict the next one
+    ydot = np.asarray(fun(t, y, *args), dtype=float)
+    for step in range(1, n_steps + 1):
+        for w in weights:
+            h_w = w * h
+            t_mid = t + 0.5 * h_w
+            # Solve z = y + h / 2 * f(z) for the midpoint z
+            z = y + 0.5 * h_w * ydot
+            inverse = None
+            last_change = np.inf
+            for _ in range(MAX_ITERATIONS):
+                residual = z - y - 0.5 * h_w * fun(t_mid, z, *args)
+                stats["nfev"] += 1
+                if jac is None:
+                    dz = residual
+                else:
+                    if inverse is None:
+                        matrix = identity - 0.5 * h_w * jac(t_mid, z, *args)
+                        inverse = np.linalg.inv(matrix)
+                        stats["njev"] += 1
+                    dz = inverse @ residual
+                z -= dz
+                change = np.abs(dz).max()
+                if change <= TOLERANCE * (1 + np.abs(z).max()):
+                    break
+                # Update the Jacobian when the iterations converge slowly
+                if change > 0.5 * last_change:
+                    inverse = None
+                last_change = change
+            else:
+                raise RuntimeError(
+                    f"The implicit midpoint equations did not converge at t = {t}"
+                )
+            ydot = 2 * (z - y) / h_w
+            y = 2 * z - y
+            t += h_w
+        if step % save_every == 0:
+            saved.append(y.copy())
+    t_saved = np.arange(len(saved)) * save_every * h
+    return t_saved, np.array(saved).T, stats
+
+
+if __name__ == "__main__":
+    import time
+
+    from scipy.integrate import solve_ivp
+
+    from .jacobians import nondim_cr3bp_jac
+    from .jit import nondim_cr3bp, relative_motion
+
+    def drift(values: np.ndarray) -> tuple[float, float]:
+        """Return the largest relative error of a conserved quantity in the first
+        and second halves of a solution, which are similar when it is bounded.
+        """
+        error = np.abs(values / values[0] - 1)
+        half = error.size // 2
+        return error[:half].max(), error[half:].max()
+
+    def print_row(name, nfev, seconds, first, second):
+        print(f"  {name:26s} {nfev:9d} {seconds:9.2f} {first:12.1e} {second:12.1e}")
+        errors[name] = second
+
+    def print_crossover(bounded, drifting, span, unit):
+        """Print when the drift of ``drifting``, which grows linearly, passes the
+        bounded error of ``bounded``.
+        """
+        crossover = span * errors[bounded] / errors[drifting]
+        print(
+            f"  {drifting} passes the bounded error of {bounded} "
+            f"after about {crossover:.0f} {unit}"
+        )
+
+    errors = {}
+
+    header = (
+        "                              RHS calls  wall (s)  first half  second half"
+    )
+
+    # A low orbit with e = 0.1 for 300 periods
+    mu = 3.986e5  # km**3/s**2
+    r_p, e = 7000.0, 0.1
+    a = r_p / (1 - e)
+    period = 2 * np.pi * np.sqrt(a**3 / mu)
+    y_0 = np.array((r_p, 0, 0, 0, np.sqrt(mu * (1 + e) / r_p), 0))
+    t_end = 300 * period
+    print(f"Two-body orbit with e = {e}, 300 periods: largest energy error")
+    print(header)
+    for order, n_steps in ((2, 100), (4, 50), (6, 25), (6, 50)):
+        start = time.perf_counter()
+        t, y, stats = leapfrog(
+            two_body_acceleration,
+            y_0,
+            t_end,
+            period / n_steps,
+            order,
+            (mu,),
+            save_every=10,
+        )
+        seconds = time.perf_counter() - start
+        name = "leapfrog" if order == 2 else f"Yoshida {order}"
+        name += f", {n_steps} steps/orbit"
+        print_row(name, stats["nfev"], seconds, *drift(two_body_energy(y, mu)))
+    for method, tol in (("RK45", 1e-6), ("RK45", 1e-8), ("DOP853", 1e-10)):
+        start = time.perf_counter()
+        sol = solve_ivp(
+            relative_motion,
+            (0, t_end),
+            y_0,
+            method=method,
+            rtol=tol,
+            atol=tol,
+            args=(mu,),
+        )
+        seconds = time.perf_counter() - start
+        name = f"{method}, tolerance {tol:.0e}"
+        print_row(name, sol.nfev, seconds, *drift(two_body_energy(sol.y, mu)))
+    print_crossover(
+        "Yoshida 6, 50 steps/orbit", "DOP853, tolerance 1e-10", 300, "periods"
+    )
+
+    # A distant orbit of the Earth in the rotating frame of the Earth-Moon system,
+    # for about 100 revolutions
+    pi_2 = 7.348e22 / (5.974e24 + 7.348e22)
+    x_0 = 0.3
+    Y_0 = np.array((x_0 - pi_2, 0, 0, 0, np.sqrt((1 - pi_2) / x_0) - x_0, 0))
+    t_end = 100
+    print(f"CR3BP orbit of the Earth to t = {t_end}: largest Jacobi constant error")
+    print(header)
+    for order, h in ((2, 0.01), (4, 0.04), (6, 0.08)):
+        start = time.perf_counter()
+        t, y, stats = implicit_midpoint(
+            nondim_cr3bp, nondim_cr3bp_jac, Y_0, t_end, h, order, (pi_2,)
+        )
+        seconds = time.perf_counter() - start
+        name = f"midpoint order {order}, h = {h}"
+        print_row(name, stats["nfev"], seconds, *drift(jacobi_constant(y, pi_2)))
+    # The default tolerances of solve_ivp, which the notes start from, and tighter
+    for rtol, atol in ((1e-3, 1e-6), (1e-6, 1e-6), (1e-9, 1e-9)):
+        start = time.perf_counter()
+        sol = solve_ivp(
+            nondim_cr3bp, (0, t_end), Y_0, rtol=rtol, atol=atol, args=(pi_2,)
+        )
+        seconds = time.perf_counter() - start
+        name = f"RK45, rtol {rtol:.0e}"
+        print_row(name, sol.nfev, seconds, *drift(jacobi_constant(sol.y, pi_2)))
+    print_crossover(
+        "midpoint order 4, h = 0.04", "RK45, rtol 1e-09", t_end, "time units"
+    )
@@ -1,41 +1,258 @@
+import ast
 from pathlib import Path
 from textwrap import dedent
 
 import yaml
 from doit.action import CmdAction
 
+from _ext import build_profile
 from raw_svg import render_math_svg
 
 HERE = Path(__file__).parent
 DOIT_CONFIG = {"default_tasks": ["build_jb"]}
+# Suffixes of the data files that the chapter scripts read or write
+DATA_SUFFIXES = {
+    ".bpc",
+    ".bsp",
+    ".csv",
+    ".html",
+    ".json",
+    ".npy",
+    ".npz",
+    ".pck",
+    ".png",
+    ".svg",
+    ".tpc",
+    ".txt",
+}
+# Functions and methods that write the file they are given
+WRITE_CALLS = {
+    "dump",
+    "save",
+    "savefig",
+    "savetxt",
+    "savez",
+    "savez_compressed",
+    "to_csv",
+    "write_bytes",
+    "write_html",
+    "write_image",
+    "write_text",
+}
+# Files outside the chapter folders that affect the built book
+BOOK_FILES = [
+    "_config.yml",
+    "_toc.yml",
+    "intro.md",
+    "bibliography.md",
+    "references.bib",
+    "raw_svg/prerender_math.py",
+    "raw_svg/render_math_svg.py",
+]
+BOOK_FOLDERS = ["_ext", "_static", "images"]
+# Folders of installed packages, which never affect the built book
+SKIPPED_FOLDERS = {"node_modules"}
 
 
 def task_svg_math():
-    for svg_file in HERE.glob("raw_svg/*.svg"):
-        target = render_math_svg.OUTPUT / svg_file.name
-        yield {
-            "name": svg_file.name,
-            "actions": [(render_math_svg.main, [svg_file])],
-            "targets": [target],
-            "file_dep": [svg_file, render_math_svg.__file__],
-        }
+    svg_files = sorted(HERE.glob("raw_svg/*.svg"))
+    return {
+        "actions": [(render_math_svg.render_all, [svg_files])],
+        "targets": [render_math_svg.OUTPUT / svg_file.name for svg_file in svg_files],
+        "file_dep": [*svg_files, render_math_svg.__file__],
+        "params": [
+            {
+                "name": "processes",
+                "long": "processes",
+                "type": int,
+                "default": None,
+                "help": "Number of worker processes to render files with",
+            },
+            {
+                "name": "force",
+                "long": "force",
+                "type": bool,
+                "default": False,
+                "help": "Render all files, even if they have not changed",
+            },
+            {
+                "name": "max_workers",
+                "long": "max-workers",
+                "type": int,
+                "default": render_math_svg.MAX_WORKERS,
+                "help": "Number of concurrent requests to the math API",
+            },
+            {
+                "name": "retries",
+                "long": "retries",
+                "type": int,
+                "default": render_math_svg.RETRIES,
+                "help": "Number of times to retry a failed request",
+            },
+            {
+                "name": "dedupe",
+                "long": "dedupe",
+                "type": bool,
+                "default": False,
+                "help": "Store repeated expressions once per file and reference them",
+            },
+            {
+                "name": "optimize",
+                "long": "optimize",
+                "type": bool,
+                "default": False,
+                "help": "Remove editor data and round numbers in the output files",
+            },
+            {
+                "name": "precision",
+                "long": "precision",
+                "type": int,
+                "default": render_math_svg.PRECISION,
+                "help": "Decimal places kept in paths and transforms when optimizing",
+            },
+            {
+                "name": "renderer",
+                "long": "renderer",
+                "type": str,
+                "default": render_math_svg.RENDERER,
+                "choices": tuple(
+                    (name, "") for name in sorted(render_math_svg.RENDERERS)
+                ),
+                "help": "Render math with the math API (http) or a MathJax process",
+            },
+        ],
+        "verbosity": 2,
+    }
 
 
 def task_clean_svg_cache():
     return {
         "actions": [(render_math_svg.clean_cache)],
-        "file_dep": [render_math_svg.CACHE.resolve()],
+        "uptodate": [not render_math_svg.CACHE.exists()],
+    }
+
+
+def task_evict_svg_cache():
+    """Remove least recently used or old entries from the math cache."""
+    return {
+        "actions": [(render_math_svg.evict_cache)],
+        "params": [
+            {
+                "name": "max_entries",
+                "long": "max-entries",
+                "type": int,
+                "default": None,
+                "help": "Keep at most this many of the most recently used entries",
+            },
+            {
+                "name": "max_age",
+                "long": "max-age",
+                "type": float,
+                "default": None,
+                "help": "Remove entries not used in this many seconds",
+            },
+        ],
+        "uptodate": [False],
+        "verbosity": 2,
+    }
+
+
+def task_svg_cache_stats():
+    """Print the hit and miss statistics of the math cache."""
+    return {
+        "actions": [(render_math_svg.print_cache_stats)],
+        "uptodate": [False],
+        "verbosity": 2,
+    }
+
+
+def invalidate_page_cache(pages):
+    # Importing the extension loads Sphinx and MyST-NB, which is slow, so only
+    # do it when the task runs
+    from _ext import page_cache
+
+    page_cache.invalidate_cache(pages)
+
+
+def task_clean_page_cache():
+    """Remove the cached outputs of the given pages, or of all the pages."""
+    return {
+        "actions": [(invalidate_page_cache,)],
+        "params": [
+            {
+                "name": "pages",
+                "short": "p",
+                "long": "page",
+                "type": list,
+                "default": [],
+                "help": "Page to remove, such as the-n-body-problem/jacobi-constant",
+            },
+        ],
+        "uptodate": [False],
+        "verbosity": 2,
     }
 
 
+def book_sources():
+    """Return the files that the book is built from.
+
+    These are the pages and everything else in the chapter folders, such as the
+    scripts and their data, plus the config, static files, and images. Only the
+    pages are taken from the top-level folder, and caches, build outputs, and
+    installed packages are skipped. Changes to the installed packages are not
+    tracked, use ``doit build_jb -a`` to force a build after updating them.
+    """
+    sources = {HERE / name for name in BOOK_FILES}
+    for folder in [*read_toc(), *BOOK_FOLDERS]:
+        if Path(folder) == Path("."):
+            sources.update(HERE.glob("*.md"))
+            sources.update(HERE.glob("*.ipynb"))
+            continue
+        for path in (HERE / folder).rglob("*"):
+            parts = path.relative_to(HERE).parts
+            if path.is_file() and not any(
+                part.startswith((".", "_build", "__pycache__"))
+                or part in SKIPPED_FOLDERS
+                for part in parts
+            ):
+                sources.add(path)
+    return sorted(path for path in sources if path.exists())
+
+
 def task_build_jb():
     return {
-        "actions": [["jb", "build", "."]],
+        "actions": [["jb", "build", "."], (build_profile.finish_build,)],
         "task_dep": [
             "svg_math",
             "execute_python_scripts",
             # "execute_matlab_scripts",
         ],
+        "file_dep": book_sources(),
+        "targets": [HERE / "_build" / "html" / "index.html"],
+        "verbosity": 2,
+    }
+
+
+def task_profile_report():
+    """Print the slowest cells of the last build and any regressions."""
+    return {
+        "actions": [(build_profile.print_report,)],
+        "params": [
+            {
+                "name": "top",
+                "long": "top",
+                "type": int,
+                "default": 10,
+                "help": "Number of the slowest cells to show",
+            },
+            {
+                "name": "n_previous",
+                "long": "previous",
+                "type": int,
+                "default": build_profile.N_PREVIOUS,
+                "help": "Number of previous builds to compare each page against",
+            },
+        ],
         "uptodate": [False],
         "verbosity": 2,
     }
@@ -67,19 +284,75 @@ def read_toc():
     return folders
 
 
+def call_name(node):
+    """Return the name of the function or method called by ``node``."""
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+
+def script_files(script):
+    """Find the files that ``script`` reads and writes by inspecting its source.
+
+    Strings in function calls that name a data file in the folder of the script
+    are inputs, unless they are passed to one of the ``WRITE_CALLS``, in which
+    case they are outputs. Modules imported from the folder of the script are
+    also inputs.
+    """
+    folder = script.parent
+    tree = ast.parse(script.read_text(encoding="utf-8"), filename=str(script))
+    inputs, outputs = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules = [node.module]
+        else:
+            modules = []
+        for module in modules:
+            module_file = folder / f"{module.split('.')[0]}.py"
+            if module_file.exists():
+                inputs.add(module_file)
+
+        if not isinstance(node, ast.Call):
+            continue
+        files = outputs if call_name(node) in WRITE_CALLS else inputs
+        for arg in [*node.args, *(keyword.value for keyword in node.keywords)]:
+            for child in ast.walk(arg):
+                if isinstance(child, ast.Constant) and isinstance(child.value, str):
+                    path = folder / child.value
+                    if path.suffix in DATA_SUFFIXES and path.parent == folder:
+                        files.add(path)
+    return sorted(inputs - outputs), sorted(outputs)
+
+
 def task_execute_python_scripts():
+    """Run the chapter scripts whose source or input files have changed.
+
+    The scripts do not depend on each other, so they can run in parallel with
+    ``doit -n N``.
+    """
     folders = read_toc()
     scripts = set()
     for folder in folders:
         script_folder = folder.joinpath("scripts")
         if script_folder.is_dir():
             scripts.update(script_folder.glob("*.py"))
-    for script in scripts:
+    for script in sorted(scripts):
+        inputs, outputs = script_files(script)
         yield {
-            "actions": [CmdAction(f"python {script.name}", cwd=(HERE / script.parent))],
+            "actions": [
+                CmdAction(
+                    f'python "{build_profile.__file__}" run {script.name}',
+                    cwd=(HERE / script.parent),
+                )
+            ],
             "name": script.name,
             "verbosity": 2,
-            "file_dep": [script],
+            "file_dep": [script, *inputs],
+            "targets": outputs,
         }
 
 
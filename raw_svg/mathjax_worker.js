@@ -0,0 +1,63 @@
+// Persistent MathJax worker used by the "worker" renderer in render_math_svg.py.
+//
+// Reads requests from stdin and writes responses to stdout. Each message is a
+// line with the length of a JSON payload in bytes followed by the payload. A
+// request looks like {"latex": "...", "display": false} and the response is
+// either {"svg": "..."} or {"error": "..."}. The output matches the math API so
+// both renderers share the same cache.
+const { mathjax } = require("mathjax-full/js/mathjax.js");
+const { TeX } = require("mathjax-full/js/input/tex.js");
+const { SVG } = require("mathjax-full/js/output/svg.js");
+const { liteAdaptor } = require("mathjax-full/js/adaptors/liteAdaptor.js");
+const { RegisterHTMLHandler } = require("mathjax-full/js/handlers/html.js");
+const { AllPackages } = require("mathjax-full/js/input/tex/AllPackages.js");
+
+const PROLOG =
+  '<?xml version="1.0" standalone="no" ?>\n' +
+  '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.0//EN" ' +
+  '"http://www.w3.org/TR/2001/REC-SVG-20010904/DTD/svg10.dtd">\n';
+const STYLE =
+  "\n<style>\n  * {\n    fill: black;\n    background-color: transparent;\n  }\n</style>";
+
+// Anything MathJax logs must not end up in the responses
+console.log = console.error;
+
+const adaptor = liteAdaptor();
+RegisterHTMLHandler(adaptor);
+const document = mathjax.document("", {
+  InputJax: new TeX({ packages: AllPackages }),
+  OutputJax: new SVG({ fontCache: "none" }),
+});
+
+function render({ latex, display }) {
+  const node = document.convert(latex, { display, em: 16, ex: 8 });
+  const svg = adaptor.innerHTML(node);
+  const end = svg.indexOf(">") + 1;
+  return PROLOG + svg.slice(0, end) + STYLE + svg.slice(end);
+}
+
+function send(message) {
+  const payload = Buffer.from(JSON.stringify(message), "utf8");
+  process.stdout.write(`${payload.length}\n`);
+  process.stdout.write(payload);
+}
+
+let buffer = Buffer.alloc(0);
+process.stdin.on("data", (chunk) => {
+  buffer = Buffer.concat([buffer, chunk]);
+  for (;;) {
+    const newline = buffer.indexOf(10);
+    if (newline < 0) return;
+    const length = Number.parseInt(buffer.subarray(0, newline).toString(), 10);
+    const start = newline + 1;
+    if (buffer.length < start + length) return;
+    const request = JSON.parse(buffer.subarray(start, start + length).toString("utf8"));
+    buffer = buffer.subarray(start + length);
+    try {
+      send({ svg: render(request) });
+    } catch (error) {
+      send({ error: String(error.message || error) });
+    }
+  }
+});
+process.stdin.on("end", () => process.exit(0));
@@ -0,0 +1,222 @@
+"""Sphinx extension to render the math on each page to SVG when the book is built.
+
+The math is rendered by the same renderer and cache as the SVG figures, so readers
+do not have to wait for MathJax to typeset the page. Any expression that cannot be
+rendered falls back to MathJax, which is then loaded only on the pages that need it.
+"""
+
+import html
+import json
+import re
+from typing import Any
+
+import requests
+from docutils import nodes
+from render_math_svg import (
+    HOST,
+    MAX_WORKERS,
+    RENDERER,
+    RENDERERS,
+    RETRIES,
+    HTTPRenderer,
+    RenderError,
+    WorkerRenderer,
+    fetch_many,
+    load_cache,
+)
+from sphinx.application import Sphinx
+from sphinx.ext import mathjax
+from sphinx.locale import _
+from sphinx.util import logging
+from sphinx.util.math import get_node_equation_number, wrap_displaymath
+from sphinx.writers.html5 import HTML5Translator
+
+logger = logging.getLogger(__name__)
+
+# Timeout in seconds of each request to the math API
+TIMEOUT = 10.0
+XML_PROLOG_REGEX = re.compile(r"<\?xml.*?\?>|<!DOCTYPE.*?>", re.DOTALL)
+STYLE_REGEX = re.compile(r"<style>.*?</style>", re.DOTALL)
+# MathJax marks expressions it could not parse instead of failing the request
+ERROR_REGEX = re.compile(r"data-mjx-error|data-mml-node=\"merror\"")
+
+# The cache, the renderer used to fetch missing expressions, the macro
+# definitions, and the pages that fell back to MathJax in this process
+_STATE: dict[str, Any] = {}
+
+
+def macro_definitions(app: Sphinx) -> dict[str, str]:
+    """Convert the MathJax macros in the config into ``\\newcommand`` definitions.
+
+    The math API does not know about the macros defined for the book, so the
+    definitions of the macros used by an expression are prepended to it.
+    """
+    config = app.config.mathjax3_config or {}
+    macros = config.get("tex", {}).get("macros", {})
+    definitions = {}
+    for name, macro in macros.items():
+        if isinstance(macro, str):
+            definitions[name] = rf"\newcommand{{\{name}}}{{{macro}}}"
+        else:
+            body, n_args, *_ = macro
+            definitions[name] = rf"\newcommand{{\{name}}}[{n_args}]{{{body}}}"
+    return definitions
+
+
+def math_source(app: Sphinx, node: nodes.math | nodes.math_block) -> str:
+    """Return the TeX sent to the math API for ``node``."""
+    if isinstance(node, nodes.math_block) and not node["nowrap"]:
+        latex = wrap_displaymath(node.astext(), None, False)
+    else:
+        latex = node.astext()
+    preamble = "".join(
+        definition
+        for name, definition in _STATE["macros"].items()
+        if re.search(rf"\\{name}(?![A-Za-z])", latex)
+    )
+    return preamble + latex
+
+
+def get_svg(app: Sphinx, node: nodes.math | nodes.math_block) -> str | None:
+    """Return the cached SVG for ``node`` as inline HTML, or ``None`` if there is
+    no usable rendering.
+    """
+    display = isinstance(node, nodes.math_block)
+    content = _STATE["cache"].get(math_source(app, node), display)
+    if content is None or ERROR_REGEX.search(content):
+        return None
+    # The style element sets the fill of everything on the page when the SVG is
+    # inline, so remove it and let the math use the color of the text.
+    svg = STYLE_REGEX.sub("", XML_PROLOG_REGEX.sub("", content)).strip()
+    label = html.escape(node.astext(), quote=True)
+    return svg.replace("<svg ", f'<svg aria-label="{label}" ', 1)
+
+
+def fall_back(self: HTML5Translator) -> None:
+    _STATE["fallback_pages"].add(self.builder.current_docname)
+
+
+def html_visit_math(self: HTML5Translator, node: nodes.math) -> None:
+    svg = get_svg(self.builder.app, node)
+    if svg is None:
+        fall_back(self)
+        mathjax.html_visit_math(self, node)
+    self.body.append(self.starttag(node, "span", "", CLASS="math notranslate"))
+    self.body.append(svg + "</span>")
+    raise nodes.SkipNode
+
+
+def html_visit_displaymath(self: HTML5Translator, node: nodes.math_block) -> None:
+    svg = get_svg(self.builder.app, node)
+    if svg is None:
+        fall_back(self)
+        mathjax.html_visit_displaymath(self, node)
+    self.body.append(self.starttag(node, "div", CLASS="math notranslate"))
+    self.body.append("<p>")
+    if node["number"]:
+        number = get_node_equation_number(self, node)
+        self.body.append(f'<span class="eqno">({number})')
+        self.add_permalink_ref(node, _("Link to this equation"))
+        self.body.append("</span>")
+    self.body.append(svg + "</p>\n</div>\n")
+    raise nodes.SkipNode
+
+
+def init_state(app: Sphinx) -> None:
+    _STATE["macros"] = macro_definitions(app)
+    _STATE["cache"] = load_cache()
+    _STATE["fallback_pages"] = set()
+    name = app.config.prerender_math_renderer
+    if name not in RENDERERS:
+        raise ValueError(f"Unknown renderer {name!r}, choose from {sorted(RENDERERS)}")
+    if name == "worker":
+        renderer = WorkerRenderer(
+            n_workers=app.config.prerender_math_max_workers, retries=RETRIES
+        )
+    else:
+        renderer = HTTPRenderer(
+            app.config.prerender_math_host,
+            app.config.prerender_math_max_workers,
+            RETRIES,
+            app.config.prerender_math_timeout,
+        )
+    try:
+        renderer.render("x")
+    except (OSError, requests.RequestException, RenderError) as e:
+        logger.warning(
+            "The %s math renderer is not available, only cached math will be "
+            "pre-rendered: %s",
+            name,
+            e,
+        )
+        renderer.close()
+        renderer = None
+    _STATE["renderer"] = renderer
+
+
+def prefetch_page_math(app: Sphinx, doctree: nodes.document, docname: str) -> None:
+    """Fetch the uncached math on a page concurrently before it is written."""
+    cache = _STATE["cache"]
+    renderer = _STATE["renderer"]
+    if renderer is None:
+        return
+    for node_type, display in ((nodes.math, False), (nodes.math_block, True)):
+        missing = set()
+        for node in doctree.findall(node_type):
+            source = math_source(app, node)
+            if not cache.has(source, display):
+                missing.add(source)
+        fetched = fetch_many(
+            sorted(missing),
+            cache,
+            renderer,
+            app.config.prerender_math_max_workers,
+            display=display,
+            ignore_errors=True,
+        )
+        n_failed = len(missing) - len(fetched)
+        if n_failed:
+            logger.warning(
+                "%d expressions on %s could not be rendered, MathJax will be used",
+                n_failed,
+                docname,
+            )
+
+
+def install_mathjax(
+    app: Sphinx, pagename: str, templatename: str, context: dict, event_arg: object
+) -> None:
+    """Load MathJax on the pages with math that could not be pre-rendered."""
+    fallback_pages = _STATE.get("fallback_pages")
+    if not fallback_pages or pagename not in fallback_pages:
+        return
+    if app.config.mathjax3_config:
+        body = f"window.MathJax = {json.dumps(app.config.mathjax3_config)}"
+        app.builder.add_js_file("", body=body)
+    app.builder.add_js_file(app.config.mathjax_path, defer="defer")
+
+
+def record_stats(app: Sphinx, exception: Exception | None) -> None:
+    if "cache" in _STATE:
+        _STATE["cache"].record_stats()
+    if _STATE.get("renderer") is not None:
+        _STATE["renderer"].close()
+
+
+def setup(app: Sphinx) -> dict:
+    # The MathJax renderer provides the fallback and its config values
+    app.setup_extension("sphinx.ext.mathjax")
+    app.add_html_math_renderer(
+        "prerender_math",
+        (html_visit_math, None),
+        (html_visit_displaymath, None),
+    )
+    app.add_config_value("prerender_math_renderer", RENDERER, "html")
+    app.add_config_value("prerender_math_host", HOST, "html")
+    app.add_config_value("prerender_math_max_workers", MAX_WORKERS, "html")
+    app.add_config_value("prerender_math_timeout", TIMEOUT, "html")
+    app.connect("builder-inited", init_state)
+    app.connect("doctree-resolved", prefetch_page_math)
+    app.connect("html-page-context", install_mathjax)
+    app.connect("build-finished", record_stats)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
@@ -1,20 +1,57 @@
+import argparse
+import copy
+import hashlib
 import json
+import os
+import queue
 import re
+import select
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import Any
 from xml.etree import ElementTree as ET
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HERE = Path(__file__).parent
 OUTPUT = HERE.parent / "images"
 # HOST = "https://math.vercel.app"
 HOST = "http://localhost:3000"
 PARAMS: dict[str, str | bytes | None] = {"from": None}
-CACHE = HERE / "mathjax_cache.json"
-CACHE_T = dict[str | bytes | None, str]
-SESSION = requests.Session()
+# Bump this when the output of the math API changes so that old entries are not used
+RENDERER_VERSION = "math-api-1"
+CACHE = HERE / "mathjax_cache"
+# The cache used to be one JSON file mapping expressions to SVG content
+LEGACY_CACHE = HERE / "mathjax_cache.json"
+# Hashes of the input files as of the last time they were rendered
+MANIFEST = HERE / "render_manifest.json"
+# Timings and sizes of the last run, and a summary line for every run
+REPORT = HERE / "render_report.json"
+REPORT_HISTORY = HERE / "render_history.jsonl"
+# The renderer used by default, either "http" to use the math API or "worker" to
+# use a persistent MathJax process started with WORKER_COMMAND
+RENDERER = "http"
+WORKER_COMMAND = ["node", str(HERE / "mathjax_worker.js")]
+# Seconds to wait for a worker process to answer before it is restarted
+WORKER_TIMEOUT = 30.0
+# Seconds to wait for the math API to connect or send data before the request is
+# retried
+HTTP_TIMEOUT = 30.0
+# Number of concurrent requests to the math API when prefetching
+MAX_WORKERS = 8
+# Number of times to retry a failed request and the base of the exponential backoff
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
 NAMESPACES = {
     "": "http://www.w3.org/2000/svg",
     "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
@@ -64,48 +101,580 @@ CC_META = """
 SIZE_REGEX = re.compile(r"([\d.]+)?(\w*)?")
 # Match a scaling factor in the class attribute
 SCALE_REGEX = re.compile(r"\bscale-([\d.]*)\b")
+# Namespaces of the drawing editors, which are not needed to display the images
+EDITOR_NAMESPACES = {NAMESPACES[prefix] for prefix in ("bx", "inkscape", "sodipodi")}
+# Elements whose whitespace is significant
+TEXT_TAGS = {"text", "tspan", "textPath", "title", "desc"}
+# Attributes whose numbers are rounded by the optimizer
+ROUNDED_ATTRIBUTES = {"d", "points", "transform"}
+# Number of decimal places kept by the optimizer
+PRECISION = 3
+# Match a number in path data or a transform
+NUMBER_REGEX = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+# Split path data into its commands and their arguments
+PATH_COMMAND_REGEX = re.compile(r"([MmLlHhVvCcSsQqTtAaZz])")
+# Positions of the large arc and sweep flags in each group of 7 arc arguments
+ARC_FLAGS = {3, 4}
+# Match anything that might refer to an element id, such as url(#id) or id.end
+ID_TOKEN_REGEX = re.compile(r"[A-Za-z_][\w-]*")
 
 
-def load_cache() -> CACHE_T:
-    if CACHE.exists():
-        cache = json.loads(CACHE.read_text())
-    else:
-        cache = {}
+class MathCache:
+    """Content-addressed cache of rendered math expressions.
+
+    Each entry is stored in its own file, named by a hash of the expression, the
+    request parameters, and the renderer version. Entries are sharded into
+    subdirectories by the first two characters of the hash. Writes go to a
+    temporary file that is atomically renamed into place, so several processes
+    can share the cache safely. The modification time of an entry is updated
+    when it is read, which is used for LRU eviction.
+    """
+
+    def __init__(self, directory: Path = CACHE) -> None:
+        self.directory = directory
+        self.stats = {"hits": 0, "misses": 0, "writes": 0}
+
+    @staticmethod
+    def key(value: str, display: bool = False) -> str:
+        key_data: dict[str, object] = {
+            "expression": value,
+            "params": PARAMS,
+            "renderer": RENDERER_VERSION,
+        }
+        if display:
+            key_data["display"] = True
+        payload = json.dumps(key_data, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, value: str, display: bool = False) -> Path:
+        key = self.key(value, display)
+        return self.directory / key[:2] / f"{key}.svg"
+
+    def __contains__(self, value: str) -> bool:
+        return self.path(value).exists()
+
+    def has(self, value: str, display: bool = False) -> bool:
+        return self.path(value, display).exists()
+
+    def get(self, value: str, display: bool = False) -> str | None:
+        path = self.path(value, display)
+        try:
+            content = path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return content
+
+    def __getitem__(self, value: str) -> str:
+        content = self.get(value)
+        if content is None:
+            raise KeyError(value)
+        return content
+
+    def __setitem__(self, value: str, content: str) -> None:
+        self.set(value, content)
+
+    def set(self, value: str, content: str, display: bool = False) -> None:
+        path = self.path(value, display)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_name, path)
+        self.stats["writes"] += 1
+
+    def entries(self) -> list[Path]:
+        return list(self.directory.glob("??/*.svg"))
+
+    def evict(
+        self, max_entries: int | None = None, max_age: float | None = None
+    ) -> int:
+        """Remove entries older than ``max_age`` seconds since they were last used,
+        then the least recently used entries beyond ``max_entries``.
+
+        Returns the number of entries removed.
+        """
+        entries = []
+        for path in self.entries():
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+        entries.sort(reverse=True)
+        keep = entries
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            keep = [(mtime, path) for mtime, path in keep if mtime >= cutoff]
+        if max_entries is not None:
+            keep = keep[:max_entries]
+        kept = {path for _, path in keep}
+        n_removed = 0
+        for _, path in entries:
+            if path not in kept:
+                path.unlink(missing_ok=True)
+                n_removed += 1
+        return n_removed
+
+    def record_stats(self) -> None:
+        """Append the hit and miss counts of this process to the stats log.
+
+        Each line is written with a single append, so concurrent processes do not
+        interleave their records.
+        """
+        if not any(self.stats.values()):
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        record = json.dumps({"time": time.time(), "pid": os.getpid(), **self.stats})
+        with self.directory.joinpath("stats.jsonl").open("a") as stats_file:
+            stats_file.write(record + "\n")
+        self.stats = dict.fromkeys(self.stats, 0)
+
+    def read_stats(self) -> dict[str, int]:
+        """Return the total hits, misses, and writes recorded in the stats log."""
+        totals = {"hits": 0, "misses": 0, "writes": 0}
+        stats_file = self.directory / "stats.jsonl"
+        if stats_file.exists():
+            for line in stats_file.read_text().splitlines():
+                record = json.loads(line)
+                for name in totals:
+                    totals[name] += record.get(name, 0)
+        return totals
+
+
+def migrate_legacy_cache(cache: MathCache) -> int:
+    """Move the entries of the old monolithic JSON cache into ``cache``.
+
+    The JSON file is removed afterwards so that the migration only happens once.
+    Returns the number of entries migrated.
+    """
+    if not LEGACY_CACHE.exists():
+        return 0
+    legacy: dict[str, str] = json.loads(LEGACY_CACHE.read_text())
+    for value, content in legacy.items():
+        if value not in cache:
+            cache[value] = content
+    LEGACY_CACHE.unlink()
+    return len(legacy)
+
+
+def load_cache() -> MathCache:
+    cache = MathCache()
+    migrate_legacy_cache(cache)
     return cache
 
 
-def write_cache(cache: CACHE_T) -> None:
-    if cache:
-        CACHE.write_text(json.dumps(cache))
+def evict_cache(max_entries: int | None = None, max_age: float | None = None) -> None:
+    n_removed = MathCache().evict(max_entries, max_age)
+    print(f"Removed {n_removed} entries from the math cache")
 
 
-def get_math_content(elem: ET.Element, cache: CACHE_T, s: requests.Session) -> str:
+def print_cache_stats() -> None:
+    stats = MathCache().read_stats()
+    lookups = stats["hits"] + stats["misses"]
+    ratio = stats["hits"] / lookups if lookups else 0.0
+    print(
+        f"Math cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"({ratio:.1%} hit ratio), {stats['writes']} writes"
+    )
+
+
+def make_session(
+    max_workers: int = MAX_WORKERS,
+    retries: int = RETRIES,
+    backoff_factor: float = BACKOFF_FACTOR,
+) -> requests.Session:
+    """Create a session with a connection pool sized for ``max_workers`` threads.
+
+    Failed connections and 5xx responses from the math API are retried with
+    exponential backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_math_value(elem: ET.Element) -> str:
     value = elem.text
     if value is None:
         value = elem[0].text
         if value is None:
             raise ValueError("Text of node cannot be 'None'", elem)
-    if value in cache:
-        content = cache[value]
-    else:
-        PARAMS["inline"] = value
-        r = s.get(HOST, params=PARAMS)
-        r.raise_for_status()
-        content = r.content.decode("utf-8")
+    return value
+
+
+def fetch_math(
+    value: str,
+    s: requests.Session,
+    display: bool = False,
+    host: str = HOST,
+    timeout: float = HTTP_TIMEOUT,
+) -> str:
+    """Render one expression with the math API.
+
+    Expressions are rendered inline unless ``display`` is ``True``.
+    """
+    params = {**PARAMS, "from" if display else "inline": value}
+    r = s.get(host, params=params, timeout=timeout)
+    r.raise_for_status()
+    return r.content.decode("utf-8")
+
+
+class RenderError(Exception):
+    """Raised when a renderer fails to render an expression."""
+
+
+class HTTPRenderer:
+    """Render math with the math API over HTTP."""
+
+    def __init__(
+        self,
+        host: str = HOST,
+        max_workers: int = MAX_WORKERS,
+        retries: int = RETRIES,
+        timeout: float = HTTP_TIMEOUT,
+    ) -> None:
+        self.host = host
+        self.timeout = timeout
+        self.session = make_session(max_workers, retries)
+
+    def render(self, value: str, display: bool = False) -> str:
+        return fetch_math(value, self.session, display, self.host, self.timeout)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class WorkerProcess:
+    """A long-lived MathJax process that renders one expression at a time.
+
+    Each message, in either direction, is a JSON object preceded by a line with
+    the length of the JSON in bytes. The process is started when it is first
+    needed and restarted if it has died. A process that does not answer within
+    ``timeout`` seconds is killed and a ``TimeoutError`` is raised.
+    """
+
+    def __init__(self, command: list[str], timeout: float = WORKER_TIMEOUT) -> None:
+        self.command = command
+        self.timeout = timeout
+        self.process: subprocess.Popen[bytes] | None = None
+        self.buffer = bytearray()
+
+    def start(self) -> subprocess.Popen[bytes]:
+        self.process = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=HERE
+        )
+        self.buffer.clear()
+        return self.process
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        if self.process.stdin is not None:
+            self.process.stdin.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def kill(self) -> None:
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def read(self, fd: int, size: int | None, deadline: float) -> bytes:
+        """Read one line, or ``size`` bytes, from ``fd`` before ``deadline``.
+
+        The pipe is read directly with `select`, instead of through the buffered
+        ``stdout`` of the process, so a read can time out.
+        """
+        while True:
+            if size is None:
+                end = self.buffer.find(b"\n") + 1
+            else:
+                end = size if len(self.buffer) >= size else 0
+            if end:
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError(f"The worker did not answer in {self.timeout} s")
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError("The worker process exited")
+            self.buffer += chunk
+
+    def request(self, message: dict[str, str | bool]) -> dict[str, str]:
+        process = self.process
+        if process is None or process.poll() is not None:
+            process = self.start()
+        assert process.stdin is not None and process.stdout is not None
+        payload = json.dumps(message).encode("utf-8")
+        process.stdin.write(f"{len(payload)}\n".encode() + payload)
+        process.stdin.flush()
+        fd = process.stdout.fileno()
+        deadline = time.monotonic() + self.timeout
+        try:
+            header = self.read(fd, None, deadline)
+            return json.loads(self.read(fd, int(header), deadline))
+        except TimeoutError:
+            self.kill()
+            raise
+
+
+class WorkerRenderer:
+    """Render math with a pool of persistent MathJax worker processes.
+
+    This avoids the overhead of an HTTP request for every expression. Each
+    process handles one request at a time, so up to ``n_workers`` expressions
+    are rendered concurrently. A process that dies, or does not answer within
+    ``timeout`` seconds, is restarted and the request is retried up to
+    ``retries`` times.
+    """
+
+    def __init__(
+        self,
+        command: list[str] = WORKER_COMMAND,
+        n_workers: int = MAX_WORKERS,
+        retries: int = RETRIES,
+        timeout: float = WORKER_TIMEOUT,
+    ) -> None:
+        self.retries = retries
+        self.workers: queue.Queue[WorkerProcess] = queue.Queue()
+        self.processes = [WorkerProcess(command, timeout) for _ in range(n_workers)]
+        for worker in self.processes:
+            self.workers.put(worker)
+
+    def render(self, value: str, display: bool = False) -> str:
+        worker = self.workers.get()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = worker.request({"latex": value, "display": display})
+                    break
+                except (OSError, EOFError, ValueError):
+                    worker.stop()
+                    if attempt == self.retries:
+                        raise RenderError(f"The worker failed to render {value!r}")
+        finally:
+            self.workers.put(worker)
+        if "error" in response:
+            raise RenderError(response["error"])
+        return response["svg"]
+
+    def close(self) -> None:
+        for worker in self.processes:
+            worker.stop()
+
+
+MathRenderer = HTTPRenderer | WorkerRenderer
+RENDERERS = {"http": HTTPRenderer, "worker": WorkerRenderer}
+
+
+def make_renderer(
+    name: str = RENDERER, max_workers: int = MAX_WORKERS, retries: int = RETRIES
+) -> MathRenderer:
+    """Create the renderer called ``name``, either ``"http"`` or ``"worker"``."""
+    if name == "worker":
+        return WorkerRenderer(n_workers=max_workers, retries=retries)
+    elif name == "http":
+        return HTTPRenderer(max_workers=max_workers, retries=retries)
+    raise ValueError(f"Unknown renderer {name!r}, choose from {sorted(RENDERERS)}")
+
+
+def fetch_many(
+    values: Iterable[str],
+    cache: MathCache,
+    renderer: MathRenderer,
+    max_workers: int = MAX_WORKERS,
+    display: bool = False,
+    ignore_errors: bool = False,
+    timings: dict[str, float] | None = None,
+) -> list[str]:
+    """Render ``values`` concurrently with up to ``max_workers`` threads.
+
+    The results are stored in ``cache``. If ``ignore_errors`` is ``True``,
+    expressions that fail to render are skipped instead of raising the error.
+    If ``timings`` is given, the time in seconds taken to render each expression
+    is stored in it. Returns the expressions that were rendered.
+    """
+
+    def fetch(value: str) -> tuple[str | None, float]:
+        start = time.perf_counter()
+        try:
+            content = renderer.render(value, display)
+        except (requests.RequestException, RenderError):
+            if ignore_errors:
+                return None, time.perf_counter() - start
+            raise
+        return content, time.perf_counter() - start
+
+    values = list(values)
+    fetched = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for value, (content, seconds) in zip(values, executor.map(fetch, values)):
+            if timings is not None:
+                timings[value] = seconds
+            if content is not None:
+                cache.set(value, content, display)
+                fetched.append(value)
+    return fetched
+
+
+def get_math_content(elem: ET.Element, cache: MathCache, renderer: MathRenderer) -> str:
+    value = get_math_value(elem)
+    content = cache.get(value)
+    if content is None:
+        content = renderer.render(value)
         cache[value] = content
     return content
 
 
 def clean_cache() -> None:
     if CACHE.exists():
-        CACHE.unlink()
+        shutil.rmtree(CACHE)
+    if LEGACY_CACHE.exists():
+        LEGACY_CACHE.unlink()
+
+
+def find_search_elements(svg_element: ET.Element) -> list[ET.Element]:
+    """Return the elements whose direct ``text`` children may contain math."""
+    search_elements = [svg_element]
+    g_elem = svg_element.find("g", NAMESPACES)
+    if g_elem is not None:
+        search_elements.append(g_elem)
+    return search_elements
+
 
+def find_math_elements(search_elem: ET.Element) -> list[ET.Element]:
+    return [
+        elem
+        for elem in search_elem.findall("text", NAMESPACES)
+        if "math" in elem.get("class", "")
+    ]
 
-def replace_text(search_elem: ET.Element, cache: CACHE_T) -> None:
-    for elem in search_elem.findall("text", NAMESPACES):
-        if "math" not in elem.get("class", ""):
+
+def collect_expressions(
+    svg_files: Iterable[Path], cache: MathCache | None = None
+) -> set[str]:
+    """Scan all the SVG files and return the unique expressions not in the cache.
+
+    If ``cache`` is ``None``, all the unique expressions are returned.
+    """
+    expressions = set()
+    for svg_file in svg_files:
+        try:
+            svg_element = ET.parse(svg_file).getroot()
+        except ET.ParseError:
+            # The error is reported when the file is rendered
             continue
-        content = get_math_content(elem, cache, SESSION)
+        for search_elem in find_search_elements(svg_element):
+            for elem in find_math_elements(search_elem):
+                value = get_math_value(elem)
+                if cache is None or value not in cache:
+                    expressions.add(value)
+    return expressions
+
+
+def prefetch(
+    svg_files: Iterable[Path],
+    cache: MathCache,
+    renderer: MathRenderer,
+    max_workers: int = MAX_WORKERS,
+    ignore_errors: bool = False,
+) -> dict[str, Any]:
+    """Render every uncached expression in ``svg_files`` concurrently.
+
+    The results are stored in ``cache``. If ``ignore_errors`` is ``True``,
+    expressions that fail to render are skipped, and the error is raised again
+    when the file that contains them is rendered. Returns the number of unique
+    expressions, how many were already cached, and the time taken and size of
+    each expression that was rendered.
+    """
+    expressions = collect_expressions(svg_files)
+    missing = sorted(value for value in expressions if value not in cache)
+    timings: dict[str, float] = {}
+    if missing:
+        fetched = fetch_many(
+            missing,
+            cache,
+            renderer,
+            max_workers,
+            ignore_errors=ignore_errors,
+            timings=timings,
+        )
+        timings = {value: timings[value] for value in fetched}
+    return {
+        "expressions": len(expressions),
+        "hits": len(expressions) - len(missing),
+        "misses": len(missing),
+        "fetched": [
+            {
+                "expression": value,
+                "seconds": seconds,
+                "bytes": len(cache.path(value).read_bytes()),
+            }
+            for value, seconds in sorted(
+                timings.items(), key=lambda item: item[1], reverse=True
+            )
+        ],
+    }
+
+
+def make_symbol(math: ET.Element, symbol_id: str) -> ET.Element:
+    """Convert a rendered math ``svg`` element into a ``symbol`` for reuse.
+
+    The math API output includes a ``style`` element that sets the fill color
+    of everything inside the image. Inside the ``defs`` of the document it would
+    apply to the whole drawing, so it is dropped and the color that the paths
+    use as ``currentColor`` is set on the symbol instead.
+    """
+    symbol = ET.Element("symbol", attrib={"id": symbol_id, "color": "black"})
+    view_box = math.get("viewBox")
+    if view_box is not None:
+        symbol.set("viewBox", view_box)
+    for child in math:
+        if child.tag != f"{{{NAMESPACES['']}}}style":
+            symbol.append(child)
+    symbol.tail = "\n  "
+    return symbol
+
+
+def replace_text(
+    search_elem: ET.Element,
+    cache: MathCache,
+    renderer: MathRenderer,
+    defs: ET.Element | None = None,
+) -> int:
+    """Replace the math text in ``search_elem`` with the rendered math.
+
+    By default, each expression is embedded as a data URI in an ``image``
+    element. If ``defs`` is given, each distinct expression is instead stored
+    once as a ``symbol`` in ``defs`` and referenced by ``use`` elements. Returns
+    the number of bytes saved by referencing the symbols.
+    """
+    bytes_saved = 0
+    for elem in find_math_elements(search_elem):
+        content = get_math_content(elem, cache, renderer)
 
         x_loc = elem.get("x")
         y_loc = elem.get("y")
@@ -143,25 +712,51 @@ def replace_text(search_elem: ET.Element, cache: CACHE_T) -> None:
             },
         )
         image_element.tail = "\n  "
-        search_elem.append(image_element)
-        search_elem.remove(elem)
+        if defs is None:
+            search_elem.append(image_element)
+            search_elem.remove(elem)
+            continue
 
+        bytes_saved += len(ET.tostring(image_element, encoding="unicode"))
+        symbol_id = "math-" + MathCache.key(get_math_value(elem))[:12]
+        if defs.find(f"symbol[@id='{symbol_id}']") is None:
+            symbol = make_symbol(math, symbol_id)
+            defs.append(symbol)
+            bytes_saved -= len(ET.tostring(symbol, encoding="unicode"))
+        use_element = ET.Element(
+            "use",
+            attrib={
+                "x": x_loc,
+                "y": y_loc,
+                "height": height,
+                "width": width,
+                "href": f"#{symbol_id}",
+            },
+        )
+        use_element.tail = "\n  "
+        bytes_saved -= len(ET.tostring(use_element, encoding="unicode"))
+        search_elem.append(use_element)
+        search_elem.remove(elem)
+    return bytes_saved
 
-def main(svg_file: Path | None = None) -> None:
-    if svg_file is None:
-        for svg_f in HERE.glob("*.svg"):
-            main(svg_f)
-            return
 
+def register_namespaces() -> None:
     for prefix, uri in NAMESPACES.items():
         ET.register_namespace(prefix, uri)
 
+
+def load_cc_metadata() -> ET.Element:
     # The 'root' element is only needed to declare the namespaces for parsing,
     # so retrieve just the metadata element here.
     CC_XML = ET.fromstring(CC_META).find("metadata")
     if CC_XML is None:
         raise ValueError("Something went horribly wrong finding the metadata")
+    return CC_XML
+
 
+def file_metadata(cc_metadata: ET.Element, name: str) -> ET.Element:
+    """Return a copy of the CC metadata with the title and date filled in."""
+    CC_XML = copy.deepcopy(cc_metadata)
     RDF = CC_XML.find("rdf:RDF", NAMESPACES)
     if RDF is None:
         raise ValueError("Could not find RDF tag")
@@ -170,19 +765,190 @@ def main(svg_file: Path | None = None) -> None:
         raise ValueError("Could not find Work tag")
     title = Work.find("dc:title", NAMESPACES)
     if title is None:
-        ET.SubElement(Work, "dc:title", text=svg_file.name)
+        ET.SubElement(Work, "dc:title", text=name)
     else:
-        title.text = svg_file.name
+        title.text = name
     date = Work.find("dc:date", NAMESPACES)
     today = datetime.today().isoformat()
     if date is None:
         ET.SubElement(Work, "dc:date", text=today)
     else:
         date.text = today
+    return CC_XML
 
-    cache = load_cache()
+
+def split_tag(tag: str) -> tuple[str, str]:
+    """Split an ElementTree tag or attribute name into its namespace and name."""
+    if tag.startswith("{"):
+        namespace, _, name = tag[1:].partition("}")
+        return namespace, name
+    return "", tag
+
+
+def round_numbers(value: str, precision: int) -> str:
+    """Round all the numbers in a path, points, or transform attribute."""
+
+    def format_number(match: re.Match[str]) -> str:
+        number = f"{round(float(match.group()), precision):.{precision}f}"
+        if "." in number:
+            number = number.rstrip("0").rstrip(".")
+        if number == "-0":
+            number = "0"
+        # Numbers like "1.5.5" are separated only by the second decimal point, so
+        # keep them apart if rounding removed it
+        start = match.start()
+        if start and (value[start - 1].isdigit() or value[start - 1] == "."):
+            number = " " + number
+        return number
+
+    return NUMBER_REGEX.sub(format_number, value)
+
+
+def round_arc(args: str, precision: int) -> str:
+    """Round the arguments of an arc command in path data.
+
+    The large arc and sweep flags are single characters that may be written
+    without separators, as in ``a1 1 0 011 2``, so they are read one character at
+    a time and kept as they are. Arguments that cannot be parsed are returned
+    unchanged.
+    """
+    tokens: list[str] = []
+    i = 0
+    while True:
+        while i < len(args) and (args[i].isspace() or args[i] == ","):
+            i += 1
+        if i == len(args):
+            return " ".join(tokens)
+        if len(tokens) % 7 in ARC_FLAGS:
+            if args[i] not in "01":
+                return args
+            tokens.append(args[i])
+            i += 1
+        else:
+            match = NUMBER_REGEX.match(args, i)
+            if match is None:
+                return args
+            tokens.append(round_numbers(match.group(), precision))
+            i = match.end()
+
+
+def round_path(value: str, precision: int) -> str:
+    """Round all the numbers in path data, except the flags of arc commands."""
+    parts = PATH_COMMAND_REGEX.split(value)
+    rounded = [round_numbers(parts[0], precision)]
+    for command, args in zip(parts[1::2], parts[2::2], strict=True):
+        rounded.append(command)
+        if command in "Aa":
+            rounded.append(round_arc(args, precision))
+        else:
+            rounded.append(round_numbers(args, precision))
+    return "".join(rounded)
+
+
+def merge_styles(svg_element: ET.Element, style_parent: ET.Element) -> None:
+    """Replace ``style`` attributes that are used more than once with classes.
+
+    The classes are defined in a new ``style`` element in ``style_parent``.
+    """
+    counts = Counter(
+        elem.get("style") for elem in svg_element.iter() if elem.get("style")
+    )
+    class_names = {}
+    for style, count in counts.items():
+        if count > 1:
+            class_names[style] = f"s{len(class_names)}"
+    if not class_names:
+        return
+    for elem in svg_element.iter():
+        style = elem.get("style")
+        if style not in class_names:
+            continue
+        del elem.attrib["style"]
+        classes = elem.get("class", "").split()
+        elem.set("class", " ".join([*classes, class_names[style]]))
+    style_elem = ET.Element("style")
+    style_elem.text = "".join(
+        f".{name}{{{style}}}" for style, name in class_names.items()
+    )
+    style_parent.insert(0, style_elem)
+
+
+def optimize_svg(svg_element: ET.Element, precision: int = PRECISION) -> None:
+    """Reduce the size of a rendered SVG without changing how it is displayed.
+
+    Elements and attributes from the drawing editors, ``data-*`` attributes, and
+    ``id`` attributes that are not referenced are removed. Numbers in path data
+    and transforms are rounded to ``precision`` decimal places, identical
+    ``style`` attributes are merged into classes, and whitespace between elements
+    is removed. The license metadata is kept.
+    """
+    parents = {child: parent for parent in svg_element.iter() for child in parent}
+    for elem in list(parents):
+        if split_tag(elem.tag)[0] in EDITOR_NAMESPACES:
+            parents[elem].remove(elem)
+
+    references = set()
+    for elem in svg_element.iter():
+        for name, value in elem.attrib.items():
+            if name != "id":
+                references.update(ID_TOKEN_REGEX.findall(value))
+        if split_tag(elem.tag)[1] == "style" and elem.text:
+            references.update(ID_TOKEN_REGEX.findall(elem.text))
+
+    for elem in svg_element.iter():
+        for name in list(elem.attrib):
+            namespace, local_name = split_tag(name)
+            if namespace in EDITOR_NAMESPACES or local_name.startswith("data-"):
+                del elem.attrib[name]
+            elif name == "id":
+                # Keep identifiers that cannot be matched as a single token
+                element_id = elem.attrib[name]
+                if element_id not in references and ID_TOKEN_REGEX.fullmatch(
+                    element_id
+                ):
+                    del elem.attrib[name]
+            elif name == "d":
+                elem.set(name, round_path(elem.attrib[name], precision))
+            elif name in ROUNDED_ATTRIBUTES:
+                elem.set(name, round_numbers(elem.attrib[name], precision))
+
+    defs_elem = svg_element.find("defs", NAMESPACES)
+    if defs_elem is None:
+        defs_elem = svg_element.find("defs")
+    merge_styles(svg_element, defs_elem if defs_elem is not None else svg_element)
+
+    for elem in svg_element.iter():
+        if split_tag(elem.tag)[1] in TEXT_TAGS:
+            continue
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        for child in elem:
+            if child.tail is not None and not child.tail.strip():
+                child.tail = None
+
+
+def render_svg(
+    svg_file: Path,
+    cc_metadata: ET.Element,
+    cache: MathCache,
+    renderer: MathRenderer,
+    dedupe: bool = False,
+    optimize: bool = False,
+    precision: int = PRECISION,
+) -> dict[str, float]:
+    """Render the math in ``svg_file`` and write the result to the output directory.
+
+    If ``dedupe`` is ``True``, repeated expressions are stored once in the
+    ``defs`` of the document. If ``optimize`` is ``True``, the output is passed
+    through `optimize_svg` with the given ``precision``.
+
+    Returns the size of the output file, the number of bytes saved by
+    deduplicating the math, the size of the output before it was optimized, the
+    number of math expressions, and the time in seconds spent in each step.
+    """
     assert OUTPUT.exists() and OUTPUT.is_dir(), "The 'images' directory must exist"
 
+    start = time.perf_counter()
     svg_tree = ET.parse(svg_file)
     svg_element = svg_tree.getroot()
     if svg_element.get("height") is None or svg_element.get("width") is None:
@@ -199,33 +965,412 @@ def main(svg_file: Path | None = None) -> None:
         if font_def is not None:
             defs_elem.remove(font_def)
 
-    svg_element.insert(1, CC_XML)
+    svg_element.insert(1, file_metadata(cc_metadata, svg_file.name))
 
-    search_elements = [svg_element]
-    g_elem = svg_element.find("g", NAMESPACES)
-    if g_elem is not None:
-        search_elements.append(g_elem)
+    math_defs = None
+    if dedupe:
+        math_defs = defs_elem
+        if math_defs is None:
+            math_defs = ET.Element("defs")
+            math_defs.tail = "\n  "
+            svg_element.insert(0, math_defs)
+
+    stats: dict[str, float] = {"dedupe_saved": 0, "expressions": 0}
+    checkpoint = time.perf_counter()
+    stats["parse_seconds"] = checkpoint - start
+    for elem in find_search_elements(svg_element):
+        stats["expressions"] += len(find_math_elements(elem))
+        stats["dedupe_saved"] += replace_text(elem, cache, renderer, math_defs)
+    stats["math_seconds"] = time.perf_counter() - checkpoint
 
-    for elem in search_elements:
-        replace_text(elem, cache)
-    svg_tree.write(
-        OUTPUT.joinpath(svg_file.name), encoding="unicode", xml_declaration=True
+    if optimize:
+        checkpoint = time.perf_counter()
+        stats["unoptimized_size"] = len(
+            ET.tostring(svg_element, encoding="utf-8", xml_declaration=True)
+        )
+        optimize_svg(svg_element, precision)
+        stats["optimize_seconds"] = time.perf_counter() - checkpoint
+    checkpoint = time.perf_counter()
+    output = ET.tostring(svg_element, encoding="utf-8", xml_declaration=True)
+    stats["serialize_seconds"] = time.perf_counter() - checkpoint
+    checkpoint = time.perf_counter()
+    OUTPUT.joinpath(svg_file.name).write_bytes(output)
+    stats["write_seconds"] = time.perf_counter() - checkpoint
+    stats["size"] = len(output)
+    return stats
+
+
+def format_stats(name: str, stats: dict[str, float]) -> str:
+    line = f"{name}: {stats['size']} bytes"
+    if "unoptimized_size" in stats:
+        before = stats["unoptimized_size"]
+        reduction = 1 - stats["size"] / before
+        line += f" ({before} bytes before optimizing, {reduction:.1%} smaller)"
+    if stats["dedupe_saved"]:
+        line += f", saved {stats['dedupe_saved']} bytes by deduplicating math"
+    return line
+
+
+def file_hash(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def load_manifest(options: dict[str, bool | int]) -> dict[str, str]:
+    """Return the input hashes of the files rendered with the current renderer.
+
+    The manifest is discarded if this script or the rendering ``options`` have
+    changed since it was written.
+    """
+    if not MANIFEST.exists():
+        return {}
+    manifest = json.loads(MANIFEST.read_text())
+    if (
+        manifest.get("renderer") != file_hash(Path(__file__))
+        or manifest.get("options") != options
+    ):
+        return {}
+    return manifest.get("files", {})
+
+
+def write_manifest(files: dict[str, str], options: dict[str, bool | int]) -> None:
+    manifest = {
+        "renderer": file_hash(Path(__file__)),
+        "options": options,
+        "files": files,
+    }
+    fd, tmp_name = tempfile.mkstemp(dir=MANIFEST.parent, suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp_file:
+        json.dump(manifest, tmp_file, indent=2, sort_keys=True)
+    os.replace(tmp_name, MANIFEST)
+
+
+def summarize_report(report: dict[str, Any]) -> dict[str, Any]:
+    """Return the totals of ``report`` without the per-file and expression data."""
+    files = report["files"].values()
+    steps = ("parse", "math", "optimize", "serialize", "write")
+    return {
+        "time": report["time"],
+        "seconds": report["seconds"],
+        "rendered": len(files),
+        "skipped": report["skipped"],
+        "failed": len(report["failed"]),
+        "expressions": report["cache"]["expressions"],
+        "hit_ratio": report["cache"]["hit_ratio"],
+        "fetched": len(report["fetched"]),
+        "bytes_fetched": sum(item["bytes"] for item in report["fetched"]),
+        "output_bytes": sum(stats["size"] for stats in files),
+        **{
+            f"{step}_seconds": sum(stats.get(f"{step}_seconds", 0.0) for stats in files)
+            for step in steps
+        },
+        **report["phases"],
+    }
+
+
+def write_report(report: dict[str, Any]) -> dict[str, Any]:
+    """Write ``report`` to the report file and append its summary to the history.
+
+    Returns the summary.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=REPORT.parent, suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp_file:
+        json.dump(report, tmp_file, indent=2)
+    os.replace(tmp_name, REPORT)
+    summary = summarize_report(report)
+    with REPORT_HISTORY.open("a") as history_file:
+        history_file.write(json.dumps(summary) + "\n")
+    return summary
+
+
+def format_summary(summary: dict[str, Any]) -> list[str]:
+    lines = [
+        f"Math: {summary['expressions']} expressions, "
+        f"{summary['hit_ratio']:.1%} cached, fetched {summary['fetched']} "
+        f"({summary['bytes_fetched']} bytes) in {summary['prefetch_seconds']:.2f} s",
+        f"Files: {summary['render_seconds']:.2f} s to render, "
+        f"{summary['output_bytes']} bytes written",
+    ]
+    if summary["rendered"]:
+        steps = ", ".join(
+            f"{step} {summary[f'{step}_seconds']:.2f} s"
+            for step in ("parse", "math", "optimize", "serialize", "write")
+        )
+        lines.append(f"  Time by step, summed over files: {steps}")
+    return lines
+
+
+# State shared by all the files rendered in one worker process, set up once by
+# init_worker() instead of for every file.
+_WORKER_STATE: dict[
+    str, ET.Element | MathCache | MathRenderer | dict[str, bool | int]
+] = {}
+
+
+def init_worker(options: dict[str, bool | int], renderer: str = RENDERER) -> None:
+    register_namespaces()
+    _WORKER_STATE["cc_metadata"] = load_cc_metadata()
+    _WORKER_STATE["cache"] = load_cache()
+    # The math has already been fetched, so one connection or process is enough
+    _WORKER_STATE["renderer"] = make_renderer(renderer, max_workers=1)
+    _WORKER_STATE["options"] = options
+
+
+def render_worker(svg_file: Path) -> tuple[str | None, dict[str, float]]:
+    """Render one file in a worker process.
+
+    Returns the error message on failure and the statistics from `render_svg`,
+    with the total time in seconds and the cache lookups for the file.
+    """
+    cc_metadata = _WORKER_STATE["cc_metadata"]
+    cache = _WORKER_STATE["cache"]
+    renderer = _WORKER_STATE["renderer"]
+    options = _WORKER_STATE["options"]
+    assert isinstance(cc_metadata, ET.Element) and isinstance(cache, MathCache)
+    assert isinstance(renderer, HTTPRenderer | WorkerRenderer)
+    assert isinstance(options, dict)
+    start = time.perf_counter()
+    try:
+        stats = render_svg(svg_file, cc_metadata, cache, renderer, **options)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", {}
+    finally:
+        lookups = dict(cache.stats)
+        cache.record_stats()
+    stats["seconds"] = time.perf_counter() - start
+    stats["cache_hits"] = lookups["hits"]
+    stats["cache_misses"] = lookups["misses"]
+    return None, stats
+
+
+def render_all(
+    svg_files: Iterable[Path] | None = None,
+    processes: int | None = None,
+    force: bool = False,
+    max_workers: int = MAX_WORKERS,
+    retries: int = RETRIES,
+    dedupe: bool = False,
+    optimize: bool = False,
+    precision: int = PRECISION,
+    renderer: str = RENDERER,
+) -> bool:
+    """Render all the SVG files whose content changed since they were last rendered.
+
+    The uncached math expressions are fetched concurrently first with the
+    ``renderer`` backend, then the files are rendered in a pool of ``processes``
+    worker processes. The ``dedupe``, ``optimize``, and ``precision`` options
+    are passed to `render_svg`.
+    The timings, cache hit ratio, and sizes are written to the report file and
+    summarized at the end.
+    Returns ``False`` if any file failed to render, so it can be used directly
+    as a doit action.
+    """
+    start = time.perf_counter()
+    if svg_files is None:
+        svg_files = HERE.glob("*.svg")
+    svg_files = sorted(svg_files)
+    options: dict[str, bool | int] = {
+        "dedupe": dedupe,
+        "optimize": optimize,
+        "precision": precision,
+    }
+    manifest = {} if force else load_manifest(options)
+
+    hashes = {svg_file.name: file_hash(svg_file) for svg_file in svg_files}
+    stale = [
+        svg_file
+        for svg_file in svg_files
+        if manifest.get(svg_file.name) != hashes[svg_file.name]
+        or not OUTPUT.joinpath(svg_file.name).exists()
+    ]
+    n_skipped = len(svg_files) - len(stale)
+    phases = {"hash_seconds": time.perf_counter() - start}
+
+    failed: dict[str, str] = {}
+    files: dict[str, dict[str, float]] = {}
+    prefetched: dict[str, Any] = {"expressions": 0, "hits": 0, "fetched": []}
+    if stale:
+        # Fetch all the uncached expressions up front so the requests can run
+        # concurrently, instead of one at a time as each file is processed.
+        checkpoint = time.perf_counter()
+        cache = load_cache()
+        math_renderer = make_renderer(renderer, max_workers, retries)
+        try:
+            # Failed expressions are reported with the files that contain them
+            prefetched = prefetch(
+                stale, cache, math_renderer, max_workers, ignore_errors=True
+            )
+        finally:
+            math_renderer.close()
+        cache.record_stats()
+        phases["prefetch_seconds"] = time.perf_counter() - checkpoint
+
+        checkpoint = time.perf_counter()
+        with ProcessPoolExecutor(
+            processes, initializer=init_worker, initargs=(options, renderer)
+        ) as executor:
+            results = executor.map(render_worker, stale)
+            for svg_file, (error, stats) in zip(stale, results):
+                if error is None:
+                    manifest[svg_file.name] = hashes[svg_file.name]
+                    files[svg_file.name] = stats
+                    if dedupe or optimize:
+                        print("  " + format_stats(svg_file.name, stats))
+                else:
+                    failed[svg_file.name] = error
+                    manifest.pop(svg_file.name, None)
+        write_manifest(manifest, options)
+        phases["render_seconds"] = time.perf_counter() - checkpoint
+    else:
+        phases["prefetch_seconds"] = phases["render_seconds"] = 0.0
+
+    n_rendered = len(stale) - len(failed)
+    n_expressions = prefetched["expressions"]
+    report = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "seconds": time.perf_counter() - start,
+        "renderer": renderer,
+        "options": options,
+        "skipped": n_skipped,
+        "failed": failed,
+        "phases": phases,
+        "cache": {
+            "expressions": n_expressions,
+            "hits": prefetched["hits"],
+            "misses": n_expressions - prefetched["hits"],
+            "hit_ratio": prefetched["hits"] / n_expressions if n_expressions else 1.0,
+        },
+        "fetched": prefetched["fetched"],
+        "files": files,
+    }
+    summary = write_report(report)
+    print(
+        f"Rendered {n_rendered}, skipped {n_skipped}, failed {len(failed)} files "
+        f"in {report['seconds']:.2f} s"
     )
+    if stale:
+        for line in format_summary(summary):
+            print("  " + line)
+    for name, error in failed.items():
+        print(f"  {name}: {error}", file=sys.stderr)
+    return not failed
 
-    write_cache(cache)
+
+def main(
+    svg_file: Path | None = None,
+    max_workers: int = MAX_WORKERS,
+    retries: int = RETRIES,
+    dedupe: bool = False,
+    optimize: bool = False,
+    precision: int = PRECISION,
+    renderer: str = RENDERER,
+) -> None:
+    if svg_file is None:
+        if not render_all(
+            max_workers=max_workers,
+            retries=retries,
+            dedupe=dedupe,
+            optimize=optimize,
+            precision=precision,
+            renderer=renderer,
+        ):
+            sys.exit(1)
+        return
+
+    register_namespaces()
+    cache = load_cache()
+    math_renderer = make_renderer(renderer, max_workers, retries)
+    try:
+        stats = render_svg(
+            svg_file,
+            load_cc_metadata(),
+            cache,
+            math_renderer,
+            dedupe,
+            optimize,
+            precision,
+        )
+    finally:
+        math_renderer.close()
+    cache.record_stats()
+    if dedupe or optimize:
+        print(format_stats(svg_file.name, stats))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1]:
-        svg_file = Path(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Render the math in the raw SVGs")
+    parser.add_argument("svg_file", nargs="?", type=Path)
+    parser.add_argument(
+        "-j",
+        "--max-workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="Number of concurrent requests to the math API",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help="Number of times to retry a failed request",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worker processes to render files with",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Render all files, even if they have not changed",
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Store repeated expressions once per file and reference them",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="Remove editor data and round numbers in the output files",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=PRECISION,
+        help="Number of decimal places kept in paths and transforms when optimizing",
+    )
+    parser.add_argument(
+        "--renderer",
+        choices=sorted(RENDERERS),
+        default=RENDERER,
+        help="Render math with the math API or a persistent MathJax process",
+    )
+    args = parser.parse_args()
+    render_options = {
+        "max_workers": args.max_workers,
+        "retries": args.retries,
+        "renderer": args.renderer,
+        "dedupe": args.dedupe,
+        "optimize": args.optimize,
+        "precision": args.precision,
+    }
+    if args.svg_file is not None:
+        svg_file = args.svg_file
         if svg_file.exists():
-            main(svg_file)
+            main(svg_file, **render_options)
         else:
             svg_file = Path("raw_svg") / svg_file
             if svg_file.exists():
-                main(svg_file)
+                main(svg_file, **render_options)
             else:
                 print("The given file does not exist", file=sys.stderr)
                 sys.exit(1)
-    else:
-        main()
+    elif not render_all(
+        processes=args.processes,
+        force=args.force,
+        **render_options,
+    ):
+        sys.exit(1)